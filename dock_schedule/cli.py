@@ -4,6 +4,7 @@ from dock_schedule.arg_parser import ArgParser
 from dock_schedule.utils import Utils
 from dock_schedule.schedule import Schedule
 from dock_schedule.init import Init
+from dock_schedule.migrations import Migrations
 from dock_schedule.swarm import Swarm, Services, Containers
 
 
@@ -65,6 +66,10 @@ def parent():
 def parse_init_args(args: dict):
     if args.get('run'):
         return Init(args['force'], args['nonInteractive'])._run()
+    if args.get('migrate'):
+        return Migrations().migrate()
+    if args.get('indexStats'):
+        return Migrations().display_index_stats()
     return True
 
 
@@ -85,6 +90,16 @@ def init(parent_args: list = None):
             'help': 'Run in non-interactive mode',
             'action': 'store_true'
         },
+        'migrate': {
+            'short': 'm',
+            'help': 'Apply pending database schema (index) migrations',
+            'action': 'store_true'
+        },
+        'indexStats': {
+            'short': 'i',
+            'help': 'Display index usage stats of the job collections',
+            'action': 'store_true'
+        },
     }).set_arguments()
     if not parse_init_args(args):
         exit(1)
@@ -265,6 +280,10 @@ def parse_job_args(args: dict):
         return run_job(args['run'])
     if args.get('results'):
         return job_results(args['results'])
+    if args.get('stats'):
+        return job_stats(args['stats'])
+    if args.get('inventories'):
+        return inventories(args['inventories'])
     if args.get('timezones'):
         return Schedule().get_timezone_options()
     return True
@@ -306,6 +325,16 @@ def jobs(parent_args: list = None):
             'help': 'Get the results of dock-schedule jobs',
             'nargs': REMAINDER,
         },
+        'stats': {
+            'short': 'S',
+            'help': 'Get run counts, failure rates and run time quantiles of dock-schedule jobs',
+            'nargs': REMAINDER,
+        },
+        'inventories': {
+            'short': 'i',
+            'help': 'Manage named host inventories that job crons reference with "@name"',
+            'nargs': REMAINDER,
+        },
         'timezones': {
             'short': 'T',
             'help': 'List all timezones available for dock-schedule jobs',
@@ -381,13 +410,55 @@ def create_job(parent_args: list = None):
         'hostInventory': {
             'short': 'H',
             'help': 'Host inventory to run remote ansible job on. Requires key=value pairs separated by comma: \
-                "hostname1=ip1, hostname2=ip2". Leave empty for the ansible job to run locally on the worker'
+                "hostname1=ip1, hostname2=ip2" or "@name" of a named inventory. Leave empty for the ansible job to \
+                run locally on the worker'
         },
         'extraVars': {
             'short': 'e',
             'help': 'Extra vars to pass to the ansible job. Requires key=value pairs separated by comma. \
                 "var1=value1, var2=value2". These will be directly used in the ansible playbook'
         },
+        'timeout': {
+            'short': 'o',
+            'help': 'Seconds the job is allowed to run before it is killed and marked timed_out. Default: no timeout',
+            'type': int,
+        },
+        'mode': {
+            'short': 'm',
+            'help': 'How the worker runs the job. "warm" runs python3 jobs without a host inventory in a pre-forked \
+                interpreter to skip interpreter startup. Default: standard',
+            'choices': ['standard', 'warm'],
+            'default': None
+        },
+        'shardSize': {
+            'short': 'S',
+            'help': 'Split the host inventory into child jobs of this many hosts that run in parallel across the \
+                workers. The job result is aggregated from every shard. Default: no sharding',
+            'type': int,
+        },
+        'keepLast': {
+            'short': 'k',
+            'help': 'Keep the results of the newest N runs, older runs are trimmed unless keepFailedFor or \
+                keepSucceededFor still covers them. Default: keep every run until JOB_RETENTION_DAYS',
+            'type': int,
+        },
+        'keepFailedFor': {
+            'short': 'F',
+            'help': 'Hours to keep the results of failed runs. Default: JOB_RETENTION_DAYS',
+            'type': int,
+        },
+        'keepSucceededFor': {
+            'short': 'K',
+            'help': 'Hours to keep the results of successful runs. Default: JOB_RETENTION_DAYS',
+            'type': int,
+        },
+        'record': {
+            'short': 'R',
+            'help': 'What a run records. "summary" skips the job document and only keeps the job stats and the last \
+                failures, for high frequency crons. Not supported with shardSize. Default: full',
+            'choices': ['full', 'summary'],
+            'default': None
+        },
         'disabled': {
             'short': 'd',
             'help': 'If the job is disabled. This will cause the job to not run until it is enabled. Default: False',
@@ -472,7 +543,8 @@ def update_job(parent_args: list = None):
         'hostInventory': {
             'short': 'H',
             'help': 'Host inventory to run remote ansible job on. Requires key=value pairs separated by comma: \
-                "hostname1=ip1, hostname2=ip2". Use "None" to remove and use localhost.',
+                "hostname1=ip1, hostname2=ip2" or "@name" of a named inventory. Use "None" to remove and use \
+                localhost.',
             'default': None
         },
         'extraVars': {
@@ -481,6 +553,43 @@ def update_job(parent_args: list = None):
                 "var1=value1, var2=value2". Include all expected key values and not just the updated ones',
             'default': None
         },
+        'timeout': {
+            'short': 'o',
+            'help': 'Seconds the job is allowed to run before it is killed and marked timed_out. Use "None" to remove.',
+            'default': None
+        },
+        'mode': {
+            'short': 'm',
+            'help': 'How the worker runs the job. Options: standard, warm (python3 jobs without a host inventory)',
+            'choices': ['standard', 'warm', None],
+            'default': None
+        },
+        'shardSize': {
+            'short': 'S',
+            'help': 'Split the host inventory into child jobs of this many hosts. Use "None" to remove.',
+            'default': None
+        },
+        'keepLast': {
+            'short': 'k',
+            'help': 'Keep the results of the newest N runs. Use "None" to remove.',
+            'default': None
+        },
+        'keepFailedFor': {
+            'short': 'F',
+            'help': 'Hours to keep the results of failed runs. Use "None" to remove.',
+            'default': None
+        },
+        'keepSucceededFor': {
+            'short': 'K',
+            'help': 'Hours to keep the results of successful runs. Use "None" to remove.',
+            'default': None
+        },
+        'record': {
+            'short': 'R',
+            'help': 'What a run records. Options: full, summary (job stats and last failures only)',
+            'choices': ['full', 'summary', None],
+            'default': None
+        },
         'state': {
             'short': 's',
             'help': 'State of the cron job. Options: enabled, disabled',
@@ -535,7 +644,8 @@ def get_job_schedule(parent_args: list = None):
 def parse_run_job_args(args: dict):
     if args.get('id'):
         return Schedule().run_predefined_job(args['id'], args.get('args'), args.get('hostInventory'),
-                                             args.get('extraVars'), args.get('wait'))
+                                             args.get('extraVars'), args.get('wait'), args.get('timeout'),
+                                             args.get('mode'), args.get('shardSize'))
     if args.get('run'):
         if not args.get('type'):
             return Schedule()._display_error('Error: --type (-t) is required to run a job')
@@ -586,6 +696,27 @@ def run_job(parent_args: list = None):
                 "var1=value1, var2=value2". Will override predefined if "--id" is used.',
             'default': None
         },
+        'timeout': {
+            'short': 'o',
+            'help': 'Seconds the job is allowed to run before it is killed and marked timed_out. Will override \
+                predefined if "--id" is used. Default: no timeout',
+            'type': int,
+            'default': None
+        },
+        'mode': {
+            'short': 'm',
+            'help': 'How the worker runs the job. "warm" runs python3 jobs without a host inventory in a pre-forked \
+                interpreter. Will override predefined if "--id" is used. Default: standard',
+            'choices': ['standard', 'warm'],
+            'default': None
+        },
+        'shardSize': {
+            'short': 'S',
+            'help': 'Split the host inventory into child jobs of this many hosts that run in parallel across the \
+                workers. Will override predefined if "--id" is used. Default: no sharding',
+            'type': int,
+            'default': None
+        },
         'wait': {
             'short': 'w',
             'help': 'Wait for the job to finish before returning. Default: False',
@@ -600,7 +731,11 @@ def run_job(parent_args: list = None):
 def parse_job_result_args(args: dict):
     if args['name'] == 'all':
         args['name'] = None
-    return Schedule().display_results(args['id'], args['name'], args['filter'], args['limit'], args['verbose'])
+    if args['export']:
+        return Schedule().export_results(args['export'], args['format'], args['name'], args['filter'], args['since'],
+                                         args['until'])
+    return Schedule().display_results(args['id'], args['name'], args['filter'], args['limit'], args['verbose'],
+                                      args['since'], args['until'], args['after'], args['before'])
 
 
 def job_results(parent_args: list = None):
@@ -623,10 +758,41 @@ def job_results(parent_args: list = None):
         },
         'filter': {
             'short': 'f',
-            'help': 'Filter the job results by status. Options: success, failed, scheduled',
-            'choices': ['success', 'failed', 'scheduled'],
+            'help': 'Filter the job results by status. Options: success, failed, scheduled, timeout',
+            'choices': ['success', 'failed', 'scheduled', 'timeout'],
+            'default': None
+        },
+        'since': {
+            'short': 's',
+            'help': 'Only jobs scheduled at or after this ISO 8601 time (UTC unless an offset is given)',
             'default': None
         },
+        'until': {
+            'short': 'u',
+            'help': 'Only jobs scheduled before this ISO 8601 time (UTC unless an offset is given)',
+            'default': None
+        },
+        'after': {
+            'short': 'a',
+            'help': 'Page key printed under the results, show the jobs older than it',
+            'default': None
+        },
+        'before': {
+            'short': 'b',
+            'help': 'Page key printed under the results, show the jobs newer than it',
+            'default': None
+        },
+        'export': {
+            'short': 'e',
+            'help': 'Stream every matching job to this file instead of displaying them. Ignores id, limit and paging',
+            'default': None
+        },
+        'format': {
+            'short': 'F',
+            'help': 'Export file format. Parquet requires pyarrow. Default: ndjson',
+            'choices': ['ndjson', 'csv', 'parquet'],
+            'default': 'ndjson'
+        },
         'verbose': {
             'short': 'v',
             'help': 'Enable verbose output',
@@ -636,3 +802,78 @@ def job_results(parent_args: list = None):
     if not parse_job_result_args(args):
         exit(1)
     exit(0)
+
+
+def parse_job_stats_args(args: dict):
+    if args['name'] == 'all':
+        args['name'] = None
+    if args['failures']:
+        return Schedule().display_job_failures(args['name'])
+    return Schedule().display_job_stats(args['name'], args['since'], args['until'])
+
+
+def job_stats(parent_args: list = None):
+    args = ArgParser('Dock Schedule: Job Stats', parent_args, {
+        'name': {
+            'short': 'n',
+            'help': 'Job name to get stats for. Use "all" to get all jobs. Default: all',
+            'default': None
+        },
+        'since': {
+            'short': 's',
+            'help': 'Start of the stats as an ISO 8601 time (UTC unless an offset is given). Default: 7 days ago',
+            'default': None
+        },
+        'until': {
+            'short': 'u',
+            'help': 'End of the stats as an ISO 8601 time (UTC unless an offset is given). Default: now',
+            'default': None
+        },
+        'failures': {
+            'short': 'f',
+            'help': 'Show the last failures of summary record jobs instead of the stats',
+            'action': 'store_true'
+        }
+    }).set_arguments()
+    if not parse_job_stats_args(args):
+        exit(1)
+    exit(0)
+
+
+def parse_inventory_args(args: dict):
+    if args.get('list'):
+        return Schedule().display_inventories()
+    if args.get('name'):
+        if args.get('delete'):
+            return Schedule().delete_inventory(args['name'])
+        if args.get('hostInventory'):
+            return Schedule().set_inventory(args['name'], args['hostInventory'])
+        return Schedule().display_inventories(args['name'])
+    return True
+
+
+def inventories(parent_args: list = None):
+    args = ArgParser('Dock Schedule: Inventories', parent_args, {
+        'list': {
+            'short': 'l',
+            'help': 'List all named inventories',
+            'action': 'store_true'
+        },
+        'name': {
+            'short': 'n',
+            'help': 'Name of the inventory to show, save or delete',
+        },
+        'hostInventory': {
+            'short': 'H',
+            'help': 'Save the inventory with these hosts. Requires key=value pairs separated by comma: \
+                "hostname1=ip1, hostname2=ip2". Replaces the hosts of an existing inventory',
+        },
+        'delete': {
+            'short': 'D',
+            'help': 'Delete the inventory. Fails while a job cron uses it',
+            'action': 'store_true'
+        }
+    }).set_arguments()
+    if not parse_inventory_args(args):
+        exit(1)
+    exit(0)
@@ -0,0 +1,294 @@
+import ssl
+import asyncio
+import logging
+from threading import Thread, Lock
+from typing import Coroutine
+
+from pika import BaseConnection
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.credentials import PlainCredentials
+from pika.channel import Channel
+from pika.connection import ConnectionParameters, SSLOptions
+
+
+class BrokerLoop():
+    def __init__(self, logger: logging.Logger = None):
+        """Single asyncio event loop that runs every broker connection of the process in one daemon thread
+
+        Args:
+            logger (logging.Logger, optional): logger object. Defaults to the dsbroker logger.
+        """
+        self.log = logger or logging.getLogger('dsbroker')
+        self.loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        except Exception:
+            self.log.exception('Exception occurred in broker event loop')
+
+    def call(self, callback: callable, *args) -> bool:
+        """Schedule a callback on the event loop from any thread. pika channels are not thread safe so every channel
+        operation made from another thread goes through here
+
+        Args:
+            callback (callable): callback to run on the event loop
+            *args: callback arguments
+
+        Returns:
+            bool: True if the callback was scheduled, otherwise False
+        """
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+            return True
+        except Exception:
+            self.log.exception('Failed to schedule callback on broker event loop')
+        return False
+
+    def run(self, coro: Coroutine, timeout: float = None):
+        """Run a coroutine on the event loop and block the calling thread until it returns
+
+        Args:
+            coro (Coroutine): coroutine to run
+            timeout (float, optional): seconds to wait for the coroutine. Defaults to None.
+
+        Returns:
+            Any: coroutine result or None if it timed out or failed
+        """
+        try:
+            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), self.loop).result()
+        except TimeoutError:
+            self.log.error(f'Timeout after {timeout}s waiting on broker event loop')
+        except Exception:
+            self.log.exception('Exception occurred while waiting on broker event loop')
+        return None
+
+    def wait(self, future: asyncio.Future, timeout: float = None):
+        """Block the calling thread until a future owned by the event loop resolves
+
+        Args:
+            future (asyncio.Future): future to wait on
+            timeout (float, optional): seconds to wait for the future. Defaults to None.
+
+        Returns:
+            Any: future result or None if it timed out or failed
+        """
+        async def waiter():
+            return await asyncio.shield(future)
+        return self.run(waiter(), timeout)
+
+
+broker_loop_lock = Lock()
+broker_loop: BrokerLoop | None = None
+
+
+def get_broker_loop(logger: logging.Logger = None) -> BrokerLoop:
+    """Get the broker event loop of this process, starting it on first use
+
+    Args:
+        logger (logging.Logger, optional): logger object. Defaults to the dsbroker logger.
+
+    Returns:
+        BrokerLoop: process wide broker event loop
+    """
+    global broker_loop
+    with broker_loop_lock:
+        if broker_loop is None:
+            broker_loop = BrokerLoop(logger)
+    return broker_loop
+
+
+class BrokerConnection():
+    def __init__(self, conn_id: str, logger: logging.Logger = None):
+        """Connection to the message broker on the process broker loop, shared by the scheduler publisher and the
+        worker consumers. Connects and reconnects with AsyncioConnection, subclasses set up their channel in
+        _open_channel and resolve _ready with _set_ready once it can be used
+
+        Args:
+            conn_id (str): ID used as the log prefix
+            logger (logging.Logger, optional): logger object. Defaults to the dsbroker logger.
+        """
+        self.log = logger or logging.getLogger('dsbroker')
+        self._id = conn_id
+        self._exchange = 'dock-schedule'
+        self._route = 'job-queue'
+        self._closing = False
+        self._loop = get_broker_loop(self.log)
+        self._client: AsyncioConnection | None = None
+        self._channel: Channel | None = None
+        self._ready: asyncio.Future = self._loop.loop.create_future()
+        self._max_connect_attempts = 36
+        self.__closed: asyncio.Future | None = None
+        self.__connect_attempt = 0
+
+    def _on_blocked(self):
+        """Called on the event loop when the broker blocks the connection"""
+
+    def _on_unblocked(self):
+        """Called on the event loop when the broker unblocks the connection"""
+
+    def _on_reconnect(self):
+        """Called on the event loop before every reconnect attempt"""
+
+    def _on_connection_closed(self):
+        """Called on the event loop when the connection closed, before a reconnect is attempted"""
+
+    def _open_channel(self, channel: Channel):
+        """Set up the channel once it is open. Must resolve _ready through _set_ready"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _resolve(future: asyncio.Future | None, result: bool):
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _set_ready(self, result: bool):
+        self._resolve(self._ready, result)
+
+    def __conn_blocked(self, *_):
+        self._on_blocked()
+
+    def __conn_unblocked(self, *_):
+        self._on_unblocked()
+
+    def __load_credentials(self):
+        creds = {'user': '', 'passwd': '', 'vhost': ''}
+        for key in creds.keys():
+            try:
+                with open(f'/run/secrets/broker_{key}', 'r') as f:
+                    creds[key] = f.read().strip()
+            except Exception:
+                self.log.exception(f'[{self._id}] Failed to load broker credentials for {key}')
+        return creds
+
+    def __create_connection_ssl_obj(self):
+        try:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_verify_locations('/app/ca.crt')
+            context.load_cert_chain('/app/host.crt', '/app/host.key')
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            return SSLOptions(context, 'broker')
+        except Exception:
+            self.log.exception(f'[{self._id}] Failed to create SSL context for broker connection')
+        return None
+
+    def __create_connection_parameters(self):
+        creds: dict = self.__load_credentials()
+        if creds:
+            ssl = self.__create_connection_ssl_obj()
+            if ssl:
+                try:
+                    return ConnectionParameters(
+                        host='broker',
+                        port=5671,
+                        virtual_host=creds.get('vhost', '/'),
+                        credentials=PlainCredentials(creds.get('user', ''), creds.get('passwd', '')),
+                        heartbeat=15,
+                        blocked_connection_timeout=20,
+                        ssl_options=ssl
+                    )
+                except Exception:
+                    self.log.exception(f'[{self._id}] Failed to create connection parameters')
+        return None
+
+    def __reconnect_attempt(self):
+        if self._closing:
+            return False
+        self._on_reconnect()
+        if self._ready.done():
+            self._ready = self._loop.loop.create_future()
+        if self.__connect_attempt < self._max_connect_attempts:
+            delay = 5 if self.__connect_attempt != 0 else 0
+            self.__connect_attempt += 1
+            self.log.info(
+                f'[{self._id}] Reconnecting to broker {self.__connect_attempt}/{self._max_connect_attempts - 1}')
+            self._loop.loop.call_later(delay, self.__open_connection)
+            return True
+        self.log.error(f'[{self._id}] Failed to reconnect to broker')
+        self._set_ready(False)
+        return False
+
+    def __open_connection(self):
+        self.log.info(f'[{self._id}] Connecting to message broker')
+        self._client = None
+        self._channel = None
+        params = self.__create_connection_parameters()
+        if params:
+            try:
+                self._client = AsyncioConnection(
+                    params, self.__connect_success, self.__connect_failed, self.__connect_closed,
+                    custom_ioloop=self._loop.loop)
+                self._client.add_on_connection_blocked_callback(self.__conn_blocked)
+                self._client.add_on_connection_unblocked_callback(self.__conn_unblocked)
+                return True
+            except Exception:
+                self.log.exception(f'[{self._id}] Failed to create connection to broker')
+        return self.__reconnect_attempt()
+
+    def __connect_success(self, connection: BaseConnection):
+        self.log.info(f'[{self._id}] Successfully connected to broker')
+        self.__connect_attempt = 0
+        connection.channel(on_open_callback=self.__channel_opened)
+
+    def __channel_opened(self, channel: Channel):
+        self.log.info(f'[{self._id}] Successfully opened channel')
+        self._channel = channel
+        self._open_channel(channel)
+
+    def __connect_failed(self, *args: tuple):
+        self.log.error(f'[{self._id}] Failed to create connection to broker: {args[1]}')
+        return self.__reconnect_attempt()
+
+    def __connect_closed(self, *args: tuple):
+        self._channel = None
+        self._on_connection_closed()
+        if self._closing:
+            self.log.info(f'[{self._id}] Connection closed')
+            return self._resolve(self.__closed, True)
+        self.log.error(f'[{self._id}] Connection closed: {args[1]}')
+        return self.__reconnect_attempt()
+
+    def __close(self):
+        try:
+            if self._client is not None and not (self._client.is_closing or self._client.is_closed):
+                self._client.close()
+                return
+        except Exception:
+            self.log.exception(f'[{self._id}] Exception occurred while closing broker connection')
+        self._resolve(self.__closed, True)
+
+    def start(self) -> bool:
+        """Connect to the broker and wait until the channel is set up, retrying for up to max_connect_attempts
+
+        Returns:
+            bool: True if the connection is ready, otherwise False
+        """
+        if self._client is not None:
+            self.log.error(f'[{self._id}] Broker already running')
+            return False
+        self.log.info(f'[{self._id}] Starting broker')
+        ready = self._ready
+        if self._loop.call(self.__open_connection) and self._loop.wait(ready, self._max_connect_attempts * 30):
+            return True
+        self.log.error(f'[{self._id}] Failed to start broker')
+        return False
+
+    def stop(self) -> bool:
+        """Close the broker connection without reconnecting
+
+        Returns:
+            bool: True if the connection closed within 5 seconds, otherwise False
+        """
+        self.log.info(f'[{self._id}] Stopping broker')
+        self._closing = True
+        self.__closed = self._loop.loop.create_future()
+        if self._loop.call(self.__close) and self._loop.wait(self.__closed, 5):
+            self._client = None
+            self.log.info(f'[{self._id}] Successfully stopped broker connection')
+            return True
+        self.log.error(f'[{self._id}] Failed to stop broker')
+        return False
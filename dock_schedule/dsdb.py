@@ -0,0 +1,996 @@
+import os
+import re
+import json
+import hashlib
+import math
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic, sleep, perf_counter
+from typing import Dict
+from urllib.parse import quote_plus
+from uuid import uuid4
+
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import (BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure,
+                            ServerSelectionTimeoutError)
+from pymongo.write_concern import WriteConcern
+
+
+def get_env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logging.getLogger('dsdb').error(f'Invalid integer value for {name}, using default {default}')
+    return default
+
+
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mongodb')
+DB_POOL_SIZE = get_env_int('DB_POOL_SIZE', 10)
+DB_MIN_POOL_SIZE = get_env_int('DB_MIN_POOL_SIZE', 0)
+DB_MAX_TIME_MS = get_env_int('DB_MAX_TIME_MS', 10000)
+DB_BULK_BATCH = get_env_int('DB_BULK_BATCH', 500)
+DB_CONNECT_ATTEMPTS = get_env_int('DB_CONNECT_ATTEMPTS', 36)
+JOB_PARTITIONING = os.environ.get('JOB_PARTITIONING', 'none')
+JOB_RETENTION_DAYS = get_env_int('JOB_RETENTION_DAYS', 7)
+JOB_STATS_RETENTION_DAYS = get_env_int('JOB_STATS_RETENTION_DAYS', 30)
+JOB_PARTITION_ID = re.compile(r'^(\d{8})_')
+JOB_PARTITION_INDEXES = [
+    [('scheduled', -1), ('_id', -1)],
+    [('state', 1), ('scheduled', -1), ('_id', -1)],
+    [('name', 1), ('scheduled', -1), ('_id', -1)],
+    [('result', 1), ('scheduled', -1), ('_id', -1)],
+    [('state', 1), ('leaseUntil', 1)],
+]
+DURATION_SKETCH_ACCURACY = 0.02
+DURATION_SKETCH_GAMMA = (1 + DURATION_SKETCH_ACCURACY) / (1 - DURATION_SKETCH_ACCURACY)
+DURATION_SKETCH_MIN_SECONDS = 0.001
+JOB_SPEC_CACHE_SIZE = get_env_int('JOB_SPEC_CACHE_SIZE', 512)
+CRON_VERSION_REFRESH_SECONDS = 3600
+CRON_SPEC_KEYS = ['type', 'run', 'args', 'hostInventory', 'inventory', 'extraVars', 'timeout', 'mode', 'runHash']
+
+
+def job_collection(job_id: str) -> str:
+    """Collection of a job. Jobs created with daily partitioning carry their partition day in the ID
+    (YYYYMMDD_<uuid>), any other job is in the jobs collection
+
+    Args:
+        job_id (str): job ID
+
+    Returns:
+        str: jobs_YYYYMMDD or jobs
+    """
+    match = JOB_PARTITION_ID.match(job_id or '')
+    return f'jobs_{match.group(1)}' if match else 'jobs'
+
+
+def sibling_job_id(job_id: str) -> str:
+    """New job ID in the same collection as job_id, for the child jobs of a sharded job"""
+    match = JOB_PARTITION_ID.match(job_id or '')
+    return f'{match.group(1)}_{uuid4()}' if match else str(uuid4())
+
+
+def cron_version(cron: Dict) -> str:
+    """Version of the run spec of a cron, a hash of its CRON_SPEC_KEYS so a cron only gets a new version when the
+    spec its jobs run with changes
+
+    Args:
+        cron (Dict): cron document
+
+    Returns:
+        str: cron version
+    """
+    spec = json.dumps({key: cron.get(key) for key in CRON_SPEC_KEYS}, sort_keys=True, default=str)
+    return hashlib.sha1(spec.encode()).hexdigest()[:16]
+
+
+def duration_sketch_key(seconds: float) -> str:
+    """Bucket of a run time in the durationSketch of a job_stats rollup. Buckets grow by DURATION_SKETCH_GAMMA so a
+    quantile read back from the sketch is within DURATION_SKETCH_ACCURACY of the real run time
+
+    Args:
+        seconds (float): job run time
+
+    Returns:
+        str: bucket index, used as the field name in durationSketch
+    """
+    return str(math.ceil(math.log(max(seconds, DURATION_SKETCH_MIN_SECONDS), DURATION_SKETCH_GAMMA)))
+
+
+def duration_quantile(sketch: Dict[str, int], quantile: float) -> float | None:
+    """Estimate a run time quantile from a durationSketch
+
+    Args:
+        sketch (Dict[str, int]): run count per bucket index
+        quantile (float): quantile to estimate, 0 to 1
+
+    Returns:
+        float | None: run time in seconds or None if the sketch is empty
+    """
+    buckets = sorted((int(index), count) for index, count in sketch.items())
+    rank = quantile * (sum(count for _, count in buckets) - 1)
+    seen = 0
+    for index, count in buckets:
+        seen += count
+        if seen > rank:
+            return 2 * DURATION_SKETCH_GAMMA ** index / (DURATION_SKETCH_GAMMA + 1)
+    return None
+
+
+def summarize_job_stats(rollups: list[Dict]) -> Dict[str, Dict]:
+    """Merge hourly job_stats rollups per job name
+
+    Args:
+        rollups (list[Dict]): job_stats documents
+
+    Returns:
+        Dict[str, Dict]: runs, failures, timedOut, durationSeconds (sum), maxDurationSeconds and durationSketch per name
+    """
+    summary: Dict[str, Dict] = {}
+    for rollup in rollups:
+        stats = summary.setdefault(rollup.get('name', ''), {
+            'runs': 0, 'failures': 0, 'timedOut': 0, 'durationSeconds': 0, 'maxDurationSeconds': 0,
+            'durationSketch': {}
+        })
+        for key in ['runs', 'failures', 'timedOut', 'durationSeconds']:
+            stats[key] += rollup.get(key, 0)
+        stats['maxDurationSeconds'] = max(stats['maxDurationSeconds'], rollup.get('maxDurationSeconds', 0))
+        for index, count in rollup.get('durationSketch', {}).items():
+            stats['durationSketch'][index] = stats['durationSketch'].get(index, 0) + count
+    return summary
+
+
+def record_job_stats(db: 'Mongo', job: Dict) -> bool:
+    """Add a completed job run to the hourly rollup of its name in job_stats: run and failure counts, resource usage
+    and a duration sketch to read run time quantiles back from. Rollups are kept for JOB_STATS_RETENTION_DAYS, longer
+    than the jobs themselves
+
+    Args:
+        db (Mongo): database connection
+        job (Dict): completed job with name, start, end, result, state and optionally usage
+
+    Returns:
+        bool: True if the rollup was updated, False otherwise
+    """
+    usage = job.get('usage') or {}
+    hour = job['end'].replace(minute=0, second=0, microsecond=0)
+    duration = (job['end'] - job['start']).total_seconds() if job.get('start') else 0
+    stats = {
+        '$set': {'name': job['name'], 'hour': hour, 'expiresAt': hour + timedelta(days=JOB_STATS_RETENTION_DAYS)},
+        '$inc': {
+            'runs': 1,
+            'failures': 0 if job['result'] else 1,
+            'timedOut': 1 if job['state'] == 'timed_out' else 0,
+            f'durationSketch.{duration_sketch_key(duration)}': 1,
+            'userCpu': usage.get('userCpu', 0),
+            'sysCpu': usage.get('sysCpu', 0),
+            'blockIn': usage.get('blockIn', 0),
+            'blockOut': usage.get('blockOut', 0),
+            'voluntaryCtxSwitches': usage.get('voluntaryCtxSwitches', 0),
+            'involuntaryCtxSwitches': usage.get('involuntaryCtxSwitches', 0),
+            'durationSeconds': duration,
+        },
+        '$max': {'maxRssKb': usage.get('maxRssKb', 0), 'maxDurationSeconds': duration},
+    }
+    query = {'_id': f'{job["name"]}|{hour.strftime("%Y%m%d%H")}'}
+    for _ in range(2):  # A concurrent first upsert of the hour collides on _id, the retry updates it instead
+        rsp = db.update_one('job_stats', query, stats, upsert=True)
+        if rsp is not False:
+            break
+    return bool(rsp)
+
+
+class LatencyHistogram():
+    def __init__(self, buckets: tuple = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        """Latency of database calls per collection and operation, rendered in the Prometheus text format
+
+        Args:
+            buckets (tuple, optional): histogram bucket bounds in seconds
+        """
+        self.__buckets = buckets
+        self.__lock = Lock()
+        self.__series: Dict[tuple, list] = {}
+
+    def observe(self, collection: str, operation: str, seconds: float):
+        with self.__lock:
+            # Cumulative bucket counts followed by the sum and count of the observations
+            series = self.__series.setdefault((collection, operation), [0] * (len(self.__buckets) + 2))
+            for index, bound in enumerate(self.__buckets):
+                if seconds <= bound:
+                    series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self, name: str) -> list[str]:
+        """Render the histogram
+
+        Args:
+            name (str): metric name, such as worker_db_latency_seconds
+
+        Returns:
+            list[str]: lines in the Prometheus text format
+        """
+        lines = [f'# HELP {name} Latency of database calls by collection and operation', f'# TYPE {name} histogram']
+        with self.__lock:
+            series = {key: list(value) for key, value in self.__series.items()}
+        for (collection, operation), values in sorted(series.items()):
+            labels = f'collection="{collection}",operation="{operation}"'
+            for bound, count in zip(self.__buckets, values):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {values[-1]}')
+            lines.append(f'{name}_sum{{{labels}}} {values[-2]}')
+            lines.append(f'{name}_count{{{labels}}} {values[-1]}')
+        return lines
+
+
+db_latency = LatencyHistogram()
+clients_lock = Lock()
+clients: Dict[tuple, MongoClient] = {}
+connect_locks: Dict[tuple, Lock] = {}
+CONNECT_ATTEMPT_SECONDS = 4  # serverSelectionTimeoutMS plus the sleep between attempts
+
+
+class Mongo():
+    def __init__(self, client_id: str = None, logger: logging.Logger = None, creds_file: str = None,
+                 tls_ca_file: str = '/app/ca.crt', tls_cert_file: str = '/app/host.pem', backend: str = DB_BACKEND,
+                 write_concern: Dict = None):
+        """Data access shared by the CLI, scheduler and worker. Every Mongo object of a process uses one pooled client
+        per server and credentials (sized by DB_POOL_SIZE and DB_MIN_POOL_SIZE), every call has its latency recorded
+        in db_latency and reads are bounded by DB_MAX_TIME_MS unless the call passes its own max_time_ms
+
+        Args:
+            client_id (str, optional): ID used to prefix log messages. Defaults to a random ID.
+            logger (logging.Logger, optional): logger object. Defaults to the dsdb logger.
+            creds_file (str, optional): JSON credentials file (user, passwd, db). Defaults to the mongo_* docker
+                secrets.
+            tls_ca_file (str, optional): CA certificate. Defaults to '/app/ca.crt'.
+            tls_cert_file (str, optional): client certificate and key. Defaults to '/app/host.pem'.
+            backend (str, optional): 'mongodb' or 'memory' for an in-memory stand-in (requires mongomock). Defaults to
+                DB_BACKEND.
+            write_concern (Dict, optional): write concern of every write, such as {'w': 'majority', 'wtimeout': 5000}.
+                Defaults to the server default.
+        """
+        self.log = logger or logging.getLogger('dsdb')
+        self.__id = client_id or str(uuid4())[:8]
+        self.__creds_file = creds_file
+        self.__tls_ca_file = tls_ca_file
+        self.__tls_cert_file = tls_cert_file
+        self.__backend = backend
+        self.__write_concern = WriteConcern(**write_concern) if write_concern else None
+        self.__client: MongoClient | None = None
+        self.__creds = {'user': '', 'passwd': '', 'db': ''}
+
+    @property
+    def __host(self):
+        return "mongodb://%s:%s@mongodb:27017/" % (quote_plus(self.__creds.get('user')),
+                                                   quote_plus(self.__creds.get('passwd')))
+
+    @property
+    def client(self):
+        if self.__client is None:
+            if self.__backend == 'memory':
+                self.__client = self.__memory_client()
+            elif self.__load_creds():
+                # Keyed by pid as well so a forked process never reuses the client of its parent
+                key = (os.getpid(), self.__host, self.__tls_ca_file, self.__tls_cert_file)
+                self.__client = self.__shared_client(key)
+        return self.__client
+
+    def __shared_client(self, key: tuple) -> MongoClient | None:
+        """Pooled client of key. One thread of the process connects it while the others wait up to one connect attempt
+        and then fail their call instead of queueing behind the whole retry loop. clients_lock only guards the
+        registry and is never held while connecting
+        """
+        with clients_lock:
+            if key in clients:
+                return clients[key]
+            connecting = connect_locks.setdefault(key, Lock())
+        if not connecting.acquire(timeout=CONNECT_ATTEMPT_SECONDS):
+            self.log.error(f'[{self.__id}] MongoDB client is still connecting on another thread')
+            return None
+        try:
+            with clients_lock:
+                if key in clients:
+                    return clients[key]
+            client = self.__create_client()
+            if client is not None:
+                with clients_lock:
+                    clients[key] = client
+            return client
+        finally:
+            connecting.release()
+
+    def __create_client(self) -> MongoClient | None:
+        for attempt in range(DB_CONNECT_ATTEMPTS):
+            try:
+                client = MongoClient(
+                    host=self.__host,
+                    tls=True,
+                    tlsCAFile=self.__tls_ca_file,
+                    tlsCertificateKeyFile=self.__tls_cert_file,
+                    serverSelectionTimeoutMS=2000,
+                    maxPoolSize=DB_POOL_SIZE,
+                    minPoolSize=DB_MIN_POOL_SIZE
+                )
+                client.admin.command('ping')
+                self.log.info(f'[{self.__id}] MongoDB client created successfully')
+                return client
+            except ServerSelectionTimeoutError:
+                self.log.error(f'[{self.__id}] Failed to connect to MongoDB {attempt + 1}/{DB_CONNECT_ATTEMPTS}')
+            except ConnectionFailure:
+                self.log.exception(f'[{self.__id}] Failed to connect to MongoDB')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to create MongoDB client')
+                return None
+            sleep(2)
+        return None
+
+    def __memory_client(self):
+        try:
+            import mongomock
+        except ImportError:
+            self.log.error(f'[{self.__id}] The memory backend requires mongomock (pip install mongomock)')
+            return None
+        self.__creds['db'] = self.__creds.get('db') or 'dock-schedule'
+        with clients_lock:
+            return clients.setdefault((os.getpid(), 'memory'), mongomock.MongoClient())
+
+    def __load_creds(self):
+        if self.__creds_file:
+            try:
+                with open(self.__creds_file, 'r') as file:
+                    self.__creds = json.load(file)
+                return True
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to load mongodb credentials')
+                return False
+        for key in self.__creds.keys():
+            try:
+                with open(f'/run/secrets/mongo_{key}', 'r') as f:
+                    self.__creds[key] = f.read().strip()
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to load mongodb credentials for {key}')
+                return False
+        return True
+
+    def __get_db(self):
+        if self.client:
+            try:
+                return self.client[self.__creds.get('db')]
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to get database object')
+        return None
+
+    def __get_collection(self, collection_name: str = 'jobs'):
+        db = self.__get_db()
+        if db is not None:
+            try:
+                return db.get_collection(collection_name, write_concern=self.__write_concern)
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to get collection: {collection_name}')
+        return None
+
+    @contextmanager
+    def __timed(self, collection_name: str, operation: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            db_latency.observe(collection_name, operation, perf_counter() - start)
+
+    def insert_one(self, collection_name: str, document: Dict):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'insert_one'):
+                    return collection.insert_one(document)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to insert document: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to insert document: {document}')
+        return None
+
+    def insert_many(self, collection_name: str, documents: list[Dict]):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'insert_many'):
+                    return collection.insert_many(documents)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to insert documents: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to insert documents: {documents}')
+        return None
+
+    def get_one(self, collection_name: str, query: Dict = None, projection: Dict = None, max_time_ms: int = None):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'find_one'):
+                    return collection.find_one(query, projection, max_time_ms=max_time_ms or DB_MAX_TIME_MS)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to find data')
+        return None
+
+    def find(self, collection_name: str, query: Dict = None, projection: Dict = None, sort: list = None,
+             limit: int = 0, max_time_ms: int = None, skip: int = 0) -> list | None:
+        """Find documents
+
+        Args:
+            collection_name (str): collection to query
+            query (Dict, optional): filter. Defaults to every document.
+            projection (Dict, optional): fields to return. Defaults to every field.
+            sort (list, optional): (field, direction) pairs to sort on. Defaults to None.
+            limit (int, optional): max documents to return, 0 for no limit. Defaults to 0.
+            max_time_ms (int, optional): server side time limit. Defaults to DB_MAX_TIME_MS.
+            skip (int, optional): documents to skip before the first one returned. Defaults to 0.
+
+        Returns:
+            list | None: matching documents or None if the query failed
+        """
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'find'):
+                    cursor = collection.find(query, projection, max_time_ms=max_time_ms or DB_MAX_TIME_MS)
+                    if sort:
+                        cursor = cursor.sort(sort)
+                    return list(cursor.skip(skip).limit(limit))
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to find data')
+        return None
+
+    def get_all(self, collection_name: str, query: Dict = None, projection: Dict = None, sort: list = None,
+                limit: int = 0, max_time_ms: int = None) -> list:
+        """Same as find but returns an empty list when the query fails"""
+        return self.find(collection_name, query, projection, sort, limit, max_time_ms) or []
+
+    def get_all_with_cursor(self, collection_name: str, query: Dict = None, projection: Dict = None,
+                            max_time_ms: int = None):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                # Not bounded by DB_MAX_TIME_MS since the caller iterates the cursor at its own pace
+                return collection.find(query, projection, max_time_ms=max_time_ms)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to query collection')
+        return None
+
+    def update_one(self, collection_name: str, query: Dict, update: Dict | list, upsert: bool = False):
+        """Update a document
+
+        Args:
+            collection_name (str): collection of the document
+            query (Dict): filter of the document to update
+            update (Dict | list): update or update pipeline to apply
+            upsert (bool, optional): insert the document if the filter does not match. Defaults to False.
+
+        Returns:
+            UpdateResult | bool | None: update result, False if the upsert collided with an existing _id or None on
+                error
+        """
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'update_one'):
+                    return collection.update_one(query, update, upsert=upsert)
+            except DuplicateKeyError:
+                return False
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to update data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to update document: {query}')
+        return None
+
+    def update_many(self, collection_name: str, query: Dict, update: Dict | list, upsert: bool = False):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'update_many'):
+                    return collection.update_many(query, update, upsert=upsert)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to update data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to update documents: {query}')
+        return None
+
+    def find_one_and_update(self, collection_name: str, query: Dict, update: Dict | list, projection: Dict = None,
+                            upsert: bool = False, max_time_ms: int = None):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'find_one_and_update'):
+                    return collection.find_one_and_update(query, update, projection, upsert=upsert,
+                                                          return_document=ReturnDocument.AFTER,
+                                                          maxTimeMS=max_time_ms or DB_MAX_TIME_MS)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to find and update data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to find and update document: {query}')
+        return None
+
+    def delete_one(self, collection_name: str, query: Dict):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'delete_one'):
+                    return collection.delete_one(query)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to delete data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to delete document: {query}')
+        return None
+
+    def delete_many(self, collection_name: str, query: Dict):
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'delete_many'):
+                    return collection.delete_many(query)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to delete data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to delete documents: {query}')
+        return None
+
+    def bulk_write(self, collection_name: str, requests: list, ordered: bool = True,
+                   batch_size: int = DB_BULK_BATCH) -> Dict | None:
+        """Run write operations as bulk writes of up to batch_size operations. An ordered write stops at the batch
+        with the first write error
+
+        Args:
+            collection_name (str): collection to write to
+            requests (list): pymongo write operations
+            ordered (bool, optional): stop at the first failed operation. Defaults to True.
+            batch_size (int, optional): operations per bulk write. Defaults to DB_BULK_BATCH.
+
+        Returns:
+            Dict | None: combined bulk API result (nInserted, nMatched, nModified, nUpserted, nRemoved, writeErrors
+                with their index into requests and writeConcernErrors) or None if a batch failed without a result
+        """
+        collection = self.__get_collection(collection_name)
+        if collection is None:
+            return None
+        summary = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'nRemoved': 0, 'writeErrors': [],
+                   'writeConcernErrors': []}
+        for start in range(0, len(requests), batch_size):
+            try:
+                with self.__timed(collection_name, 'bulk_write'):
+                    details = collection.bulk_write(requests[start:start + batch_size], ordered=ordered).bulk_api_result
+            except BulkWriteError as error:
+                details = error.details
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to bulk write data: {error.details}')
+                return None
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to bulk write {len(requests)} operations')
+                return None
+            for key in ['nInserted', 'nMatched', 'nModified', 'nUpserted', 'nRemoved']:
+                summary[key] += details.get(key, 0)
+            summary['writeErrors'] += [{**error, 'index': error['index'] + start}
+                                       for error in details.get('writeErrors', [])]
+            summary['writeConcernErrors'] += details.get('writeConcernErrors', [])
+            if ordered and details.get('writeErrors'):
+                break
+        return summary
+
+    def aggregate(self, collection_name: str, pipeline: list[Dict], max_time_ms: int = None) -> list[Dict] | None:
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'aggregate'):
+                    return list(collection.aggregate(pipeline, maxTimeMS=max_time_ms or DB_MAX_TIME_MS))
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to aggregate data: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to aggregate data')
+        return None
+
+    def count_documents(self, collection_name: str, query: Dict, max_time_ms: int = None) -> int:
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'count_documents'):
+                    return collection.count_documents(query, maxTimeMS=max_time_ms or DB_MAX_TIME_MS)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to count documents: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to count documents')
+        return 0
+
+    def create_index(self, collection_name: str, keys: list[tuple], **kwargs) -> str | None:
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'create_index'):
+                    return collection.create_index(keys, **kwargs)
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to create index on {collection_name}: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to create index on {collection_name}: {keys}')
+        return None
+
+    def list_collection_names(self, name_pattern: str) -> list[str] | None:
+        db = self.__get_db()
+        if db is not None:
+            try:
+                with self.__timed('*', 'list_collections'):
+                    names = db.list_collection_names()
+                # Matched here, the memory backend keeps dropped collections in listings filtered by name
+                return [name for name in names if re.search(name_pattern, name)]
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to list collections: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to list collections')
+        return None
+
+    def drop_collection(self, collection_name: str) -> bool:
+        db = self.__get_db()
+        if db is not None:
+            try:
+                with self.__timed(collection_name, 'drop_collection'):
+                    db.drop_collection(collection_name)
+                return True
+            except OperationFailure as error:
+                self.log.error(f'[{self.__id}] Failed to drop collection {collection_name}: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to drop collection {collection_name}')
+        return False
+
+    def drop_index(self, collection_name: str, index_name: str) -> bool:
+        collection = self.__get_collection(collection_name)
+        if collection is not None:
+            try:
+                with self.__timed(collection_name, 'drop_index'):
+                    collection.drop_index(index_name)
+                return True
+            except OperationFailure as error:
+                if error.code == 27 or 'index not found' in str(error):  # IndexNotFound, already dropped
+                    return True
+                self.log.error(f'[{self.__id}] Failed to drop index {index_name} on {collection_name}: {error.details}')
+            except Exception:
+                self.log.exception(f'[{self.__id}] Failed to drop index {index_name} on {collection_name}')
+        return False
+
+
+class SchemaMigrations():
+    def __init__(self, db: Mongo, migrations_file: str, logger: logging.Logger = None):
+        """Versioned index migrations from migrations.json. Applied versions are recorded in schema_migrations and
+        every step is idempotent, so the scheduler and `dschedule -I --migrate` can both run them
+
+        Args:
+            db (Mongo): database client
+            migrations_file (str): migration definitions
+            logger (logging.Logger, optional): logger object. Defaults to the dsdb logger.
+        """
+        self.log = logger or logging.getLogger('dsdb')
+        self.__db = db
+        self.__migrations_file = migrations_file
+
+    def __load_migrations(self) -> list | None:
+        try:
+            with open(self.__migrations_file, 'r') as file:
+                return sorted(json.load(file), key=lambda migration: migration['version'])
+        except Exception:
+            self.log.exception(f'Failed to load schema migrations from {self.__migrations_file}')
+        return None
+
+    def __apply(self, migration: Dict) -> bool:
+        for index in migration.get('createIndexes', []):
+            keys = [tuple(key) for key in index['keys']]
+            if self.__db.create_index(index['collection'], keys, **index.get('options', {})) is None:
+                return False
+        for index in migration.get('dropIndexes', []):
+            if not self.__db.drop_index(index['collection'], index['name']):
+                return False
+        for backfill in migration.get('backfills', []):
+            if not self.__backfill(backfill):
+                return False
+        return self.__db.update_one('schema_migrations', {'_id': migration['version']}, {'$set': {
+            'description': migration.get('description', ''),
+            'appliedAt': datetime.now(timezone.utc).replace(tzinfo=None)
+        }}, upsert=True) is not None
+
+    def __backfill(self, backfill: Dict) -> bool:
+        """Apply an update to the documents matching a filter in _id ordered batches, so the collection stays
+        writable while it runs and a document the update cannot convert is not revisited"""
+        collection, last_id, updated = backfill['collection'], None, 0
+        while True:
+            query = dict(backfill['filter'])
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            cursor = self.__db.get_all_with_cursor(collection, query, {'_id': 1})
+            if cursor is None:
+                return False
+            try:
+                ids = [doc['_id'] for doc in cursor.sort('_id', 1).limit(backfill.get('batchSize', 1000))]
+            except Exception:
+                self.log.exception(f'Failed to read backfill batch of {collection}')
+                return False
+            if not ids:
+                self.log.info(f'Backfilled {updated} documents of {collection}')
+                return True
+            if self.__db.update_many(collection, {'_id': {'$in': ids}}, backfill['update']) is None:
+                return False
+            updated += len(ids)
+            last_id = ids[-1]
+
+    def migrate(self) -> bool:
+        """Apply every migration not yet recorded in schema_migrations, in version order
+
+        Returns:
+            bool: True if the schema is at the latest version, otherwise False
+        """
+        migrations = self.__load_migrations()
+        if migrations is None:
+            return False
+        applied = {doc['_id'] for doc in self.__db.get_all('schema_migrations', {}, {'_id': 1})}
+        for migration in migrations:
+            if migration['version'] in applied:
+                continue
+            self.log.info(f'Applying schema migration {migration["version"]}: {migration.get("description", "")}')
+            if not self.__apply(migration):
+                self.log.error(f'Failed to apply schema migration {migration["version"]}')
+                return False
+        if migrations:
+            self.log.info(f'Database schema is at version {migrations[-1]["version"]}')
+        return True
+
+
+class JobPartitions():
+    def __init__(self, db: Mongo, logger: logging.Logger = None, partitioning: str = None,
+                 retention_days: int = JOB_RETENTION_DAYS):
+        """Daily job partitions. With daily partitioning jobs go to a jobs_YYYYMMDD collection of the day they were
+        scheduled, which is dropped as a whole once it is retention_days old instead of TTL deleting every job. Jobs
+        created before partitioning was enabled stay in the jobs collection until its TTL index expires them
+
+        Args:
+            db (Mongo): database client
+            logger (logging.Logger, optional): logger object. Defaults to the dsdb logger.
+            partitioning (str, optional): 'daily' or 'none'. Defaults to detecting it from the partitions in the
+                database, for the CLI which does not know the scheduler setting.
+            retention_days (int, optional): days a partition is kept. Defaults to JOB_RETENTION_DAYS.
+        """
+        self.log = logger or logging.getLogger('dsdb')
+        self.__db = db
+        self.__partitioning = partitioning
+        self.__retention_days = retention_days
+        self.__ensured: set[str] = set()
+        self.__lock = Lock()
+
+    @property
+    def partitioned(self) -> bool:
+        if self.__partitioning is None:
+            return bool(self.__partitions())
+        return self.__partitioning == 'daily'
+
+    def __partitions(self) -> list[str] | None:
+        names = self.__db.list_collection_names(r'^jobs_\d{8}$')
+        return sorted(names) if names is not None else None
+
+    def new_job_id(self, scheduled: datetime) -> str:
+        """ID of a new job, carrying its partition day when partitioned
+
+        Args:
+            scheduled (datetime): UTC time the job is scheduled
+
+        Returns:
+            str: job ID
+        """
+        if self.partitioned:
+            return f'{scheduled:%Y%m%d}_{uuid4()}'
+        return str(uuid4())
+
+    def collections(self, since: datetime = None, until: datetime = None) -> list[str] | None:
+        """Job collections that can hold jobs scheduled in [since, until), newest partition first. Partitions split
+        jobs by scheduled day, so reading them in this order returns jobs newest first. The jobs collection comes last
+        since it holds the jobs from before partitioning
+
+        Args:
+            since (datetime, optional): earliest scheduled time. Defaults to None.
+            until (datetime, optional): latest scheduled time. Defaults to None.
+
+        Returns:
+            list[str] | None: collection names or None if they could not be listed
+        """
+        names = self.__partitions()
+        if names is None:
+            return None
+        # A day early since a manual job keeps the ID the CLI gave it, which can carry the day before around midnight
+        first = f'jobs_{since - timedelta(days=1):%Y%m%d}' if isinstance(since, datetime) else None
+        last = f'jobs_{until:%Y%m%d}' if isinstance(until, datetime) else None
+        selected = [name for name in names if (not first or name >= first) and (not last or name <= last)]
+        return selected[::-1] + ['jobs']
+
+    def ensure(self, collection_name: str) -> bool:
+        """Create the job indexes of a partition, once per process
+
+        Args:
+            collection_name (str): job collection
+
+        Returns:
+            bool: True if the indexes exist, otherwise False
+        """
+        if collection_name == 'jobs' or collection_name in self.__ensured:
+            return True
+        for keys in JOB_PARTITION_INDEXES:
+            if self.__db.create_index(collection_name, keys) is None:
+                self.log.error(f'Failed to create job indexes of partition {collection_name}')
+                return False
+        with self.__lock:
+            self.__ensured.add(collection_name)
+        return True
+
+    def prepare(self, now: datetime) -> bool:
+        """Create today's and tomorrow's partitions ahead of their first job when partitioned and drop the partitions
+        older than the retention. Expired partitions are dropped even when partitioning was switched off since then
+
+        Args:
+            now (datetime): current UTC time
+
+        Returns:
+            bool: True if every step succeeded, otherwise False
+        """
+        success = True
+        if self.__partitioning == 'daily':
+            for day in [now, now + timedelta(days=1)]:
+                success = self.ensure(f'jobs_{day:%Y%m%d}') and success
+        names = self.__partitions()
+        if names is None:
+            return False
+        cutoff = f'jobs_{now - timedelta(days=self.__retention_days):%Y%m%d}'
+        for name in names:
+            if name < cutoff:
+                if self.__db.drop_collection(name):
+                    self.log.info(f'Dropped expired job partition {name}')
+                else:
+                    success = False
+        return success
+
+
+class JobSpecs():
+    def __init__(self, db: Mongo, logger: logging.Logger = None, size: int = JOB_SPEC_CACHE_SIZE):
+        """Cron versions and named inventories that job documents reference instead of carrying a copy of them. Cache
+        entries are keyed by version and never change once written, a changed cron or inventory is a new key, so
+        entries are only evicted when the cache is full
+
+        Args:
+            db (Mongo): database client
+            logger (logging.Logger, optional): logger object. Defaults to the dsdb logger.
+            size (int, optional): max cached specs. Defaults to JOB_SPEC_CACHE_SIZE.
+        """
+        self.log = logger or logging.getLogger('dsdb')
+        self.__db = db
+        self.__size = size
+        self.__cache: OrderedDict[tuple, Dict] = OrderedDict()
+        self.__saved: Dict[tuple, float] = {}
+        self.__lock = Lock()
+
+    def __cached(self, key: tuple) -> Dict | None:
+        with self.__lock:
+            value = self.__cache.get(key)
+            if value is not None:
+                self.__cache.move_to_end(key)
+            return value
+
+    def __store(self, key: tuple, value: Dict):
+        with self.__lock:
+            self.__cache[key] = value
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.__size:
+                self.__cache.popitem(last=False)
+
+    def save_cron_version(self, cron: Dict) -> str | None:
+        """Store the run spec of a cron as an immutable cron_versions document if it is not stored yet and push back
+        its expiry. A version expires two days after the retention of the last job that referenced it, the expiry is
+        refreshed at most every CRON_VERSION_REFRESH_SECONDS. A version of a live cron that expired between two runs
+        is stored again by its next run
+
+        Args:
+            cron (Dict): cron document
+
+        Returns:
+            str | None: cron version or None if it could not be stored
+        """
+        version = cron_version(cron)
+        key = (cron['_id'], version)
+        with self.__lock:
+            saved = self.__saved.get(key)
+        if saved is not None and monotonic() - saved < CRON_VERSION_REFRESH_SECONDS:
+            return version
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        rsp = self.__db.update_one('cron_versions', {'_id': f'{cron["_id"]}:{version}'}, {
+            '$setOnInsert': {
+                'cronId': cron['_id'],
+                'version': version,
+                'savedAt': now,
+                **{key: cron.get(key) for key in CRON_SPEC_KEYS},
+            },
+            '$set': {'lastUsed': now, 'expiresAt': now + timedelta(days=JOB_RETENTION_DAYS + 2)},
+        }, upsert=True)
+        if rsp is None:
+            return None
+        # False is a concurrent upsert of the same version, which stored it already
+        if rsp is not False:
+            with self.__lock:
+                self.__saved[key] = monotonic()
+        return version
+
+    def cron_spec(self, cron_id: str, version: str) -> Dict | None:
+        """Run spec of a cron version
+
+        Args:
+            cron_id (str): cron ID
+            version (str): cron version
+
+        Returns:
+            Dict | None: CRON_SPEC_KEYS of the cron version or None if it was not found
+        """
+        key = ('cron', cron_id, version)
+        spec = self.__cached(key)
+        if spec is None:
+            spec = self.__db.get_one('cron_versions', {'_id': f'{cron_id}:{version}'},
+                                     {key: 1 for key in CRON_SPEC_KEYS})
+            if spec is None:
+                self.log.error(f'Version {version} of cron {cron_id} not found')
+                return None
+            spec.pop('_id', None)
+            self.__store(key, spec)
+        return dict(spec)
+
+    def join_cron_versions(self, jobs: list[Dict]) -> list[Dict]:
+        """Fill in the run spec of jobs that reference a cron version, the way the worker resolves it, for the result
+        views and exports. Fields set on the job itself, like the host inventory of a shard, are kept. Versions that
+        are not cached are read in one query
+
+        Args:
+            jobs (list[Dict]): job documents, updated in place
+
+        Returns:
+            list[Dict]: the same jobs
+        """
+        keys = {('cron', job['cronId'], job.get('cronVersion')) for job in jobs if job.get('cronId')}
+        missing = [key for key in keys if self.__cached(key) is None]
+        if missing:
+            versions = self.__db.get_all('cron_versions', {'_id': {'$in': [f'{key[1]}:{key[2]}' for key in missing]}},
+                                         {'cronId': 1, 'version': 1, **{key: 1 for key in CRON_SPEC_KEYS}})
+            for spec in versions:
+                spec.pop('_id', None)
+                self.__store(('cron', spec.pop('cronId', None), spec.pop('version', None)), spec)
+        for job in jobs:
+            spec = self.__cached(('cron', job['cronId'], job.get('cronVersion'))) if job.get('cronId') else None
+            for key, value in (spec or {}).items():
+                if value is not None:
+                    job.setdefault(key, value)
+        return jobs
+
+    def inventory(self, name: str) -> Dict | None:
+        """Hosts of a named inventory. Only the inventory version is read while the cached hosts are current
+
+        Args:
+            name (str): inventory name
+
+        Returns:
+            Dict | None: hostname to IP of the inventory or None if it was not found
+        """
+        current = self.__db.get_one('inventories', {'_id': name}, {'version': 1})
+        if current is None:
+            self.log.error(f'Inventory {name} not found')
+            return None
+        hosts = self.__cached(('inventory', name, current.get('version')))
+        if hosts is None:
+            inventory = self.__db.get_one('inventories', {'_id': name}, {'hosts': 1, 'version': 1})
+            if inventory is None:
+                self.log.error(f'Inventory {name} not found')
+                return None
+            hosts = inventory.get('hosts') or {}
+            self.__store(('inventory', name, inventory.get('version')), hosts)
+        return dict(hosts)
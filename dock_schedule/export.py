@@ -0,0 +1,105 @@
+import csv
+import json
+from datetime import datetime
+from typing import Dict, List
+
+
+EXPORT_FIELDS = ['_id', 'name', 'type', 'run', 'args', 'hostInventory', 'inventory', 'extraVars', 'timeout', 'mode',
+                 'cronId', 'cronVersion', 'state', 'result', 'scheduled', 'start', 'end', 'durationSeconds', 'workerId',
+                 'resendAttempt', 'parentId', 'shard', 'errors', 'tasks', 'usage']
+NESTED_FIELDS = ['args', 'hostInventory', 'extraVars', 'errors', 'tasks', 'usage']
+TIME_FIELDS = ['scheduled', 'start', 'end']
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def flatten_job(job: Dict) -> Dict:
+    """Flatten a job document into an EXPORT_FIELDS row. Nested fields are JSON encoded and the run time is added as
+    durationSeconds
+
+    Args:
+        job (Dict): job document
+
+    Returns:
+        Dict: export row
+    """
+    row = {field: job.get(field) for field in EXPORT_FIELDS}
+    if isinstance(row['start'], datetime) and isinstance(row['end'], datetime):
+        row['durationSeconds'] = (row['end'] - row['start']).total_seconds()
+    for field in NESTED_FIELDS:
+        if row[field] is not None:
+            row[field] = json.dumps(row[field], cls=DateTimeEncoder)
+    return row
+
+
+class NdjsonExport():
+    def __init__(self, path: str):
+        """One job document per line, every field of the job"""
+        self.__file = open(path, 'w')
+
+    def write(self, jobs: List[Dict]):
+        self.__file.writelines(json.dumps(job, cls=DateTimeEncoder) + '\n' for job in jobs)
+
+    def close(self):
+        self.__file.close()
+
+
+class CsvExport():
+    def __init__(self, path: str):
+        """One EXPORT_FIELDS row per job"""
+        self.__file = open(path, 'w', newline='')
+        self.__writer = csv.DictWriter(self.__file, EXPORT_FIELDS)
+        self.__writer.writeheader()
+
+    def write(self, jobs: List[Dict]):
+        for job in jobs:
+            row = flatten_job(job)
+            for field in TIME_FIELDS:
+                if isinstance(row[field], datetime):
+                    row[field] = row[field].isoformat()
+            self.__writer.writerow(row)
+
+    def close(self):
+        self.__file.close()
+
+
+class ParquetExport():
+    def __init__(self, path: str):
+        """One EXPORT_FIELDS row per job, every write is a row group. Requires pyarrow (pip install pyarrow)"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.__pa = pa
+        self.__schema = pa.schema([
+            ('_id', pa.string()), ('name', pa.string()), ('type', pa.string()), ('run', pa.string()),
+            ('args', pa.string()), ('hostInventory', pa.string()), ('inventory', pa.string()),
+            ('extraVars', pa.string()), ('timeout', pa.int64()), ('mode', pa.string()), ('cronId', pa.string()),
+            ('cronVersion', pa.string()), ('state', pa.string()), ('result', pa.bool_()),
+            ('scheduled', pa.timestamp('ms', tz='UTC')), ('start', pa.timestamp('ms', tz='UTC')),
+            ('end', pa.timestamp('ms', tz='UTC')),
+            ('durationSeconds', pa.float64()), ('workerId', pa.string()), ('resendAttempt', pa.int64()),
+            ('parentId', pa.string()), ('shard', pa.int64()), ('errors', pa.string()), ('tasks', pa.string()),
+            ('usage', pa.string())
+        ])
+        self.__writer = pq.ParquetWriter(path, self.__schema, compression='zstd')
+
+    def write(self, jobs: List[Dict]):
+        rows = []
+        for job in jobs:
+            row = flatten_job(job)
+            for field in TIME_FIELDS:
+                if not isinstance(row[field], datetime):
+                    row[field] = None
+            rows.append(row)
+        self.__writer.write_table(self.__pa.Table.from_pylist(rows, self.__schema))
+
+    def close(self):
+        self.__writer.close()
+
+
+EXPORT_FORMATS = {'ndjson': NdjsonExport, 'csv': CsvExport, 'parquet': ParquetExport}
@@ -1,6 +1,6 @@
 from json import dump
 from pathlib import Path
-from shutil import copytree, ignore_patterns
+from shutil import copy2, copytree, ignore_patterns
 from string import ascii_letters
 from random import choices, choice
 from logging import Logger
@@ -88,6 +88,11 @@ class Init(Utils):
         try:
             src = Path(__file__).parent / 'services/'
             copytree(src, '/opt/dock-schedule/', dirs_exist_ok=True, ignore=ignore_patterns('__init__.py'))
+            # The scheduler and worker images are built from their own directory and share the data-access and
+            # broker connection layers
+            for service in ['scheduler', 'worker']:
+                for module in ['dsdb.py', 'dsbroker.py']:
+                    copy2(Path(__file__).parent / module, f'/opt/dock-schedule/{service}/{module}')
             return True
         except Exception:
             self.log.exception('Failed to copy dock-schedule files')
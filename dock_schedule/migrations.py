@@ -0,0 +1,58 @@
+from pathlib import Path
+from logging import Logger
+from typing import List
+from datetime import datetime
+
+from dock_schedule.color import Color
+from dock_schedule.dsdb import SchemaMigrations
+from dock_schedule.utils import Utils, Mongo
+
+
+class Migrations(Utils):
+    def __init__(self, logger: Logger = None):
+        """Versioned index migrations. The definitions are shared with the scheduler, which applies them at startup
+
+        Args:
+            logger (Logger, optional): logger object. Defaults to None.
+        """
+        super().__init__(logger)
+        self.__db = Mongo(self.log)
+
+    @property
+    def __migrations_file(self) -> Path:
+        return Path(__file__).parent / 'services/scheduler/migrations.json'
+
+    @property
+    def __collections(self) -> List[str]:
+        return ['jobs', 'crons', 'host_slots', 'job_stats', 'job_failures', 'cron_versions',
+                'inventories']
+
+    def migrate(self) -> bool:
+        """Apply every migration not yet recorded in schema_migrations, in version order
+
+        Returns:
+            bool: True if the schema is at the latest version, otherwise False
+        """
+        if SchemaMigrations(self.__db, str(self.__migrations_file), self.log).migrate():
+            return self._display_success('Database schema is at the latest version')
+        return self._display_error('Failed to apply schema migrations')
+
+    def display_index_stats(self) -> bool:
+        """Display the $indexStats access count of every index since it was created or mongod last restarted. Indexes
+        with no accesses are shown in yellow as candidates to drop in a later migration
+
+        Returns:
+            bool: True if the stats were displayed, otherwise False
+        """
+        for collection in self.__collections:
+            stats = self.__db.aggregate(collection, [{'$indexStats': {}}, {'$sort': {'name': 1}}])
+            if stats is None:
+                return self._display_error(f'Failed to get index stats of {collection}')
+            self._display_info(f'{collection}:')
+            for index in stats:
+                ops = index.get('accesses', {}).get('ops', 0)
+                since = index.get('accesses', {}).get('since')
+                since = since.isoformat() if isinstance(since, datetime) else since
+                msg = f'  {index.get("name")}: {ops} ops since {since}'
+                Color().print_message(msg, 'yellow' if ops == 0 and index.get('name') != '_id_' else 'green')
+        return True
@@ -1,16 +1,19 @@
 import json
+import hashlib
 import requests
 from pathlib import Path
 from logging import Logger
 from typing import Dict, List
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from time import sleep
 
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING
 from pytz import all_timezones_set
 
 from dock_schedule.color import Color
+from dock_schedule.dsdb import JobPartitions, JobSpecs, duration_quantile, job_collection, summarize_job_stats
+from dock_schedule.export import DateTimeEncoder, EXPORT_FORMATS
 from dock_schedule.utils import Utils, Mongo
 
 
@@ -108,17 +111,12 @@ class WebClient():
         return self.__send_msg({'update': True}, '/job-update')
 
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
-
-
 class Schedule(Utils):
     def __init__(self, logger: Logger = None):
         super().__init__(logger)
         self.__db = Mongo(self.log)
+        self.__partitions = JobPartitions(self.__db, self.log)
+        self.__specs = JobSpecs(self.__db, self.log)
 
     def get_job_schedule(self) -> List[Dict] | None:
         return self.__db.get_all('crons')
@@ -129,16 +127,36 @@ class Schedule(Utils):
             return self._display_info('Job Schedule:\n' + json.dumps(schedule, indent=2))
         return False
 
-    def __check_job_run_file_exists(self, job_type: str, job_run: str) -> bool:
+    def __job_run_file(self, job_type: str, job_run: str) -> Path:
         if job_type == 'ansible':
-            job_file = f'/opt/dock-schedule/ansible/playbooks/{job_run}'
-        else:
-            job_file = f'/opt/dock-schedule/jobs/{job_type}/{job_run}'
-        if not Path(job_file).exists():
+            return Path(f'/opt/dock-schedule/ansible/playbooks/{job_run}')
+        return Path(f'/opt/dock-schedule/jobs/{job_type}/{job_run}')
+
+    def __check_job_run_file_exists(self, job_type: str, job_run: str) -> bool:
+        job_file = self.__job_run_file(job_type, job_run)
+        if not job_file.exists():
             self.log.error(f'Job run file does not exist: {job_file}')
             return False
         return True
 
+    def __set_job_run_hash(self, job: Dict) -> bool:
+        """Record the sha256 of the job run file on the job. Workers cache run files by this hash so an updated run
+        file is picked up once the cron is saved again
+
+        Args:
+            job (Dict): job or cron data with type and run set
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            run_file = self.__job_run_file(job.get('type'), job.get('run'))
+            job['runHash'] = hashlib.sha256(run_file.read_bytes()).hexdigest()
+            return True
+        except Exception:
+            self.log.exception(f'Failed to hash job run file: {job.get("run")}')
+        return False
+
     def __send_job_update_state(self):
         return WebClient(self.log).send_job_update_request()
 
@@ -146,7 +164,8 @@ class Schedule(Utils):
     def __schedule_keys(self):
         return {
             'name', 'type', 'run', 'args', 'frequency', 'interval',
-            'at', 'timezone', 'hostInventory', 'extraVars', 'disabled'
+            'at', 'timezone', 'hostInventory', 'extraVars', 'timeout', 'mode', 'shardSize', 'disabled', 'keepLast',
+            'keepFailedFor', 'keepSucceededFor', 'record'
         }
 
     def create_cron_job(self, job: Dict) -> bool:
@@ -171,10 +190,29 @@ class Schedule(Utils):
 
                 timezone (str): timezone to run the job (UTC, EST, PST, etc)
 
-                hostInventory (str): host inventory to run the job on (ansible inventory)
+                hostInventory (str): host inventory to run the job on (ansible inventory) or @name of a named
+                    inventory
 
                 extraVars (str): extra variables to pass to the job (ansible extra vars)
 
+                timeout (int): seconds the job can run before it is killed (no timeout if not set)
+
+                mode (str): how the worker runs the job (standard, warm). warm runs python3 jobs in a pre-forked
+                    interpreter on the worker
+
+                shardSize (int): split the host inventory into child jobs of this many hosts that run in parallel
+                    across the workers
+
+                keepLast (int): keep the results of the newest keepLast runs, older runs are trimmed unless their
+                    keep window below still covers them
+
+                keepFailedFor (int): hours to keep the results of failed runs
+
+                keepSucceededFor (int): hours to keep the results of successful runs
+
+                record (str): what a run records (full, summary). summary runs have no job document, only the
+                    job_stats rollups and the last failures in job_failures
+
                 disabled (bool): job is disabled and will not run until reenabled
 
         Returns:
@@ -182,6 +220,17 @@ class Schedule(Utils):
         """
         if not job.get('interval') and not job.get('at'):
             return self._display_error('Error: --interval (-i) or --at (-A) is required for job creation')
+        if not self.__validate_timeout(job.get('timeout')):
+            return False
+        if not self.__validate_mode(job.get('mode'), job.get('type'), job.get('hostInventory')):
+            return False
+        if not self.__validate_shard_size(job.get('shardSize')):
+            return False
+        if not self.__validate_record(job.get('record'), job.get('shardSize')):
+            return False
+        for key in ['keepLast', 'keepFailedFor', 'keepSucceededFor']:
+            if not self.__validate_retention(key, job.get(key)):
+                return False
         if self.__check_job_run_file_exists(job.get('type'), job.get('run')):
             if not self.__validate_timezone(job.get('timezone')):
                 return False
@@ -192,6 +241,8 @@ class Schedule(Utils):
             if job.get('type') == 'ansible':
                 if not self.__parse_ansible_job_data(job):
                     return False
+            if not self.__set_job_run_hash(job):
+                return False
             if self.__db.insert_one('crons', job):
                 self.log.info(f'Job {job.get("name")} created successfully')
                 return self.__send_job_update_state()
@@ -222,7 +273,12 @@ class Schedule(Utils):
         return data
 
     def __parse_ansible_job_data(self, job: Dict) -> bool:
-        if job.get('hostInventory'):
+        if isinstance(job.get('hostInventory'), str) and job['hostInventory'].startswith('@'):
+            if not self.__check_inventory_exists(job['hostInventory'][1:]):
+                return False
+            job['inventory'] = job['hostInventory'][1:]
+            job['hostInventory'] = {}
+        elif job.get('hostInventory'):
             data = self.__parse_key_value_data(job['hostInventory'])
             if not data:
                 return False
@@ -238,6 +294,56 @@ class Schedule(Utils):
             job['extraVars'] = {}
         return True
 
+    def __check_inventory_exists(self, name: str) -> bool:
+        if self.__db.get_one('inventories', {'_id': name}, {'_id': 1}) is None:
+            self.log.error(f'Inventory does not exist: {name}')
+            return False
+        return True
+
+    def set_inventory(self, name: str, hosts: str) -> bool:
+        """Create or replace a named host inventory. Crons reference it with "@name" as their host inventory and
+        their jobs run against its hosts as of when the job starts, the crons do not need to be updated
+
+        Args:
+            name (str): inventory name
+            hosts (str): "hostname1=ip1, hostname2=ip2" hosts of the inventory
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        data = self.__parse_key_value_data(hosts)
+        if not data:
+            return False
+        if self.__db.update_one('inventories', {'_id': name}, {
+            '$set': {'hosts': data, 'updated': datetime.now(timezone.utc)},
+            '$inc': {'version': 1}
+        }, upsert=True):
+            self.log.info(f'Inventory {name} saved with {len(data)} hosts')
+            return True
+        self.log.error(f'Failed to save inventory {name}')
+        return False
+
+    def delete_inventory(self, name: str) -> bool:
+        crons = self.__db.find('crons', {'inventory': name}, {'name': 1})
+        if crons is None:
+            return self._display_error(f'Failed to check the crons of inventory {name}')
+        if crons:
+            names = ', '.join(cron.get('name', '') for cron in crons)
+            return self._display_error(f'Inventory {name} is used by job crons: {names}')
+        if self.__db.delete_one('inventories', {'_id': name}):
+            self.log.info(f'Successfully deleted inventory {name}')
+            return True
+        self.log.error(f'Failed to delete inventory {name}')
+        return False
+
+    def display_inventories(self, name: str = None) -> bool:
+        inventories = self.__db.find('inventories', {'_id': name} if name else {}, sort=[('_id', 1)])
+        if inventories is None:
+            return self._display_error('Failed to get inventories')
+        if not inventories:
+            return self._display_info('No inventories found')
+        return self._display_info(f'Inventories:\n{json.dumps(inventories, indent=2, cls=DateTimeEncoder)}')
+
     def __validate_job_at_time(self, freq: str, at: str) -> bool:
         if freq == 'second':
             self.log.error('Frequency cannot be set to "second" when using "at"')
@@ -269,6 +375,47 @@ class Schedule(Utils):
             self.log.error('Invalid frequency, must be one of: second, minute, hour, day')
         return False
 
+    def __validate_timeout(self, timeout: int | None) -> bool:
+        if timeout is None or timeout > 0:
+            return True
+        self.log.error(f'Invalid timeout value: {timeout}, must be a positive number of seconds')
+        return False
+
+    def __validate_shard_size(self, shard_size: int | None) -> bool:
+        if shard_size is None or shard_size > 0:
+            return True
+        self.log.error(f'Invalid shard size: {shard_size}, must be a positive number of hosts')
+        return False
+
+    def __validate_retention(self, key: str, value: int | None) -> bool:
+        if value is None or value > 0:
+            return True
+        unit = 'runs' if key == 'keepLast' else 'hours'
+        self.log.error(f'Invalid {key} value: {value}, must be a positive number of {unit}')
+        return False
+
+    def __validate_record(self, record: str | None, shard_size: int | None) -> bool:
+        if record in [None, 'full']:
+            return True
+        if record != 'summary':
+            self.log.error(f'Invalid record: {record}, must be one of: full, summary')
+        elif shard_size:
+            self.log.error('Summary record is not supported for sharded jobs, shards report to a parent job document')
+        else:
+            return True
+        return False
+
+    def __validate_mode(self, mode: str | None, job_type: str | None, host_inventory: Dict | None) -> bool:
+        if mode in [None, 'standard']:
+            return True
+        if mode != 'warm':
+            self.log.error(f'Invalid mode: {mode}, must be one of: standard, warm')
+        elif job_type != 'python3' or host_inventory:
+            self.log.error('Warm mode is only supported for python3 jobs that run on the worker (no host inventory)')
+        else:
+            return True
+        return False
+
     def __validate_timezone(self, timezone: str) -> bool:
         if timezone in all_timezones_set:
             return True
@@ -313,7 +460,14 @@ class Schedule(Utils):
                 if key not in self.__schedule_keys:
                     self.log.error(f'Invalid key: {key}')
                     return False
-                if key in ['hostInventory', 'extraVars']:
+                if key == 'hostInventory' and value.startswith('@'):
+                    if not self.__check_inventory_exists(value[1:]):
+                        return False
+                    data['inventory'] = value[1:]
+                    value = {}
+                elif key in ['hostInventory', 'extraVars']:
+                    if key == 'hostInventory':
+                        data['inventory'] = None
                     value = self.__parse_key_value_data(value)
                     if not value:
                         self.log.error(f'Failed to parse {key} data')
@@ -329,13 +483,24 @@ class Schedule(Utils):
                         value = None
                     elif not self.__validate_job_at_time(update.get('frequency') or job.get('frequency'), value):
                         return False
-                elif key == 'interval':
+                elif key in ['interval', 'timeout', 'shardSize', 'keepLast', 'keepFailedFor', 'keepSucceededFor']:
                     if value.isdigit():
                         value = int(value)
                     elif value.lower() == 'none':
                         value = None
                     else:
-                        self.log.error(f'Invalid interval value: {value}')
+                        self.log.error(f'Invalid {key} value: {value}')
+                        return False
+                    if key == 'timeout' and not self.__validate_timeout(value):
+                        return False
+                    if key == 'shardSize' and not self.__validate_shard_size(value):
+                        return False
+                    if key.startswith('keep') and not self.__validate_retention(key, value):
+                        return False
+                elif key == 'mode':
+                    inventory = update.get('hostInventory') or job.get('hostInventory') or job.get('inventory')
+                    if not self.__validate_mode(value, update.get('type') or job.get('type'),
+                                                inventory if inventory != 'None' else None):
                         return False
                 elif key == 'args':
                     if value[0] == 'NONE':
@@ -347,6 +512,10 @@ class Schedule(Utils):
                         return False
                 data[key] = value
         job.update(data)
+        if not self.__validate_record(job.get('record'), job.get('shardSize')):
+            return False
+        if not self.__set_job_run_hash(job):
+            return False
         if self.__db.update_one('crons', {'_id': job_id}, {'$set': job}):
             self.log.info(f'Successfully updated job ID {job_id}')
             return self.__send_job_update_state()
@@ -405,7 +574,7 @@ class Schedule(Utils):
     def __wait_for_job_completion(self, job_id: str, max_wait: int = 1800) -> bool:
         try:
             while max_wait > 0:
-                result = self.__db.get_one('jobs', {'_id': job_id}, {'result': 1, 'errors': 1})
+                result = self.__db.get_one(job_collection(job_id), {'_id': job_id}, {'result': 1, 'errors': 1})
                 if result and result.get('result') is not None:
                     if result['result'] is True:
                         self.log.info('Job completed successfully')
@@ -427,12 +596,26 @@ class Schedule(Utils):
             return False
 
     def run_predefined_job(self, job_id: str, args: List[str] = None, host_inventory: Dict = None,
-                           extra_vars: Dict = None, wait: bool = False) -> bool:
+                           extra_vars: Dict = None, wait: bool = False, timeout: int = None,
+                           mode: str = None, shard_size: int = None) -> bool:
         job = self.get_job_by_id(job_id)
         if job:
+            if shard_size is not None:
+                if not self.__validate_shard_size(shard_size):
+                    return False
+                job['shardSize'] = shard_size
+            if timeout is not None:
+                if not self.__validate_timeout(timeout):
+                    return False
+                job['timeout'] = timeout
+            if mode is not None:
+                if not self.__validate_mode(mode, job.get('type'), job.get('hostInventory')):
+                    return False
+                job['mode'] = mode
             if job.get('type') == 'ansible':
                 if host_inventory:
                     job['hostInventory'] = host_inventory if host_inventory != 'None' else None
+                    job.pop('inventory', None)
                 if extra_vars:
                     job['extraVars'] = extra_vars if extra_vars != 'None' else None
                 if not self.__parse_ansible_job_data(job):
@@ -444,7 +627,9 @@ class Schedule(Utils):
         return False
 
     def __create_manual_job(self, job: Dict, wait: bool = False) -> bool:
-        job['_id'] = str(uuid4())
+        job['_id'] = self.__partitions.new_job_id(datetime.now(timezone.utc))
+        if not self.__set_job_run_hash(job):
+            return False
         if WebClient(self.log).send_run_job_request(job):
             self.log.info(f'Successfully sent job {job["_id"]} "{job.get("name")}" to scheduler')
             if wait:
@@ -456,6 +641,12 @@ class Schedule(Utils):
     def run_job(self, job: Dict):
         if job.get('name', '') in ['GENERATE', '', None]:
             job['name'] = f'manual-{job.get("type")}-{job.get("run")}'
+        if not self.__validate_timeout(job.get('timeout')):
+            return False
+        if not self.__validate_mode(job.get('mode'), job.get('type'), job.get('hostInventory')):
+            return False
+        if not self.__validate_shard_size(job.get('shardSize')):
+            return False
         if self.__check_job_run_file_exists(job.get('type'), job.get('run')):
             if job.get('type') == 'ansible':
                 if not self.__parse_ansible_job_data(job):
@@ -463,14 +654,66 @@ class Schedule(Utils):
             return self.__create_manual_job(job, job.get('wait', False))
         return False
 
-    def get_jobs_by_filter(self, _filter: Dict, limit: int = 10) -> List[Dict] | None:
-        if not _filter:
-            cursor = self.__db.get_all_with_cursor('jobs')
+    @property
+    def __result_projection(self) -> Dict:
+        return {'name': 1, 'state': 1, 'result': 1, 'start': 1, 'end': 1, 'errors': 1, 'scheduled': 1}
+
+    def get_jobs_by_filter(self, _filter: Dict, limit: int = 10, projection: Dict = None, after: tuple = None,
+                           before: tuple = None) -> List[Dict] | None:
+        """Get jobs newest first, paged on (scheduled, _id) so a page deep into history costs the same as the first
+
+        Args:
+            _filter (Dict): job filter
+            limit (int, optional): max jobs to return. Defaults to 10.
+            projection (Dict, optional): fields to return. Defaults to the whole job.
+            after (tuple, optional): (scheduled, _id) of a job, return the jobs older than it. Defaults to None.
+            before (tuple, optional): (scheduled, _id) of a job, return the jobs newer than it. Defaults to None.
+
+        Returns:
+            List[Dict] | None: jobs or None if the query failed
+        """
+        query, direction, operator = dict(_filter), DESCENDING, '$lt'
+        if before:
+            direction, operator = ASCENDING, '$gt'
+        key = after or before
+        if key:
+            keyset = {'$or': [{'scheduled': {operator: key[0]}}, {'scheduled': key[0], '_id': {operator: key[1]}}]}
+            query = {'$and': [query, keyset]} if query else keyset
+        if isinstance(_filter.get('_id'), str):
+            collections = [job_collection(_filter['_id'])]
         else:
-            cursor = self.__db.get_all_with_cursor('jobs', _filter)
-        if cursor:
-            return list(cursor.sort('scheduled', DESCENDING).limit(limit))
-        return []
+            collections = self.__job_collections(_filter, after, before)
+            if collections is None:
+                return None
+        jobs = []
+        for collection in collections:
+            found = self.__db.find(collection, query, projection, [('scheduled', direction), ('_id', direction)],
+                                   limit - len(jobs) if limit else 0)
+            if found is None:
+                return None
+            jobs.extend(found)
+            if limit and len(jobs) >= limit:
+                break
+        if before:
+            jobs.reverse()
+        return jobs
+
+    def __job_collections(self, _filter: Dict, after: tuple = None, before: tuple = None) -> List[str] | None:
+        """Job collections that can hold the jobs of a query, in the order their jobs sort newest first or oldest
+        first when reading forward from a before page key. Only the daily partitions within the scheduled range of
+        the query and the page key are read
+        """
+        scheduled = _filter.get('scheduled') if isinstance(_filter.get('scheduled'), dict) else {}
+        since, until = scheduled.get('$gte'), scheduled.get('$lt')
+        if after:
+            until = min(until, after[0]) if until else after[0]
+        if before:
+            since = max(since, before[0]) if since else before[0]
+        collections = self.__partitions.collections(since, until)
+        if collections is None:
+            self.log.error('Failed to list job partitions')
+            return None
+        return collections[::-1] if before else collections
 
     def __determine_result_color(self, result: bool) -> str:
         if result is True:
@@ -524,21 +767,86 @@ class Schedule(Utils):
             _filters['result'] = False
         elif _filter == 'scheduled':
             _filters['state'] = 'pending'
+        elif _filter == 'timeout':
+            _filters['state'] = 'timed_out'
         else:
             self.log.error(f'Invalid filter: {_filter}')
 
+    def __parse_time(self, value: str) -> datetime | None:
+        """Parse an ISO 8601 time given on the command line. A time without a UTC offset is taken as UTC"""
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            self.log.error(f'Invalid time, expected ISO 8601 such as 2025-04-28T18:00:00: {value}')
+            return None
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    def __determine_time_filter(self, since: str | None, until: str | None, _filters: Dict) -> bool:
+        scheduled = {}
+        for operator, value in [('$gte', since), ('$lt', until)]:
+            if value:
+                parsed = self.__parse_time(value)
+                if parsed is None:
+                    return False
+                scheduled[operator] = parsed
+        if scheduled:
+            _filters['scheduled'] = scheduled
+        return True
+
+    def __build_result_filter(self, job_name: str | None, _filter: str | None, since: str | None,
+                              until: str | None) -> Dict | None:
+        _filters = {}
+        if job_name:
+            _filters['name'] = job_name
+        if _filter:
+            self.__determine_result_filter(_filter, _filters)
+        if not self.__determine_time_filter(since, until, _filters):
+            return None
+        return _filters
+
+    def __parse_page_key(self, value: str) -> tuple | None:
+        """Parse a page key printed under the results, <scheduled>|<job id>"""
+        scheduled, _, job_id = value.rpartition('|')
+        if not scheduled or not job_id:
+            self.log.error(f'Invalid page key, expected <scheduled>|<job id>: {value}')
+            return None
+        parsed = self.__parse_time(scheduled)
+        if parsed is None:
+            return None
+        return parsed, job_id
+
+    def __page_key(self, job: Dict) -> str:
+        scheduled = job.get('scheduled')
+        if isinstance(scheduled, datetime):
+            scheduled = scheduled.isoformat()
+        return f'{scheduled}|{job.get("_id")}'
+
     def display_results(self, job_id: str = None, job_name: str = None, _filter: str = None, limit: int = 10,
-                        verbose: bool = False) -> bool:
+                        verbose: bool = False, since: str = None, until: str = None, after: str = None,
+                        before: str = None) -> bool:
+        # Without verbose only the summary fields are fetched, not the task output of every job
+        projection = None if verbose else self.__result_projection
         if job_id:
-            results = self.get_jobs_by_filter({'_id': job_id}, 1)
+            results = self.get_jobs_by_filter({'_id': job_id}, 1, projection)
         else:
-            _filters = {}
-            if job_name:
-                _filters['name'] = job_name
-            if _filter:
-                self.__determine_result_filter(_filter, _filters)
-            results = self.get_jobs_by_filter(_filters, limit)
+            _filters = self.__build_result_filter(job_name, _filter, since, until)
+            if _filters is None:
+                return False
+            if after and before:
+                return self._display_error('Use either --after or --before, not both')
+            keys = {}
+            for name, value in [('after', after), ('before', before)]:
+                if value:
+                    keys[name] = self.__parse_page_key(value)
+                    if keys[name] is None:
+                        return False
+            results = self.get_jobs_by_filter(_filters, limit, projection, **keys)
+        if results is None:
+            return self._display_error('Failed to get job results')
         if verbose:
+            self.__specs.join_cron_versions(results)
             return self._display_info(f'Job Results:\n{json.dumps(results, indent=2, cls=DateTimeEncoder)}')
         for r in results:
             color = self.__determine_result_color(r.get('result'))
@@ -552,4 +860,132 @@ class Schedule(Utils):
                 for error in errors:
                     msg += f'\n  {error}'
             Color().print_message(msg + '\n', color)
+        if results and not job_id:
+            self._display_info(f'Newer: --before "{self.__page_key(results[0])}"  '
+                               f'Older: --after "{self.__page_key(results[-1])}"')
+        return True
+
+    def display_job_stats(self, job_name: str = None, since: str = None, until: str = None) -> bool:
+        """Display run counts, failure rate and run time quantiles per job name from the hourly job_stats rollups,
+        which are kept longer than the jobs themselves
+
+        Args:
+            job_name (str, optional): only this job name. Defaults to every job.
+            since (str, optional): ISO 8601 time to start from. Defaults to 7 days ago.
+            until (str, optional): ISO 8601 time to end at. Defaults to now.
+
+        Returns:
+            bool: True if the stats were displayed, otherwise False
+        """
+        hour = {'$gte': datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=7)}
+        for operator, value in [('$gte', since), ('$lt', until)]:
+            if value:
+                hour[operator] = self.__parse_time(value)
+                if hour[operator] is None:
+                    return False
+        _filters = {'hour': hour}
+        if job_name:
+            _filters['name'] = job_name
+        rollups = self.__db.find('job_stats', _filters, {
+            'name': 1, 'runs': 1, 'failures': 1, 'timedOut': 1, 'durationSeconds': 1, 'maxDurationSeconds': 1,
+            'durationSketch': 1
+        })
+        if rollups is None:
+            return self._display_error('Failed to get job stats')
+        summary = summarize_job_stats(rollups)
+        if not summary:
+            return self._display_info('No job runs in the time range')
+        for name, stats in sorted(summary.items()):
+            runs, failures = stats['runs'], stats['failures']
+            msg = f'Name: {name}, Runs: {runs}, Failures: {failures} ({failures / runs * 100 if runs else 0:.1f}%), '
+            msg += f'Timed Out: {stats["timedOut"]}, Avg: {self.__seconds_to_units(stats["durationSeconds"] / runs)}'
+            for quantile in [0.5, 0.95, 0.99]:
+                value = duration_quantile(stats['durationSketch'], quantile)
+                msg += f', P{int(quantile * 100)}: {"N/A" if value is None else self.__seconds_to_units(value)}'
+            msg += f', Max: {self.__seconds_to_units(stats["maxDurationSeconds"])}'
+            Color().print_message(msg + '\n', 'red' if failures else 'green')
+        return True
+
+    def display_job_failures(self, job_name: str = None) -> bool:
+        """Display the last failures of summary record jobs kept in job_failures
+
+        Args:
+            job_name (str, optional): only this job name. Defaults to every job.
+
+        Returns:
+            bool: True if the failures were displayed, otherwise False
+        """
+        buffers = self.__db.find('job_failures', {'_id': job_name} if job_name else {}, {'failures': 1},
+                                 [('_id', 1)])
+        if buffers is None:
+            return self._display_error('Failed to get job failures')
+        if not buffers:
+            return self._display_info('No summary job failures recorded')
+        for buffer in buffers:
+            self._display_info(f'{buffer["_id"]}:')
+            for failure in reversed(buffer.get('failures', [])):
+                msg = f'  ID: {failure.get("jobId")}, State: {failure.get("state")}, '
+                msg += f'Scheduled: {failure["scheduled"].isoformat()}, Worker: {failure.get("workerId")}'
+                for error in failure.get('errors', []):
+                    msg += f'\n    {error}'
+                for line in failure.get('output', [])[-10:]:
+                    msg += f'\n    | {line}'
+                Color().print_message(msg + '\n', 'red')
         return True
+
+    def __seconds_to_units(self, seconds: float) -> str:
+        return self.__convert_timedelta_to_units(timedelta(seconds=seconds))
+
+    def export_results(self, path: str, _format: str = 'ndjson', job_name: str = None, _filter: str = None,
+                       since: str = None, until: str = None, batch_size: int = 5000) -> bool:
+        """Stream the matching jobs, oldest first, from a MongoDB cursor to a file in batches so memory use does not
+        grow with the number of jobs exported
+
+        Args:
+            path (str): file to write
+            _format (str, optional): ndjson, csv or parquet. Defaults to 'ndjson'.
+            job_name (str, optional): job name filter. Defaults to None.
+            _filter (str, optional): result filter (success, failed, scheduled, timeout). Defaults to None.
+            since (str, optional): ISO 8601 time, only jobs scheduled at or after it. Defaults to None.
+            until (str, optional): ISO 8601 time, only jobs scheduled before it. Defaults to None.
+            batch_size (int, optional): jobs per write and per parquet row group. Defaults to 5000.
+
+        Returns:
+            bool: True if every job was exported, otherwise False
+        """
+        _filters = self.__build_result_filter(job_name, _filter, since, until)
+        if _filters is None:
+            return False
+        try:
+            writer = EXPORT_FORMATS[_format](path)
+        except ImportError:
+            return self._display_error(f'Exporting {_format} requires pyarrow (pip install pyarrow)')
+        except Exception:
+            self.log.exception(f'Failed to open export file {path}')
+            return self._display_error(f'Failed to open export file {path}')
+        exported = 0
+        try:
+            collections = self.__job_collections(_filters)
+            if collections is None:
+                return self._display_error('Failed to query job results')
+            batch = []
+            # Oldest first, the partitions hold consecutive days
+            for collection in reversed(collections):
+                cursor = self.__db.get_all_with_cursor(collection, _filters)
+                if cursor is None:
+                    return self._display_error('Failed to query job results')
+                for job in cursor.sort([('scheduled', ASCENDING), ('_id', ASCENDING)]).batch_size(batch_size):
+                    batch.append(job)
+                    if len(batch) == batch_size:
+                        writer.write(self.__specs.join_cron_versions(batch))
+                        exported += len(batch)
+                        batch = []
+            if batch:
+                writer.write(self.__specs.join_cron_versions(batch))
+                exported += len(batch)
+        except Exception:
+            self.log.exception(f'Failed to export job results to {path}')
+            return self._display_error(f'Failed to export job results to {path} after {exported} jobs')
+        finally:
+            writer.close()
+        return self._display_success(f'Exported {exported} jobs to {path}')
@@ -1,32 +1,36 @@
 #!/usr/bin/env python3
 
 import ssl
+import asyncio
 import logging
 from time import sleep, gmtime
-from threading import Thread, Event, local
+from threading import Event, Lock, local
 from multiprocessing import Process, Queue
 from queue import Empty
 from uuid import uuid4
-from json import loads
+from json import dumps, loads
 from typing import Dict
-from urllib.parse import quote_plus
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
 import schedule
 import uvicorn
 from fastapi import FastAPI, Request, Response
-from pika import SelectConnection, BaseConnection, BasicProperties
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.credentials import PlainCredentials
+from pika import BasicProperties
 from pika.channel import Channel
-from pika.connection import ConnectionParameters, SSLOptions
+from pika.frame import Method
 from pika.spec import Basic
-from pymongo import MongoClient, DESCENDING
-from pymongo.errors import ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
+from pymongo import DESCENDING
+
+from dsbroker import BrokerConnection
+from dsdb import (CRON_SPEC_KEYS, JOB_PARTITIONING, JOB_RETENTION_DAYS, JobPartitions, JobSpecs, Mongo,
+                  SchemaMigrations, db_latency, duration_quantile, job_collection, record_job_stats, sibling_job_id,
+                  summarize_job_stats)
 
 
 thread_local = local()
+RETENTION_KEYS = ['keepLast', 'keepFailedFor', 'keepSucceededFor']
 
 
 def get_logger():
@@ -42,182 +46,9 @@ def get_logger():
     return log
 
 
-class Mongo():
-    def __init__(self, client_id: str = None, logger: logging.Logger = None):
-        self.log = logger
-        self.__id = client_id or str(uuid4())[:8]
-        self.__client: MongoClient | None = None
-        self.__creds = {'user': '', 'passwd': '', 'db': ''}
-
-    @property
-    def __host(self):
-        return "mongodb://%s:%s@mongodb:27017/" % (quote_plus(self.__creds.get('user')),
-                                                   quote_plus(self.__creds.get('passwd')))
-
-    @property
-    def client(self):
-        if self.__client is None:
-            if self.__load_creds():
-                for attempt in range(36):
-                    try:
-                        self.__client = MongoClient(
-                            host=self.__host,
-                            tls=True,
-                            tlsCAFile='/app/ca.crt',
-                            tlsCertificateKeyFile='/app/host.pem',
-                            serverSelectionTimeoutMS=2000
-                        )
-                        self.__client.admin.command('ping')
-                        self.log.info(f'[{self.__id}] MongoDB client created successfully')
-                        return self.__client
-                    except ServerSelectionTimeoutError:
-                        self.log.error(f'[{self.__id}] Failed to connect to MongoDB {attempt + 1}/35')
-                    except ConnectionFailure:
-                        self.log.exception(f'[{self.__id}] Failed to connect to MongoDB')
-                    except Exception:
-                        self.log.exception(f'[{self.__id}] Failed to create MongoDB client')
-                        return None
-                    sleep(2)
-        return self.__client
-
-    def __load_creds(self):
-        for key in self.__creds.keys():
-            try:
-                with open(f'/run/secrets/mongo_{key}', 'r') as f:
-                    self.__creds[key] = f.read().strip()
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to load mongodb credentials for {key}')
-                return False
-        return True
-
-    def __get_db(self):
-        if self.client:
-            try:
-                return self.client[self.__creds.get('db')]
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to get database object')
-        return None
-
-    def __get_collection(self, collection_name: str = 'jobs'):
-        db = self.__get_db()
-        if db is not None:
-            try:
-                return db[collection_name]
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to get collection: {collection_name}')
-        return None
-
-    def insert_one(self, collection_name: str, document: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.insert_one(document)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] failed to insert document: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to insert document: {document}')
-        return None
-
-    def insert_many(self, collection_name: str, documents: list[dict]):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.insert_many(documents)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to insert documents: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to insert documents: {documents}')
-        return None
-
-    def get_one(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.find_one(*filters)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to find data')
-        return None
-
-    def get_all(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return list(collection.find(*filters))
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to query collection')
-        return []
-
-    def get_all_with_cursor(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.find(*filters)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to query collection')
-        return None
-
-    def update_one(self, collection_name: str, query: dict, update: dict, upsert: bool = False):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.update_one(query, update, upsert=upsert)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to update data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to update document: {query}')
-        return None
-
-    def update_many(self, collection_name: str, query: dict, update: dict, upsert: bool = False):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.update_many(query, update, upsert=upsert)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to update data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to update documents: {query}')
-        return None
-
-    def delete_one(self, collection_name: str, query: dict) -> bool:
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                collection.delete_one(query)
-                return True
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to delete data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to delete document: {query}')
-        return False
-
-    def delete_many(self, collection_name: str, query: dict) -> bool:
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                collection.delete_many(query)
-                return True
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to delete data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to delete documents: {query}')
-        return False
-
-    def count_documents(self, collection_name: str, query: Dict) -> int:
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.count_documents(query, maxTimeMS=2000)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to count documents: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to count documents')
-        return 0
+def utc_now() -> datetime:
+    """Naive UTC datetime, the form pymongo stores and returns, so it compares directly with values read back"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class WebServer():
@@ -225,6 +56,7 @@ class WebServer():
         self.log = logger
         self._app = FastAPI()
         self.__db: Mongo | None = None
+        self.__partitions: JobPartitions | None = None
         self.__msg_queue = queue
         self.__process: Process | None = None
 
@@ -241,14 +73,30 @@ class WebServer():
         def metrics_route() -> Response:
             if self.__db is None:
                 self.__db = Mongo('web-server', self.log)
+                self.__partitions = JobPartitions(self.__db, self.log, JOB_PARTITIONING)
             try:
-                total_jobs = self.__db.count_documents('jobs', {})
-                pending_jobs = self.__db.count_documents('jobs', {'state': 'pending'})
-                running_jobs = self.__db.count_documents('jobs', {'state': 'running'})
-                successful_jobs = self.__db.count_documents('jobs', {'state': 'completed', 'result': True})
-                failed_jobs = self.__db.count_documents('jobs', {'state': 'completed', 'result': False})
-                total_crons = self.__db.count_documents('crons', {})
-                total_crons_enabled = self.__db.count_documents('crons', {'disabled': False})
+                collections = self.__partitions.collections() or ['jobs']
+                total_jobs = self.__count_jobs(collections, {})
+                pending_jobs = self.__count_jobs(collections, {'state': 'pending'})
+                running_jobs = self.__count_jobs(collections, {'state': 'running'})
+                # Run counts come from the hourly job_stats rollups, which outlive the job documents
+                totals = self.__db.aggregate('job_stats', [
+                    {'$group': {'_id': None, 'runs': {'$sum': '$runs'}, 'failures': {'$sum': '$failures'}}}
+                ], 2000) or [{'runs': 0, 'failures': 0}]
+                successful_jobs = totals[0]['runs'] - totals[0]['failures']
+                failed_jobs = totals[0]['failures']
+                recent = summarize_job_stats(self.__db.get_all(
+                    'job_stats', {'hour': {'$gte': utc_now() - timedelta(hours=24)}},
+                    {'name': 1, 'runs': 1, 'failures': 1, 'durationSketch': 1}, max_time_ms=2000))
+                timed_out_jobs = {}
+                for collection in collections:
+                    for timed_out in self.__db.aggregate(collection, [
+                        {'$match': {'state': 'timed_out'}},
+                        {'$group': {'_id': '$name', 'count': {'$sum': 1}}}
+                    ], 2000) or []:
+                        timed_out_jobs[timed_out['_id']] = timed_out_jobs.get(timed_out['_id'], 0) + timed_out['count']
+                total_crons = self.__db.count_documents('crons', {}, 2000)
+                total_crons_enabled = self.__db.count_documents('crons', {'disabled': False}, 2000)
                 output = [
                     "# HELP scheduler_jobs_total Total number of jobs submitted",
                     "# TYPE scheduler_jobs_total counter",
@@ -262,11 +110,12 @@ class WebServer():
                     "# TYPE scheduler_jobs_running gauge",
                     f"scheduler_jobs_running {running_jobs}",
 
-                    "# HELP scheduler_jobs_successful_total Total number of successful jobs run",
+                    "# HELP scheduler_jobs_successful_total Total number of successful jobs run in the job stats "
+                    "retention",
                     "# TYPE scheduler_jobs_successful_total counter",
                     f"scheduler_jobs_successful_total {successful_jobs}",
 
-                    "# HELP scheduler_jobs_failed_total Total number of failed jobs run",
+                    "# HELP scheduler_jobs_failed_total Total number of failed jobs run in the job stats retention",
                     "# TYPE scheduler_jobs_failed_total counter",
                     f"scheduler_jobs_failed_total {failed_jobs}",
 
@@ -277,7 +126,30 @@ class WebServer():
                     "# HELP scheduler_crons_enabled_total Total number of enabled crons",
                     "# TYPE scheduler_crons_enabled_total counter",
                     f"scheduler_crons_enabled_total {total_crons_enabled}",
+
+                    "# HELP scheduler_jobs_timed_out_total Total number of jobs killed by their timeout per job name",
+                    "# TYPE scheduler_jobs_timed_out_total counter",
                 ]
+                for name, count in timed_out_jobs.items():
+                    output.append(f'scheduler_jobs_timed_out_total{{name="{self.__label_value(name)}"}} {count}')
+                output.extend([
+                    '# HELP scheduler_job_runs_24h Runs per job name over the last 24 hours',
+                    '# TYPE scheduler_job_runs_24h gauge',
+                    '# HELP scheduler_job_failures_24h Failed runs per job name over the last 24 hours',
+                    '# TYPE scheduler_job_failures_24h gauge',
+                    '# HELP scheduler_job_duration_seconds_24h Run time quantiles per job name over the last 24 hours',
+                    '# TYPE scheduler_job_duration_seconds_24h gauge',
+                ])
+                for name, stats in sorted(recent.items()):
+                    label = f'name="{self.__label_value(name)}"'
+                    output.append(f'scheduler_job_runs_24h{{{label}}} {stats["runs"]}')
+                    output.append(f'scheduler_job_failures_24h{{{label}}} {stats["failures"]}')
+                    for quantile in [0.5, 0.95, 0.99]:
+                        value = duration_quantile(stats['durationSketch'], quantile)
+                        if value is not None:
+                            output.append(
+                                f'scheduler_job_duration_seconds_24h{{{label},quantile="{quantile}"}} {value:.3f}')
+                output.extend(db_latency.render('scheduler_db_latency_seconds'))
                 return Response('\n'.join(output), 200, media_type='text/plain')
             except Exception:
                 self.log.exception('Failed to get metrics')
@@ -341,6 +213,12 @@ class WebServer():
             del raw_msg
             return Response(*state)
 
+    def __count_jobs(self, collections: list[str], query: Dict) -> int:
+        return sum(self.__db.count_documents(collection, query, 2000) for collection in collections)
+
+    def __label_value(self, value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
     @property
     def __certs(self):
         return {
@@ -400,316 +278,158 @@ class WebServer():
         return True
 
 
-class JobPublisher():
+class JobPublisher(BrokerConnection):
     def __init__(self, pub_id: str, logger: logging.Logger = None):
-        self.log = logger or get_logger()
-        self.__id = pub_id
-        self.__route = 'job-queue'
-        self.__exchange = 'dock-schedule'
-        self.__thread: Thread | None = None
-        self.__client: SelectConnection | None = None
-        self.__channel: BlockingChannel | None = None
-        self.__connect_attempt = 0
-        self.__max_connect_attempts = 36
-        self.__reconnecting = False
-        self.__exchange_declared = False
-        self.__conn_blocked = False
-        self.__queue_declared = False
-
-    @property
-    def client_exists(self):
-        if self.__client and self.__client.is_open:
-            if self.__channel:
-                if self.__channel.is_open:
-                    return True
-                return self.__wait_for_channel_open()
-            self.log.error(f'[{self.__id}] Broker connection channel is closed')
-        else:
-            self.log.error(f'[{self.__id}] Broker connection is closed')
-        return False
-
-    def __wait_for_channel_open(self):
-        cnt = 0
-        if self.__channel is not None:
-            while not self.__channel.is_open:
-                cnt += 1
-                if cnt > 100:
-                    self.log.error(f'[{self.__id}] Failed to open channel')
-                    return False
-                sleep(.2)
-            self.log.debug(f'[{self.__id}] Channel is open')
-            return True
-        self.log.error(f'[{self.__id}] Channel does not exist')
-        return False
-
-    def __wait_for_exchange_declare(self):
-        while not self.__exchange_declared:
-            if self.__connect_attempt == self.__max_connect_attempts:
-                self.log.error(f'[{self.__id}] Failed to declare exchange')
-                return False
-            sleep(.2)
-        self.log.debug(f'[{self.__id}] Exchange declared')
-        return True
-
-    def __wait_for_conn_unblock(self, timeout: int = 180):
-        self.__conn_blocked = True
-        cnt = 0
-        while self.__conn_blocked:
-            sleep(1)
-            cnt += 1
-            if cnt > timeout:
-                self.log.error(f'[{self.__id}] Timeout waiting for connection unblock')
-                return False
-        return True
-
-    def __conn_unblocked(self):
-        self.__conn_blocked = False
-
-    def __load_credentials(self):
-        creds = {'user': '', 'passwd': '', 'vhost': ''}
-        for key in creds.keys():
-            try:
-                with open(f'/run/secrets/broker_{key}', 'r') as f:
-                    creds[key] = f.read().strip()
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to load broker credentials for {key}')
-        return creds
-
-    def __create_connection_ssl_obj(self):
+        super().__init__(pub_id, logger or get_logger())
+        self.__confirms: Dict[int, asyncio.Future] = {}
+        self.__delivery_tag = 0
+        self.__confirm_timeout = 30
+        self.__unblocked = asyncio.Event()
+        self.__unblocked.set()
+        self.__unblock_timeout = 180
+        self.__returned: deque = deque()
+        self.__return_timer: asyncio.TimerHandle | None = None
+        self.__max_return_attempts = 10
+
+    def _on_blocked(self):
+        self.log.info(f'[{self._id}] Connection blocked, publishing paused until the broker unblocks it')
+        self.__unblocked.clear()
+
+    def _on_unblocked(self):
+        self.log.info(f'[{self._id}] Connection unblocked, resuming publishing')
+        self.__unblocked.set()
+
+    def _on_connection_closed(self):
+        self.__fail_pending_confirms()
+        # pika closes a connection that stays blocked, the publish waiting on the unblock moves on to the reconnect
+        self.__unblocked.set()
+
+    def __fail_pending_confirms(self):
+        for confirm in self.__confirms.values():
+            self._resolve(confirm, False)
+        self.__confirms.clear()
+
+    def _open_channel(self, channel: Channel):
+        self.__delivery_tag = 0
         try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.load_verify_locations('/app/ca.crt')
-            context.load_cert_chain('/app/host.crt', '/app/host.key')
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.check_hostname = True
-            return SSLOptions(context, 'broker')
+            channel.add_on_close_callback(self.__channel_closed)
+            channel.add_on_return_callback(self.__returned_to_sender_handler)
+            channel.exchange_declare(self._exchange, 'direct')
+            channel.confirm_delivery(ack_nack_callback=self.__ack_nack_handler)
+            # Channel RPCs run in order so the declare callback fires once the exchange and confirms are set
+            channel.queue_declare(self._route, durable=True, callback=self.__queue_declared)
         except Exception:
-            self.log.exception(f'[{self.__id}] Failed to create SSL context for broker connection')
-        return None
-
-    def __create_connection_parameters(self):
-        creds: dict = self.__load_credentials()
-        if creds:
-            ssl = self.__create_connection_ssl_obj()
-            if ssl:
-                try:
-                    return ConnectionParameters(
-                        host='broker',
-                        port=5671,
-                        virtual_host=creds.get('vhost', '/'),
-                        credentials=PlainCredentials(creds.get('user', ''), creds.get('passwd', '')),
-                        heartbeat=15,
-                        blocked_connection_timeout=20,
-                        ssl_options=ssl
-                    )
-                except Exception:
-                    self.log.exception(f'[{self.__id}] Failed to create connection parameters')
-        return None
-
-    def __reconnect_attempt(self):
-        self.__reconnecting = True
-        if self.__connect_attempt < self.__max_connect_attempts:
-            if self.__connect_attempt != 0:
-                sleep(5)
-            self.__connect_attempt += 1
-            self.log.info(
-                f'[{self.__id}] Reconnecting to broker {self.__connect_attempt}/{self.__max_connect_attempts - 1}')
-            return self._restart_io_loop_in_thread()
-        return False
-
-    def __connect(self, on_connect: callable = None, on_failed: callable = None, on_closed: callable = None):
-        self.log.info(f'[{self.__id}] Connecting to message broker')
-        params = self.__create_connection_parameters()
-        if params:
+            self.log.exception(f'[{self._id}] Failed to set exchange and queue')
+
+    def __queue_declared(self, _: Method):
+        self.log.info(f'[{self._id}] Successfully set exchange and declared queue')
+        self.__unblocked.set()
+        self._set_ready(True)
+        if self.__returned:
+            self.__schedule_resend(0)
+
+    def __channel_closed(self, _: Channel, reason: Exception):
+        self.log.error(f'[{self._id}] Channel closed: {reason}')
+        self.__fail_pending_confirms()
+
+    def __ack_nack_handler(self, method_frame: Method):
+        acked = method_frame.method.NAME == 'Basic.Ack'
+        tag = method_frame.method.delivery_tag
+        if method_frame.method.multiple:
+            tags = [pending for pending in self.__confirms if pending <= tag]
+        else:
+            tags = [tag]
+        for pending in tags:
+            self._resolve(self.__confirms.pop(pending, None), acked)
+        if not acked:
+            self.log.error(f'[{self._id}] Message not acknowledged')
+
+    def __returned_to_sender_handler(self, _: Channel, __: Basic.Return, properties: BasicProperties, body: bytes):
+        attempt = 1
+        if isinstance(properties.headers, dict):
+            attempt = properties.headers.get('x-return-attempt', 0) + 1
+        job_id = properties.message_id or body.decode()
+        if attempt > self.__max_return_attempts:
+            self.log.error(f'[{self._id}] Message for job {job_id} returned {attempt - 1} times, leaving it '
+                           'to the pending job reschedule check')
+            return
+        self.log.error(f'[{self._id}] Message returned for job {job_id}. Resend {attempt} scheduled')
+        self.__returned.append((body, properties, attempt))
+        self.__schedule_resend(min(2 ** (attempt - 1), 30))
+
+    def __schedule_resend(self, delay: float):
+        if self.__return_timer is None:
+            self.__return_timer = self._loop.loop.call_later(delay, self.__resend_returned)
+
+    def __resend_returned(self):
+        """Republish returned messages from the retry queue. Runs on a loop timer so a return never holds up
+        heartbeats or confirms, and is pushed back while the channel is down or the connection is blocked
+        """
+        self.__return_timer = None
+        if self._channel is None or not self._channel.is_open or not self.__unblocked.is_set():
+            return self.__schedule_resend(1)
+        while self.__returned:
+            body, properties, attempt = self.__returned.popleft()
+            headers = dict(properties.headers or {})
+            headers['x-return-attempt'] = attempt
+            properties.headers = headers
             try:
-                return SelectConnection(params, on_connect, on_failed, on_closed)
+                self._channel.basic_publish(self._exchange, self._route, body, properties, mandatory=True)
+                # Every publish on a confirm channel takes a delivery tag, the resend confirm is not awaited
+                self.__delivery_tag += 1
             except Exception:
-                self.log.exception(f'[{self.__id}] Failed to create connection to broker')
-        return None
-
-    def __connect_success(self, connection: BaseConnection):
-        self.log.info(f'[{self.__id}] Successfully connected to broker')
-        self.__connect_attempt = 0
-        connection.channel(on_open_callback=self.__open_channel)
-
-    def __connect_failed(self, *args: tuple):
-        self.log.error(f'[{self.__id}] Failed to create connection to broker: {args[1]}')
-        return self.__reconnect_attempt()
-
-    def __connect_closed(self, *args: tuple):
-        self.log.error(f'[{self.__id}] Connection closed: {args[1]}')
-        return self.__reconnect_attempt()
-
-    def __open_channel(self, channel: Channel):
-        self.log.info(f'[{self.__id}] Successfully opened channel and set exchange')
-        self.__channel = channel
-        self.__channel.exchange_declare(self.__exchange, 'direct')
-        self.__channel.add_on_return_callback(self.__returned_to_sender_handler)
-        self.__channel.confirm_delivery(ack_nack_callback=self.__ack_nack_handler)
-        self.__exchange_declared = True
-        self.__reconnecting = False
-        self.__conn_blocked = False
-
-    def __ack_nack_handler(self, method_frame: Basic.Deliver):
-        if method_frame.method.NAME != 'Basic.Ack':
-            self.log.error(f'[{self.__id}] Message not acknowledged')
-            if not self.__reconnecting:
-                self.__reconnect_attempt()
-
-    def __reset_connect_state(self):
-        self.__client = None
-        self.__channel = None
-        self.__exchange_declared = False
-        self.__queue_declared = False
-
-    def __returned_to_sender_handler(self, ch: Channel, _: Basic.Deliver, properties: BasicProperties, body: bytes):
-        try:
-            job_id = body.decode()
-            self.log.error(f'[{self.__id}] Message returned for job ID {job_id}. Resending to queue...')
-            sleep(1)
-            ch.basic_publish(
-                exchange=self.__exchange,
-                routing_key=self.__route,
-                body=body,
-                properties=properties,
-                mandatory=True
-            )
-        except Exception:
-            self.log.error(f'[{self.__id}] Failed to resend message to queue')
+                self.log.exception(f'[{self._id}] Failed to resend message to queue')
+                self.__returned.appendleft((body, properties, attempt))
+                return self.__schedule_resend(1)
 
-    def __start_io_loop(self) -> bool:
-        self.__client = self.__connect(self.__connect_success, self.__connect_failed, self.__connect_closed)
-        if self.__client is not None:
+    async def __publish(self, msg: bytes, job_id: str) -> bool:
+        if not await asyncio.shield(self._ready):
+            return False
+        if not self.__unblocked.is_set():
+            self.log.info(f'[{self._id}] Connection blocked, waiting for unblock from server...')
             try:
-                self.__client.add_on_connection_blocked_callback(self.__wait_for_conn_unblock)
-                self.__client.add_on_connection_unblocked_callback(self.__conn_unblocked)
-                self.__client.ioloop.start()
-                return True
-            except Exception:
-                self.log.exception(f'[{self.__id}] Exception occurred in IO loop')
-        return False
-
-    def __stop_io_loop(self):
+                await asyncio.wait_for(self.__unblocked.wait(), self.__unblock_timeout)
+            except TimeoutError:
+                self.log.error(f'[{self._id}] Timeout waiting for connection unblock')
+                return False
+            if not await asyncio.shield(self._ready):
+                return False
+        self.__delivery_tag += 1
+        confirm = self._loop.loop.create_future()
+        self.__confirms[self.__delivery_tag] = confirm
         try:
-            if self.__channel is not None:
-                if self.__channel.is_open:
-                    self.__channel.close()
-            if self.__client is not None:
-                if self.__client.is_open:
-                    self.__client.close()
-                self.__client.ioloop.stop()
-            self.__reset_connect_state()
-            return True
+            self._channel.basic_publish(self._exchange, self._route, msg, BasicProperties(
+                content_type='application/octet-stream',
+                delivery_mode=2,
+                message_id=job_id
+            ))
         except Exception:
-            self.log.exception(f'[{self.__id}] Exception occurred while stopping IO-loop')
+            self.__confirms.pop(self.__delivery_tag, None)
+            self.log.exception(f'[{self._id}] Failed to send message to queue')
             return False
+        try:
+            return await asyncio.wait_for(confirm, self.__confirm_timeout)
+        except TimeoutError:
+            self.log.error(f'[{self._id}] Timeout waiting for broker to confirm job {job_id[:8]}')
+        return False
 
-    def __stop_thread(self):
-        if self.__thread:
-            try:
-                if self.__thread.is_alive():
-                    self.__thread.join(3)
-                    if self.__thread.is_alive():
-                        self.log.error(f'[{self.__id}] Failed to stop broker thread')
-                        return False
-                    self.__thread = None
-                    self.log.info(f'[{self.__id}] Successfully stopped broker thread')
-                return True
-            except Exception:
-                self.log.exception(f'[{self.__id}] Exception occurred while stopping broker thread')
-        self.log.debug(f'[{self.__id}] Broker thread does not exist to stop')
-        return True
-
-    def _wait_for_reconnect(self, timeout: int = 1800):
-        cnt = 0
-        while self.__reconnecting:
-            self.log.info(f'[{self.__id}] Waiting for reconnection...')
-            sleep(1)
-            cnt += 1
-            if cnt > timeout:
-                self.log.error(f'[{self.__id}] Timeout waiting for reconnection')
-                return False
-        return True
+    def send_msg(self, msg: bytes, job_id: str):
+        """Publish a job message and wait for the broker to confirm it. Waits for an in progress reconnect first
 
-    def _restart_io_loop_in_thread(self):
-        """The connection to the broker is done in a separate thread to avoid blocking the main thread. This method
-        will get called via the reconnect procedure to restart the connection to the broker within the thread.
-        __start_io_loop might not return as it will be running the IO loop until the connection is closed. This is OK.
+        Args:
+            msg (bytes): message body
+            job_id (str): job ID set as the message ID
 
         Returns:
-            bool: True if the connection was successfully restarted, otherwise False
+            bool: True if the broker confirmed the message, otherwise False
         """
-        if self.__stop_io_loop():
-            return self.__start_io_loop()
-        self.log.error(f'[{self.__id}] Failed to restart broker connection')
-        return False
-
-    def __configure_queue(self):
-        if not self.__queue_declared:
-            try:
-                self.__channel.queue_declare(self.__route, durable=True)
-                self.__queue_declared = True
-                self.log.info(f'[{self.__id}] Successfully declared queue')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to declare queue')
-                return False
-        return True
-
-    def __handle_blocked_connection(self):
-        self.log.info(f'[{self.__id}] Connection blocked, waiting for unblock from server...')
-        while self.__conn_blocked:
-            sleep(.5)
-        self.log.info(f'[{self.__id}] Connection unblocked, resuming operations...')
-
-    def __can_send(self) -> bool:
-        if self.__conn_blocked:
-            self.__handle_blocked_connection()
-        if self.client_exists:
-            return self.__configure_queue()
-        if self._wait_for_reconnect():
-            return self.__can_send()
-        return False
-
-    def send_msg(self, msg: bytes, job_id: str):
         if isinstance(msg, bytes):
-            if self.__can_send():
-                try:
-                    self.__channel.basic_publish(self.__exchange, self.__route, msg, BasicProperties(
-                        content_type='application/octet-stream',
-                        delivery_mode=2,
-                        message_id=job_id
-                    ))
-                    self.log.info(f'[{self.__id}] Sent job to queue: {job_id[:8]}')
-                    return True
-                except Exception:
-                    self.log.exception(f'[{self.__id}] Failed to send message to queue')
-            else:
-                self.log.error(f'[{self.__id}] Failed to send message to queue')
-        else:
-            self.log.error(f'[{self.__id}] Invalid message type: {type(msg)}')
-        return False
-
-    def start(self):
-        if self.__thread:
-            self.log.error(f'[{self.__id}] Broker already running')
-            return False
-        self.log.info(f'[{self.__id}] Starting broker')
-        try:
-            self.__thread = Thread(target=self.__start_io_loop, daemon=True)
-            self.__thread.start()
-            if self.__wait_for_exchange_declare():
+            if self._loop.run(self.__publish(msg, job_id), self._max_connect_attempts * 30):
+                self.log.info(f'[{self._id}] Sent job to queue: {job_id[:8]}')
                 return True
-            self.log.error(f'[{self.__id}] Failed to start broker')
-            return False
-        except Exception:
-            self.log.exception(f'[{self.__id}] Failed to start broker')
-        return False
-
-    def stop(self):
-        self.log.info(f'[{self.__id}] Stopping broker')
-        if self.__stop_io_loop():
-            return self.__stop_thread()
-        self.log.error(f'[{self.__id}] Failed to stop broker')
+            self.log.error(f'[{self._id}] Failed to send message to queue')
+        else:
+            self.log.error(f'[{self._id}] Invalid message type: {type(msg)}')
         return False
 
 
@@ -718,6 +438,13 @@ class JobScheduler():
         self.log = get_logger()
         self.stop_trigger = Event()
         self.__db = Mongo('parent', self.log)
+        if not SchemaMigrations(self.__db, '/app/migrations.json', self.log).migrate():
+            self.log.error('Schema migration failed, job queries may run without their indexes')
+        self.__partitions = JobPartitions(self.__db, self.log, JOB_PARTITIONING)
+        if not self.__partitions.prepare(utc_now()):
+            self.log.error('Failed to prepare job partitions')
+        self.__specs = JobSpecs(self.__db, self.log)
+        self.__trimming = Lock()
         self.__run_job_queue = Queue()
         self.__web_server = WebServer(self.__run_job_queue, self.log)
         self._crons = schedule
@@ -790,32 +517,143 @@ class JobScheduler():
 
     def __publish_job(self, cron: Dict, job_id: str = None):
         try:
-            now = datetime.now()
+            now = utc_now()
             job = {
-                '_id': job_id or str(uuid4()),
+                '_id': job_id or self.__partitions.new_job_id(now),
                 'name': cron.get('name', ''),
                 'type': cron.get('type'),
                 'run': cron.get('run', ''),
-                'args': cron.get('args', []),
-                'hostInventory': cron.get('hostInventory', {}),
-                'extraVars': cron.get('extraVars', {}),
                 'state': 'pending',
                 'resendAttempt': 0,
-                'resent': now.isoformat(),
-                'scheduled': now.isoformat(),
-                'expiryTime': now + timedelta(days=7),
+                'resent': now,
+                'scheduled': now,
+                'expiryTime': now + timedelta(days=JOB_RETENTION_DAYS),
                 'start': None,
                 'end': None,
                 'result': None,
                 'errors': [],
             }
-            if bool(thread_local.db.insert_one('jobs', job)):
+            if job_id is None and cron.get('record') == 'summary' and not cron.get('shardSize'):
+                return self.__publish_summary_job(cron, job)
+            # Saving the version again pushes back its expiry, or stores it again if it expired since the last run
+            version = self.__specs.save_cron_version(cron) if job_id is None and cron.get('cronVersion') else None
+            if version:
+                # The worker reads the run spec from the cron version, the job only references it
+                job.update({'cronId': cron['_id'], 'cronVersion': version})
+            else:
+                job.update({
+                    'args': cron.get('args', []),
+                    'hostInventory': cron.get('hostInventory', {}),
+                    'inventory': cron.get('inventory'),
+                    'extraVars': cron.get('extraVars', {}),
+                    'timeout': cron.get('timeout'),
+                    'mode': cron.get('mode'),
+                    'runHash': cron.get('runHash'),
+                })
+            collection = job_collection(job['_id'])
+            if collection != 'jobs':
+                # Partitions are dropped whole, their jobs do not need the TTL field
                 del job['expiryTime']
+                if not self.__partitions.ensure(collection):
+                    return False
+            shard_size = cron.get('shardSize')
+            inventory = cron.get('hostInventory')
+            if shard_size and cron.get('inventory'):
+                inventory = self.__specs.inventory(cron['inventory'])
+                if inventory is None:
+                    return False
+            if shard_size and isinstance(inventory, dict) and len(inventory) > shard_size:
+                return self.__publish_sharded_job(job, inventory, shard_size)
+            if bool(thread_local.db.insert_one(collection, job)):
                 return thread_local.publisher.send_msg(job['_id'].encode(), job['_id'])
         except Exception:
             self.log.exception(f'[{thread_local.sched_id}] Failed to publish job')
         return False
 
+    def __publish_summary_job(self, cron: Dict, job: Dict) -> bool:
+        """Publish a run of a cron in summary record mode. The message carries the job spec and no job document is
+        written, the worker only adds the run to job_stats and its failures to job_failures
+
+        Args:
+            cron (Dict): cron document
+            job (Dict): job document
+
+        Returns:
+            bool: True if the broker confirmed the message, otherwise False
+        """
+        spec = {key: cron[key] for key in CRON_SPEC_KEYS if cron.get(key) is not None}
+        spec.update({'_id': job['_id'], 'name': job['name'], 'record': 'summary',
+                     'scheduled': job['scheduled'].isoformat()})
+        return thread_local.publisher.send_msg(dumps(spec).encode(), job['_id'])
+
+    def __publish_sharded_job(self, job: Dict, inventory: Dict, shard_size: int) -> bool:
+        """Split a job with a large host inventory into child jobs of shard_size hosts that run across the worker
+        fleet. The job itself becomes the parent document that workers fold the child results into
+
+        Args:
+            job (Dict): job document
+            inventory (Dict): host inventory of the job, resolved when it is a named inventory
+            shard_size (int): max hosts per child job
+
+        Returns:
+            bool: True if the parent and every child were created and published, False otherwise
+        """
+        hosts = list(inventory.items())
+        shards = [dict(hosts[index:index + shard_size]) for index in range(0, len(hosts), shard_size)]
+        children = []
+        for index, shard in enumerate(shards):
+            children.append({
+                **job,
+                '_id': sibling_job_id(job['_id']),
+                'name': f'{job["name"]} [shard {index + 1}/{len(shards)}]',
+                'hostInventory': shard,
+                'inventory': None,
+                'parentId': job['_id'],
+                'shard': index,
+            })
+        job.update({
+            'state': 'running',
+            'start': utc_now(),
+            'shards': len(shards),
+            'completedShards': [],
+            'failedShards': 0,
+            'hosts': [],
+        })
+        self.log.info(f'[{thread_local.sched_id}] Sharding job {job["_id"]} into {len(shards)} child jobs')
+        collection = job_collection(job['_id'])
+        if not thread_local.db.insert_one(collection, job) or not thread_local.db.insert_many(collection, children):
+            self.log.error(f'[{thread_local.sched_id}] Failed to create sharded job {job["_id"]}')
+            return False
+        sent = True
+        for child in children:
+            if not thread_local.publisher.send_msg(child['_id'].encode(), child['_id']):
+                sent = False
+        return sent
+
+    def __complete_shard(self, job: Dict, errors: list, end: datetime):
+        """Fold a failed child job into its parent. Mirrors the worker so a shard whose worker died still lets the
+        parent finish. The completedShards guard keeps a shard from being counted twice, the parent is added to
+        job_stats as one run when this completes it
+        """
+        rsp = thread_local.db.update_one(
+            job_collection(job['parentId']), {'_id': job['parentId'], 'completedShards': {'$ne': job.get('shard')}},
+            {'$push': {'completedShards': job.get('shard'), 'errors': {'$each': errors}}, '$inc': {'failedShards': 1}}
+        )
+        if rsp is None or not rsp.modified_count:
+            return
+        rsp = thread_local.db.update_one(
+            job_collection(job['parentId']), {
+                '_id': job['parentId'], 'state': 'running',
+                '$expr': {'$eq': [{'$size': '$completedShards'}, '$shards']}
+            },
+            [{'$set': {'state': 'completed', 'end': end, 'result': {'$eq': ['$failedShards', 0]}}}]
+        )
+        if rsp is not None and rsp.modified_count:
+            parent = thread_local.db.get_one(job_collection(job['parentId']), {'_id': job['parentId']},
+                                             {'name': 1, 'start': 1, 'end': 1, 'result': 1, 'state': 1, 'usage': 1})
+            if parent and not record_job_stats(thread_local.db, parent):
+                self.log.error(f'[{thread_local.sched_id}] Failed to update job stats for {parent.get("name")}')
+
     def _run_cron(self, cron: Dict, job_id: str = None):
         self.__pool.submit(self.__publish_job, cron, job_id)
 
@@ -823,6 +661,11 @@ class JobScheduler():
         self._crons.clear()
         for cron in self.__get_crons():
             cron: Dict
+            version = self.__specs.save_cron_version(cron)
+            if version is None:
+                self.log.error(f'Failed to save cron version of {cron.get("name")}, its jobs carry the full run spec')
+            else:
+                cron['cronVersion'] = version
             if not self.__create_cron_job(cron):
                 self.log.error(f'Failed to create cron job for {cron.get("name")}')
                 return False
@@ -830,37 +673,177 @@ class JobScheduler():
 
     def __reschedule_job(self, job: Dict, attempt: int = 1):
         self.log.info(f'[{thread_local.sched_id}] Resending job {job.get("_id")} attempt {attempt}')
-        job['resendAttempt'] = attempt
-        job['resent'] = datetime.now().isoformat()
-        if bool(thread_local.db.update_one('jobs', {'_id': job.get('_id')}, {'$set': job})):
+        update = {'resendAttempt': attempt, 'resent': utc_now()}
+        rsp = thread_local.db.update_one(job_collection(job.get('_id')), {'_id': job.get('_id'), 'state': 'pending'},
+                                         {'$set': update})
+        if rsp is not None:
+            if rsp.matched_count == 0:
+                self.log.info(f'[{thread_local.sched_id}] Job {job.get("_id")} already claimed, skipping resend')
+                return True
             if thread_local.publisher.send_msg(job['_id'].encode(), job['_id']):
                 return True
         self.log.error(f'[{thread_local.sched_id}] Failed to reschedule job {job.get("_id")}')
         return False
 
-    def __get_latest_completed_job(self):
-        cursor = self.__db.get_all_with_cursor('jobs', {'state': 'completed'})
-        if cursor:
-            try:
-                latest = list(cursor.sort('scheduled', DESCENDING).limit(1))
-                if latest:
-                    return datetime.fromisoformat(latest[0].get('scheduled'))
-            except Exception:
-                self.log.exception('Failed to get latest completed job')
+    def __job_collections(self, now: datetime) -> list[str]:
+        return self.__partitions.collections(now - timedelta(days=JOB_RETENTION_DAYS)) or ['jobs']
+
+    def __get_latest_completed_job(self, collections: list[str]):
+        # Newest partition first, the first completed job found is the latest one
+        for collection in collections:
+            latest = self.__db.find(collection, {'state': 'completed'}, {'scheduled': 1},
+                                    [('scheduled', DESCENDING)], 1)
+            if latest:
+                return latest[0].get('scheduled')
         return None
 
     def reschedule_jobs_check(self):
-        pending = self.__db.get_all('jobs', {'state': 'pending'})
-        if pending:
-            latest = self.__get_latest_completed_job()
-            if latest:
-                now = datetime.now()
-                for job in pending:
-                    if datetime.fromisoformat(job.get('scheduled')) < latest:
-                        attempt = job.get('resendAttempt', 0) + 1
-                        if attempt < 4:
-                            if datetime.fromisoformat(job.get('resent')) < now - timedelta(minutes=attempt):
-                                self.__pool.submit(self.__reschedule_job, job, attempt)
+        """Resend pending jobs scheduled before the latest completed job. Attempt n waits n minutes after the last
+        send, the time comparisons run in MongoDB on the (state, scheduled) index"""
+        now = utc_now()
+        collections = self.__job_collections(now)
+        latest = self.__get_latest_completed_job(collections)
+        if latest:
+            query = {'state': 'pending', 'scheduled': {'$lt': latest}, '$or': [
+                {'resendAttempt': attempt - 1, 'resent': {'$lt': now - timedelta(minutes=attempt)}}
+                for attempt in range(1, 4)
+            ]}
+            for collection in collections:
+                for job in self.__db.get_all(collection, query, {'resendAttempt': 1}):
+                    self.__pool.submit(self.__reschedule_job, job, job.get('resendAttempt', 0) + 1)
+
+    def __requeue_expired_job(self, job: Dict, now: datetime):
+        query = {'_id': job.get('_id'), 'state': 'running', 'leaseUntil': {'$lt': now}}
+        attempt = job.get('resendAttempt', 0) + 1
+        if attempt < 4:
+            self.log.info(f'[{thread_local.sched_id}] Lease expired for job {job.get("_id")}, requeue {attempt}')
+            rsp = thread_local.db.update_one(job_collection(job.get('_id')), query, {'$set': {
+                'state': 'pending',
+                'resendAttempt': attempt,
+                'resent': now,
+                'start': None,
+                'workerId': None,
+                'leaseUntil': None,
+            }})
+            if rsp is not None:
+                if rsp.matched_count == 0 or thread_local.publisher.send_msg(job['_id'].encode(), job['_id']):
+                    return True
+        else:
+            self.log.error(f'[{thread_local.sched_id}] Lease expired for job {job.get("_id")}, marking failed')
+            error = f'Worker {job.get("workerId")} lease expired after {attempt - 1} requeue attempts'
+            rsp = thread_local.db.update_one(job_collection(job.get('_id')), query, {
+                '$set': {'state': 'completed', 'result': False, 'end': now, 'leaseUntil': None},
+                '$push': {'errors': error}
+            })
+            if rsp is not None:
+                if rsp.matched_count and job.get('parentId'):
+                    self.__complete_shard(job, [error], now)
+                return True
+        self.log.error(f'[{thread_local.sched_id}] Failed to handle expired lease for job {job.get("_id")}')
+        return False
+
+    def reap_expired_leases(self):
+        """Find running jobs whose worker stopped renewing the job lease (worker crashed or was killed) and requeue
+        them, or fail them once they have used up their resend attempts
+        """
+        now = utc_now()
+        for collection in self.__job_collections(now):
+            expired = self.__db.get_all(collection, {'state': 'running', 'leaseUntil': {'$lt': now}},
+                                        {'resendAttempt': 1, 'workerId': 1, 'parentId': 1, 'shard': 1})
+            for job in expired:
+                self.__pool.submit(self.__requeue_expired_job, job, now)
+
+    def trim_job_results(self):
+        """Apply the keepLast, keepFailedFor and keepSucceededFor retention of the crons in the background. A pass is
+        skipped while the previous one is still running"""
+        if self.__trimming.acquire(blocking=False):
+            self.__pool.submit(self.__trim_job_results)
+
+    def __trim_job_results(self):
+        try:
+            now = utc_now()
+            collections = self.__job_collections(now)
+            crons = self.__db.get_all('crons', {'$or': [{key: {'$gt': 0}} for key in RETENTION_KEYS]},
+                                      {'name': 1, **{key: 1 for key in RETENTION_KEYS}})
+            for cron in crons:
+                trimmed = self.__trim_cron_results(cron, collections, now)
+                if trimmed:
+                    self.log.info(f'[{thread_local.sched_id}] Trimmed {trimmed} job results of {cron.get("name")}')
+        except Exception:
+            self.log.exception(f'[{thread_local.sched_id}] Failed to trim job results')
+        finally:
+            self.__trimming.release()
+
+    def __keep_last_boundary(self, name: str, keep_last: int, collections: list[str]) -> tuple | None:
+        """Find the oldest of the newest keep_last completed runs of a job name. Walks the (name, scheduled, _id) index
+        of each partition newest first with skip and limit, skipping past the few unfinished runs newer than the
+        boundary
+
+        Returns:
+            tuple | None: (index of its collection, job) or None if there are no more than keep_last runs
+        """
+        seen = 0
+        sort = [('scheduled', DESCENDING), ('_id', DESCENDING)]
+        for index, collection in enumerate(collections):
+            unfinished = thread_local.db.find(collection, {'name': name, 'state': {'$in': ['pending', 'running']}},
+                                              {'scheduled': 1})
+            if unfinished is None:
+                return None
+            skip = keep_last - seen - 1
+            while True:
+                boundary = thread_local.db.find(collection, {'name': name}, {'scheduled': 1}, sort, 1, skip=skip)
+                if not boundary:
+                    break
+                newer = sum(1 for run in unfinished
+                            if (run['scheduled'], run['_id']) >= (boundary[0]['scheduled'], boundary[0]['_id']))
+                if skip == keep_last - seen - 1 + newer:
+                    return index, boundary[0]
+                skip = keep_last - seen - 1 + newer
+            if boundary is None:
+                return None
+            seen += thread_local.db.count_documents(collection, {'name': name}) - len(unfinished)
+        return None
+
+    def __trim_cron_results(self, cron: Dict, collections: list[str], now: datetime) -> int:
+        """Delete the completed runs of a cron that are neither among its newest keepLast runs nor inside the keep
+        window of their result. A result without a keep window is only trimmed by keepLast. Every delete is a range
+        on the (name, scheduled, _id) index
+
+        Returns:
+            int: number of job results deleted
+        """
+        keep_last = cron.get('keepLast')
+        conditions = []
+        for result, key in [(True, 'keepSucceededFor'), (False, 'keepFailedFor')]:
+            if cron.get(key):
+                conditions.append({'result': result, 'scheduled': {'$lt': now - timedelta(hours=cron[key])}})
+            elif keep_last:
+                conditions.append({'result': result})
+        if not conditions:
+            return 0
+        start, boundary = 0, None
+        if keep_last:
+            found = self.__keep_last_boundary(cron['name'], keep_last, collections)
+            if found is None:
+                return 0
+            start, boundary = found
+        trimmed = 0
+        for index in range(start, len(collections)):
+            query = {'name': cron['name'], '$or': conditions}
+            if index == start and boundary is not None:
+                query['$and'] = [{'$or': [
+                    {'scheduled': {'$lt': boundary['scheduled']}},
+                    {'scheduled': boundary['scheduled'], '_id': {'$lt': boundary['_id']}}
+                ]}]
+            rsp = thread_local.db.delete_many(collections[index], query)
+            if rsp is not None:
+                trimmed += rsp.deleted_count
+        return trimmed
+
+    def prepare_job_partitions(self):
+        """Create the upcoming job partitions and drop the expired ones"""
+        if not self.__partitions.prepare(utc_now()):
+            self.log.error('Failed to prepare job partitions')
 
 
 def main():
@@ -873,6 +856,9 @@ def main():
             scheduler.get_scheduled_run_now_jobs()
             if cnt == 60:
                 scheduler.reschedule_jobs_check()
+                scheduler.reap_expired_leases()
+                scheduler.prepare_job_partitions()
+                scheduler.trim_job_results()
                 cnt = 0
             sleep(1)
             cnt += 1
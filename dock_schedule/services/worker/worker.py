@@ -1,25 +1,43 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import shutil
 import ssl
+import fcntl
+import sqlite3
+import shlex
+import hashlib
+import pickle
+import signal
+import select
 import logging
-from time import sleep, gmtime
-from threading import Thread, Event, local
+import resource
+import traceback
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from runpy import run_path
+from time import sleep, gmtime, time
+from threading import Thread, Event, Lock, local
 from typing import Dict
-from tempfile import TemporaryDirectory
-from urllib.parse import quote_plus
-from datetime import datetime
-from queue import Queue
+from tempfile import TemporaryDirectory, TemporaryFile, NamedTemporaryFile
+from datetime import datetime, timedelta, timezone
+from queue import Queue, Empty
 from uuid import uuid4
 
 import ansible_runner
-from pika import SelectConnection, BaseConnection
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.credentials import PlainCredentials
+from pika import BasicProperties
 from pika.channel import Channel
-from pika.connection import ConnectionParameters, SSLOptions
+from pika.frame import Method
 from pika.spec import Basic
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
+from json import loads
+from bson import json_util
+from pymongo import UpdateOne
+
+from dsbroker import BrokerConnection
+from dsdb import JOB_STATS_RETENTION_DAYS, JobSpecs, Mongo, db_latency, job_collection, record_job_stats
 
 
 thread_local = local()
@@ -38,405 +56,1106 @@ def get_logger():
     return log
 
 
-class Mongo():
-    def __init__(self, client_id: str = None, logger: logging.Logger = None):
-        self.log = logger
-        self.__id = client_id or str(uuid4())[:8]
-        self.__client: MongoClient | None = None
-        self.__creds = {'user': '', 'passwd': '', 'db': ''}
+def utc_now() -> datetime:
+    """Naive UTC datetime, the form pymongo stores and returns, so it compares directly with values read back"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        get_logger().error(f'Invalid integer value for {name}, using default {default}')
+    return default
+
+
+JOB_LEASE_SECONDS = get_env_int('JOB_LEASE_SECONDS', 60)
+JOB_HEARTBEAT_SECONDS = get_env_int('JOB_HEARTBEAT_SECONDS', 15)
+WARM_POOL_SIZE = get_env_int('WARM_POOL_SIZE', 2)
+WARM_POOL_MAX_TASKS = get_env_int('WARM_POOL_MAX_TASKS', 50)
+HOST_CONCURRENCY_DEFAULT = get_env_int('HOST_CONCURRENCY_DEFAULT', 2)
+HOST_DEFER_SECONDS = get_env_int('HOST_DEFER_SECONDS', 30)
+JOB_FAILURES_KEEP = get_env_int('JOB_FAILURES_KEEP', 20)
+WORKER_METRICS_PORT = get_env_int('WORKER_METRICS_PORT', 9200)
+WORKER_STOP_GRACE_SECONDS = get_env_int('WORKER_STOP_GRACE_SECONDS', 300)
+RUNNER_TMPFS = get_env_int('RUNNER_TMPFS', 1) > 0
+RUNNER_DIR = os.environ.get('RUNNER_DIR', '/app/runner')
+JOB_CACHE_DIR = os.environ.get('JOB_CACHE_DIR', '/app/cache')
+SSH_CONTROL_DIR = os.environ.get('SSH_CONTROL_DIR', '/app/ssh-cp')
+RESULT_SPOOL_DIR = os.environ.get('RESULT_SPOOL_DIR', '/app/spool')
+RESULT_SPOOL_FLUSH_SECONDS = get_env_int('RESULT_SPOOL_FLUSH_SECONDS', 5)
+RESULT_SPOOL_BATCH = get_env_int('RESULT_SPOOL_BATCH', 100)
+SSH_POOL_IDLE_SECONDS = get_env_int('SSH_POOL_IDLE_SECONDS', 900)
+SSH_POOL_PREWARM_PERIOD = get_env_int('SSH_POOL_PREWARM_PERIOD', 3600)
+SSH_POOL_MAX_HOSTS = get_env_int('SSH_POOL_MAX_HOSTS', 100)
+SSH_POOL_REPORT_SECONDS = get_env_int('SSH_POOL_REPORT_SECONDS', 300)
+WARM_POOL_PRELOAD = [module.strip() for module in os.environ.get('WARM_POOL_PRELOAD', '').split(',') if module.strip()]
+
+
+def get_host_limits() -> Dict[str, int]:
+    """Get the per-host concurrency limits from HOST_CONCURRENCY_LIMITS ("ip1=2, ip2=4"). Hosts that are not listed
+    use HOST_CONCURRENCY_DEFAULT
+
+    Returns:
+        Dict[str, int]: concurrency limit by host
+    """
+    limits = {}
+    for item in os.environ.get('HOST_CONCURRENCY_LIMITS', '').split(','):
+        if '=' in item:
+            host, limit = item.split('=', 1)
+            try:
+                limits[host.strip()] = int(limit)
+            except ValueError:
+                pass
+    return limits
+
+
+HOST_CONCURRENCY_LIMITS = get_host_limits()
+
+
+def get_usage(*targets: int | resource.struct_rusage) -> Dict:
+    """Get the resource usage of the current process and/or its reaped children
+
+    Args:
+        targets (int | resource.struct_rusage): resource.RUSAGE_SELF and/or resource.RUSAGE_CHILDREN, or a usage
+            already collected such as the one os.wait4 returns for a child
+
+    Returns:
+        Dict: CPU seconds, max RSS (KB), block I/O and context switches
+    """
+    usage = {
+        'userCpu': 0.0, 'sysCpu': 0.0, 'maxRssKb': 0, 'blockIn': 0, 'blockOut': 0,
+        'voluntaryCtxSwitches': 0, 'involuntaryCtxSwitches': 0
+    }
+    for target in targets:
+        rusage = resource.getrusage(target) if isinstance(target, int) else target
+        usage['userCpu'] += rusage.ru_utime
+        usage['sysCpu'] += rusage.ru_stime
+        usage['maxRssKb'] = max(usage['maxRssKb'], rusage.ru_maxrss)
+        usage['blockIn'] += rusage.ru_inblock
+        usage['blockOut'] += rusage.ru_oublock
+        usage['voluntaryCtxSwitches'] += rusage.ru_nvcsw
+        usage['involuntaryCtxSwitches'] += rusage.ru_nivcsw
+    return usage
+
+
+def get_forkserver_context() -> multiprocessing.context.ForkServerContext:
+    """Fork server context of the runner and warm pools. The fork server imports this module, and with it
+    ansible_runner, pika and pymongo, and WARM_POOL_PRELOAD once so pool processes start without importing them again
+
+    Returns:
+        multiprocessing.context.ForkServerContext: forkserver context
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__'] + WARM_POOL_PRELOAD)
+    return context
+
+
+def _run_ansible(runner_args: Dict, runner_dir: str | None, ident: str) -> Dict:
+    events = []
+
+    def keep_event(event: Dict) -> bool:
+        events.append(event)
+        return False  # Do not write the event to the artifact dir
+
+    if runner_dir is None:
+        with TemporaryDirectory(prefix=f'job-{ident}-', dir='/tmp', delete=True) as temp_dir:
+            result = ansible_runner.run(private_data_dir=temp_dir, **runner_args)
+            events = list(result.events)
+    else:
+        try:
+            result = ansible_runner.run(
+                private_data_dir=runner_dir,
+                ident=ident,
+                event_handler=keep_event,
+                suppress_env_files=True,
+                suppress_output_file=True,
+                **runner_args
+            )
+        finally:
+            shutil.rmtree(os.path.join(runner_dir, 'artifacts', ident), ignore_errors=True)
+    return {'status': result.status, 'rc': result.rc, 'events': events}
+
+
+def _exec_ansible_job(runner_args: Dict, runner_dir: str | None, ident: str, output: int):
+    """Body of the forked ansible job process, never returns"""
+    rc = 1
+    try:
+        with os.fdopen(output, 'wb', closefd=False) as file:
+            pickle.dump(_run_ansible(runner_args, runner_dir, ident), file)
+        rc = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stderr.flush()
+        os._exit(rc)
+
+
+def run_ansible_job(runner_args: Dict, runner_dir: str | None, ident: str) -> Dict:
+    """Run a job with ansible_runner. Runs in a long lived runner pool process, which forks the run like a warm job:
+    ansible_runner is already imported so a run only pays for the fork, and the usage os.wait4 returns for the fork
+    is the usage of the job's whole process tree
+
+    Args:
+        runner_args (Dict): ansible_runner.run arguments
+        runner_dir (str | None): reusable tmpfs private data dir, or None to run in a temporary dir in /tmp
+        ident (str): job ID
+
+    Raises:
+        RuntimeError: the run process exited without a result
+
+    Returns:
+        Dict: status, rc, events and usage of the run
+    """
+    with TemporaryFile() as output:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            _exec_ansible_job(runner_args, runner_dir, ident, output.fileno())
+        _, status, rusage = os.wait4(pid, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise RuntimeError(f'Ansible run process of job {ident} exited with {os.waitstatus_to_exitcode(status)}')
+        output.seek(0)
+        result = pickle.load(output)
+    result['usage'] = get_usage(rusage)
+    return result
+
+
+def _exec_warm_script(script: str, args: list, stdout: int, stderr: int):
+    """Body of the forked warm job process, never returns"""
+    rc = 1
+    try:
+        os.setpgid(0, 0)
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        sys.argv = [script] + shlex.split(' '.join(str(arg) for arg in args or []))
+        run_path(script, run_name='__main__')
+        rc = 0
+    except SystemExit as error:
+        if isinstance(error.code, int):
+            rc = error.code
+        elif error.code is not None:
+            sys.stderr.write(f'{error.code}\n')
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(rc & 0xff)
+
+
+def run_warm_script(script: str, args: list, timeout: int = None) -> Dict:
+    """Run a python3 job script from a pre-forked warm pool interpreter. Runs in the pool child process, which forks
+    the script into its own process group: the modules the pool preloads are already imported so only the script
+    itself is executed, and on timeout the whole group is killed like an ansible job's
+
+    Args:
+        script (str): path to the python3 job script
+        args (list): job arguments, split the same way the run_job_script playbook passes them
+        timeout (int, optional): seconds the script can run before it is stopped. Defaults to None.
+
+    Returns:
+        Dict: rc, stdout, stderr, timedOut and usage of the script run
+    """
+    rsp = {'timedOut': False}
+    with TemporaryFile() as stdout, TemporaryFile() as stderr:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            _exec_warm_script(script, args, stdout.fileno(), stderr.fileno())
+        try:
+            os.setpgid(pid, pid)  # Also set by the child, whichever runs first keeps killpg from missing the group
+        except OSError:
+            pass
+        pidfd = os.pidfd_open(pid)
+        try:
+            if not select.select([pidfd], [], [], timeout)[0]:
+                os.killpg(pid, signal.SIGKILL)
+                rsp['timedOut'] = True
+        finally:
+            os.close(pidfd)
+        _, status, rusage = os.wait4(pid, 0)
+        rsp['rc'] = 124 if rsp['timedOut'] else os.waitstatus_to_exitcode(status)
+        for name, output in [('stdout', stdout), ('stderr', stderr)]:
+            output.seek(0)
+            rsp[name] = output.read().decode(errors='replace')
+    rsp['usage'] = get_usage(rusage)
+    return rsp
+
+
+class WorkerMetrics():
+    def __init__(self):
+        """In-process metrics of this worker replica, rendered in the Prometheus text format by MetricsServer"""
+        self.__lock = Lock()
+        self.__values: Dict[str, Dict[tuple, float]] = {name: {} for name in self.__metrics}
+        self.__histograms: Dict[str, Dict[tuple, list]] = {name: {} for name in self.__buckets}
 
     @property
-    def __host(self):
-        return "mongodb://%s:%s@mongodb:27017/" % (quote_plus(self.__creds.get('user')),
-                                                   quote_plus(self.__creds.get('passwd')))
+    def __metrics(self) -> Dict[str, tuple]:
+        return {
+            'worker_slots': ('gauge', 'Job slots (worker threads) of the worker'),
+            'worker_slots_busy': ('gauge', 'Job slots currently running a job'),
+            'worker_jobs_total': ('counter', 'Jobs finished by the worker by type and state'),
+            'worker_jobs_deferred_total': ('counter', 'Jobs deferred to the delay queue because a host was saturated'),
+            'worker_broker_reconnects_total': ('counter', 'Reconnect attempts to the message broker'),
+            'worker_broker_blocked': ('gauge', 'Broker connections of the worker blocked by the broker (1) or not (0)'),
+            'worker_ssh_checkouts_total': ('counter', 'SSH pool host checkouts by reuse of an open master'),
+            'worker_results_spooled_total': ('counter', 'Job results spooled locally as MongoDB was unavailable'),
+            'worker_spool_pending': ('gauge', 'Job results in the local spool waiting to be flushed to MongoDB'),
+        }
 
     @property
-    def client(self):
-        if self.__client is None:
-            if self.__load_creds():
-                for attempt in range(36):
-                    try:
-                        self.__client = MongoClient(
-                            host=self.__host,
-                            tls=True,
-                            tlsCAFile='/app/ca.crt',
-                            tlsCertificateKeyFile='/app/host.pem',
-                            serverSelectionTimeoutMS=2000
-                        )
-                        self.__client.admin.command('ping')
-                        self.log.info(f'[{self.__id}] MongoDB client created successfully')
-                        return self.__client
-                    except ServerSelectionTimeoutError:
-                        self.log.error(f'[{self.__id}] Failed to connect to MongoDB {attempt + 1}/35')
-                    except ConnectionFailure:
-                        self.log.exception(f'[{self.__id}] Failed to connect to MongoDB')
-                    except Exception:
-                        self.log.exception(f'[{self.__id}] Failed to create MongoDB client')
-                        return None
-                    sleep(2)
-        return self.__client
-
-    def __load_creds(self):
-        for key in self.__creds.keys():
-            try:
-                with open(f'/run/secrets/mongo_{key}', 'r') as f:
-                    self.__creds[key] = f.read().strip()
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to load mongodb credentials for {key}')
-                return False
-        return True
+    def __buckets(self) -> Dict[str, tuple]:
+        return {
+            'worker_job_duration_seconds': (1, 5, 15, 30, 60, 300, 900, 1800, 3600),
+            'worker_job_queue_wait_seconds': (0.1, 0.5, 1, 5, 15, 60, 300, 900),
+            'worker_ack_latency_seconds': (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+        }
 
-    def __get_db(self):
-        if self.client:
-            try:
-                return self.client[self.__creds.get('db')]
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to get database object')
-        return None
+    @property
+    def __histogram_help(self) -> Dict[str, str]:
+        return {
+            'worker_job_duration_seconds': 'Job execution time by type',
+            'worker_job_queue_wait_seconds': 'Time from the job being scheduled to being claimed by the worker',
+            'worker_ack_latency_seconds': 'Time from a worker thread acking a message to the ack being sent',
+        }
 
-    def __get_collection(self, collection_name: str = 'jobs'):
-        db = self.__get_db()
-        if db is not None:
-            try:
-                return db[collection_name]
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to get collection: {collection_name}')
-        return None
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__values[name][key] = self.__values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.__lock:
+            self.__values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.__buckets[name]
+        with self.__lock:
+            # Cumulative bucket counts followed by the sum and count of the observations
+            series = self.__histograms[name].setdefault(key, [0] * (len(buckets) + 2))
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def __label_value(self, value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def __labels(self, labels: tuple, extra: str = '') -> str:
+        items = [f'{key}="{self.__label_value(value)}"' for key, value in labels]
+        if extra:
+            items.append(extra)
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def render(self) -> str:
+        lines = []
+        with self.__lock:
+            for name, (metric_type, description) in self.__metrics.items():
+                lines.extend([f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'])
+                for labels, value in self.__values[name].items():
+                    lines.append(f'{name}{self.__labels(labels)} {value}')
+            for name, buckets in self.__buckets.items():
+                lines.extend([f'# HELP {name} {self.__histogram_help[name]}', f'# TYPE {name} histogram'])
+                for labels, series in self.__histograms[name].items():
+                    for index, bound in enumerate(buckets):
+                        lines.append(f'{name}_bucket{self.__labels(labels, f'le="{bound}"')} {series[index]}')
+                    lines.append(f'{name}_bucket{self.__labels(labels, 'le="+Inf"')} {series[-1]}')
+                    lines.append(f'{name}_sum{self.__labels(labels)} {series[-2]}')
+                    lines.append(f'{name}_count{self.__labels(labels)} {series[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+worker_metrics = WorkerMetrics()
+
+
+class MetricsServer():
+    def __init__(self, logger: logging.Logger, port: int = WORKER_METRICS_PORT):
+        """HTTPS /metrics endpoint of the worker replica. Uses the worker TLS material and requires a client
+        certificate signed by the swarm CA like the scheduler web server
+
+        Args:
+            logger (logging.Logger): logger object
+            port (int, optional): port to listen on. Defaults to WORKER_METRICS_PORT.
+        """
+        self.log = logger
+        self.__port = port
+        self.__server: ThreadingHTTPServer | None = None
 
-    def update_one(self, query: dict, update: dict, upsert: bool = False):
-        collection = self.__get_collection()
-        if collection is not None:
-            try:
-                return collection.update_one(query, update, upsert=upsert)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to update data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to update document: {query}')
-        return None
+    @property
+    def __ssl_context(self) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain('/app/host.crt', '/app/host.key')
+        context.load_verify_locations('/app/ca.crt')
+        context.verify_mode = ssl.CERT_REQUIRED
+        return context
+
+    def start(self) -> bool:
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = worker_metrics.render() + '\n'.join(db_latency.render('worker_db_latency_seconds')) + '\n'
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
 
-    def get_one(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.find_one(*filters)
-            except OperationFailure as error:
-                self.log.error(f'[{self.__id}] Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to find data')
-        return None
+        try:
+            self.__server = ThreadingHTTPServer(('0.0.0.0', self.__port), MetricsHandler)
+            self.__server.socket = self.__ssl_context.wrap_socket(self.__server.socket, server_side=True)
+            Thread(target=self.__server.serve_forever, daemon=True).start()
+            self.log.info(f'Worker metrics listening on port {self.__port}')
+            return True
+        except Exception:
+            self.log.exception('Failed to start worker metrics server')
+        return False
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server = None
 
 
-class JobConsumer():
+class JobConsumer(BrokerConnection):
     def __init__(self, consumer_id: str, queue: Queue, logger: logging.Logger = None):
-        self.log = logger or get_logger()
-        self.__id = consumer_id
+        super().__init__(consumer_id, logger or get_logger())
         self.__queue = queue
-        self.__route = 'job-queue'
-        self.__exchange = 'dock-schedule'
-        self.__thread: Thread | None = None
-        self.__client: SelectConnection | None = None
-        self.__channel: BlockingChannel | None = None
-        self.__connect_attempt = 0
-        self.__max_connect_attempts = 36
-        self.__reconnecting = False
-        self.__bind_set = False
-        self.__conn_blocked = False
-        self.__queue_declared = False
+        self.__delay_route = 'job-delay-queue'
+        self.__consumer_tag: str | None = None
+        self.__draining = False
 
-    @property
-    def client_exists(self):
-        if self.__client and self.__client.is_open:
-            if self.__channel:
-                if self.__channel.is_open:
-                    return True
-                return self.__wait_for_channel_open()
-            self.log.error(f'[{self.__id}] Broker connection channel is closed')
-        else:
-            self.log.error(f'[{self.__id}] Broker connection is closed')
-        return False
+    def _on_blocked(self):
+        # Acks and deliveries carry on while blocked, only the delay queue publishes are held by the broker
+        self.log.info(f'[{self._id}] Connection blocked by the broker')
+        worker_metrics.set('worker_broker_blocked', 1, consumer=self._id)
+
+    def _on_unblocked(self):
+        self.log.info(f'[{self._id}] Connection unblocked by the broker')
+        worker_metrics.set('worker_broker_blocked', 0, consumer=self._id)
 
-    def __wait_for_channel_open(self):
-        cnt = 0
-        if self.__channel is not None:
-            while not self.__channel.is_open:
-                cnt += 1
-                if cnt > 100:
-                    self.log.error(f'[{self.__id}] Failed to open channel')
-                    return False
-                sleep(.2)
-            self.log.debug(f'[{self.__id}] Channel is open')
+    def _on_reconnect(self):
+        worker_metrics.inc('worker_broker_reconnects_total')
+
+    def _open_channel(self, channel: Channel):
+        self.__set_queue_bind()
+
+    def __set_queue_bind(self):
+        try:
+            self._channel.exchange_declare(self._exchange, 'direct')
+            self._channel.queue_declare(self._route, durable=True)
+            self._channel.queue_declare(self.__delay_route, durable=True, arguments={
+                'x-dead-letter-exchange': self._exchange,
+                'x-dead-letter-routing-key': self._route,
+            })
+            self._channel.basic_qos(prefetch_count=3)
+            # Channel RPCs run in order so the bind callback fires once every declare above is done
+            self._channel.queue_bind(self._route, self._exchange, self._route, callback=self.__queue_bound)
             return True
-        self.log.error(f'[{self.__id}] Channel does not exist')
+        except Exception:
+            self.log.exception(f'[{self._id}] Failed to bind to queue')
         return False
 
-    def __wait_for_bind_set(self):
-        while not self.__bind_set:
-            if self.__connect_attempt == self.__max_connect_attempts:
-                self.log.error(f'[{self.__id}] Failed to set queue bind')
-                return False
-            sleep(.2)
-        self.log.info(f'[{self.__id}] Successfully set queue')
-        return True
+    def __queue_bound(self, _: Method):
+        self.log.info(f'[{self._id}] Successfully set queue')
+        worker_metrics.set('worker_broker_blocked', 0, consumer=self._id)
+        self._set_ready(self.__start_consuming_queue())
 
-    def __wait_for_conn_unblock(self, timeout: int = 180):
-        self.__conn_blocked = True
-        cnt = 0
-        while self.__conn_blocked:
-            sleep(1)
-            cnt += 1
-            if cnt > timeout:
-                self.log.error(f'[{self.__id}] Timeout waiting for connection unblock')
-                return False
-        return True
-
-    def __conn_unblocked(self):
-        self.__conn_blocked = False
+    def __add_job_to_queue(self, ch: Channel, method: Basic.Deliver, _, body: bytes):
+        self.__queue.put((ch, method, body))
 
-    def __load_credentials(self):
-        creds = {'user': '', 'passwd': '', 'vhost': ''}
-        for key in creds.keys():
-            try:
-                with open(f'/run/secrets/broker_{key}', 'r') as f:
-                    creds[key] = f.read().strip()
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to load broker credentials for {key}')
-        return creds
+    def __ack(self, ch: Channel, delivery_tag: int, requested: float):
+        try:
+            ch.basic_ack(delivery_tag=delivery_tag)
+            worker_metrics.observe('worker_ack_latency_seconds', time() - requested)
+        except Exception:
+            self.log.exception(f'[{self._id}] Failed to ack message')
 
-    def __create_connection_ssl_obj(self):
+    def __cancel(self):
         try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.load_verify_locations('/app/ca.crt')
-            context.load_cert_chain('/app/host.crt', '/app/host.key')
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.check_hostname = True
-            return SSLOptions(context, 'broker')
+            if self._channel is not None and self.__consumer_tag:
+                self._channel.basic_cancel(self.__consumer_tag)
+                self.log.info(f'[{self._id}] Cancelled consumer')
         except Exception:
-            self.log.exception(f'[{self.__id}] Failed to create SSL context for broker connection')
-        return None
+            self.log.exception(f'[{self._id}] Failed to cancel consumer')
 
-    def __create_connection_parameters(self):
-        creds: dict = self.__load_credentials()
-        if creds:
-            ssl = self.__create_connection_ssl_obj()
-            if ssl:
-                try:
-                    return ConnectionParameters(
-                        host='broker',
-                        port=5671,
-                        virtual_host=creds.get('vhost', '/'),
-                        credentials=PlainCredentials(creds.get('user', ''), creds.get('passwd', '')),
-                        heartbeat=15,
-                        blocked_connection_timeout=20,
-                        ssl_options=ssl
-                    )
-                except Exception:
-                    self.log.exception(f'[{self.__id}] Failed to create connection parameters')
-        return None
+    def cancel(self) -> bool:
+        """Stop new deliveries to this consumer. The consumer is not restarted on reconnect once cancelled
 
-    def __reconnect_attempt(self):
-        self.__reconnecting = True
-        if self.__connect_attempt < self.__max_connect_attempts:
-            if self.__connect_attempt != 0:
-                sleep(5)
-            self.__connect_attempt += 1
-            self.log.info(
-                f'[{self.__id}] Reconnecting to broker {self.__connect_attempt}/{self.__max_connect_attempts - 1}')
-            return self._restart_io_loop_in_thread()
-        return False
+        Returns:
+            bool: True if the cancel was scheduled on the event loop, otherwise False
+        """
+        self.__draining = True
+        return self._loop.call(self.__cancel)
 
-    def __connect(self, on_connect: callable = None, on_failed: callable = None, on_closed: callable = None):
-        self.log.info(f'[{self.__id}] Connecting to message broker')
-        params = self.__create_connection_parameters()
-        if params:
-            try:
-                return SelectConnection(params, on_connect, on_failed, on_closed)
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to create connection to broker')
-        return None
+    def __nack(self, ch: Channel, delivery_tag: int):
+        try:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        except Exception:
+            self.log.exception(f'[{self._id}] Failed to nack message')
 
-    def __connect_success(self, connection: BaseConnection):
-        self.log.info(f'[{self.__id}] Successfully connected to broker')
-        self.__connect_attempt = 0
-        connection.channel(on_open_callback=self.__open_channel)
+    def nack_msg(self, ch: Channel, delivery_tag: int) -> bool:
+        """Hand a delivered message back to the broker from a worker thread, for a job that cannot be looked up
 
-    def __connect_failed(self, *args: tuple):
-        self.log.error(f'[{self.__id}] Failed to create connection to broker: {args[1]}')
-        return self.__reconnect_attempt()
+        Args:
+            ch (Channel): channel the message was delivered on
+            delivery_tag (int): delivery tag of the message
 
-    def __connect_closed(self, *args: tuple):
-        self.log.error(f'[{self.__id}] Connection closed: {args[1]}')
-        return self.__reconnect_attempt()
+        Returns:
+            bool: True if the nack was scheduled on the event loop, otherwise False
+        """
+        return self._loop.call(self.__nack, ch, delivery_tag)
 
-    def __open_channel(self, channel: BlockingChannel):
-        self.log.info(f'[{self.__id}] Successfully opened channel')
-        self.__channel = channel
-        self.__set_queue_bind()
+    def requeue_buffered(self) -> int:
+        """Hand delivered messages that no worker thread has started back to the broker
 
-    def __set_queue_bind(self):
+        Returns:
+            int: number of messages requeued
+        """
+        count = 0
+        while True:
+            try:
+                ch, method, _ = self.__queue.get(block=False)
+            except Empty:
+                break
+            if self._loop.call(self.__nack, ch, method.delivery_tag):
+                count += 1
+        if count:
+            self.log.info(f'[{self._id}] Requeued {count} buffered messages')
+        return count
+
+    def __defer(self, ch: Channel, body: bytes, delay: int):
         try:
-            self.__channel.exchange_declare(self.__exchange, 'direct')
-            self.__channel.queue_declare(self.__route, durable=True)
-            self.__channel.basic_qos(prefetch_count=3)
-            self.log.info(f'[{self.__id}] Successfully set exchange')
-            self.__channel.queue_bind(self.__route, self.__exchange, self.__route)
-            self.__bind_set = True
-            self.__reconnecting = False
-            self.__conn_blocked = False
+            ch.basic_publish('', self.__delay_route, body, BasicProperties(
+                delivery_mode=2, expiration=str(delay * 1000)))
         except Exception:
-            self.log.exception(f'[{self.__id}] Failed to bind to queue')
-            return False
-        return self.__start_consuming_queue()
+            self.log.exception(f'[{self._id}] Failed to publish message to delay queue')
 
-    def __add_job_to_queue(self, ch: Channel, method: Basic.Deliver, _, body: bytes):
-        self.__queue.put((ch, method, body))
+    def defer_msg(self, ch: Channel, body: bytes, delay: int = HOST_DEFER_SECONDS) -> bool:
+        """Publish a message to the delay queue. The broker dead letters it back onto the job queue once it expires
+
+        Args:
+            ch (Channel): channel to publish on
+            body (bytes): message body
+            delay (int, optional): seconds before the message is redelivered. Defaults to HOST_DEFER_SECONDS.
+
+        Returns:
+            bool: True if the publish was scheduled on the event loop, otherwise False
+        """
+        return self._loop.call(self.__defer, ch, body, delay)
+
+    def ack_msg(self, ch: Channel, delivery_tag: int) -> bool:
+        """Acknowledge a delivered message from a worker thread. The ack is handed off to the broker event loop as
+        pika channels are not thread safe
+
+        Args:
+            ch (Channel): channel the message was delivered on
+            delivery_tag (int): delivery tag of the message
+
+        Returns:
+            bool: True if the ack was scheduled on the event loop, otherwise False
+        """
+        return self._loop.call(self.__ack, ch, delivery_tag, time())
 
     def __start_consuming_queue(self):
         try:
-            self.log.info(f'[{self.__id}] Starting to consume messages from queue')
-            self.__channel.basic_consume(self.__route, self.__add_job_to_queue, False)
+            self.log.info(f'[{self._id}] Starting to consume messages from queue')
+            if self.__draining:
+                return True
+            self.__consumer_tag = self._channel.basic_consume(self._route, self.__add_job_to_queue, False)
             return True
         except Exception:
-            self.log.exception(f'[{self.__id}] Exception occurred while consuming message queue')
+            self.log.exception(f'[{self._id}] Exception occurred while consuming message queue')
             return False
 
-    def __reset_connect_state(self):
-        self.__channel = None
-        self.__client = None
-        self.__bind_set = False
 
-    def __start_io_loop(self) -> bool:
-        self.__client = self.__connect(self.__connect_success, self.__connect_failed, self.__connect_closed)
-        if self.__client is not None:
-            try:
-                self.__client.add_on_connection_blocked_callback(self.__wait_for_conn_unblock)
-                self.__client.add_on_connection_unblocked_callback(self.__conn_unblocked)
-                self.__client.ioloop.start()
+class HostSlots():
+    def __init__(self, db: Mongo, job_id: str, worker_id: str, logger: logging.Logger):
+        """Distributed per-host semaphore shared by every worker. A host has one host_slots document per slot
+        ("<host>#<n>") and a slot is taken by upserting it with a filter that only matches a free or expired slot, so a
+        held slot makes the upsert collide on _id. Slots expire with the job lease if a worker dies
+
+        Args:
+            db (Mongo): database object
+            job_id (str): job taking the slots
+            worker_id (str): worker thread ID
+            logger (logging.Logger): logger object
+        """
+        self.log = logger
+        self.__db = db
+        self.__job_id = job_id
+        self.__worker_id = worker_id
+
+    def __acquire_host(self, host: str) -> bool:
+        limit = HOST_CONCURRENCY_LIMITS.get(host, HOST_CONCURRENCY_DEFAULT)
+        if limit <= 0:
+            return True
+        now = utc_now()
+        for slot in range(limit):
+            rsp = self.__db.update_one(
+                'host_slots', {'_id': f'{host}#{slot}', '$or': [{'expiresAt': {'$lt': now}}, {'jobId': self.__job_id}]},
+                {'$set': {
+                    'host': host,
+                    'jobId': self.__job_id,
+                    'workerId': self.__worker_id,
+                    'expiresAt': now + timedelta(seconds=JOB_LEASE_SECONDS),
+                }},
+                upsert=True
+            )
+            if rsp is None:
+                return False
+            if rsp is not False:
                 return True
-            except Exception:
-                self.log.exception(f'[{self.__id}] Exception occurred in IO loop')
         return False
 
-    def __stop_io_loop(self):
+    def acquire(self, hosts: list) -> bool:
+        """Take a slot on every host or none of them
+
+        Args:
+            hosts (list): target hosts (ip) of the job
+
+        Returns:
+            bool: True if a slot was taken on every host, False if a host is saturated
+        """
+        for host in sorted(set(hosts)):
+            if not self.__acquire_host(host):
+                self.log.info(f'[{self.__worker_id}] Host {host} saturated, deferring job {self.__job_id[:8]}')
+                self.release()
+                return False
+        return True
+
+    def renew(self):
+        expires = utc_now() + timedelta(seconds=JOB_LEASE_SECONDS)
+        if self.__db.update_many('host_slots', {'jobId': self.__job_id}, {'$set': {'expiresAt': expires}}) is None:
+            self.log.error(f'[{self.__worker_id}] Failed to renew host slots for job {self.__job_id[:8]}')
+
+    def release(self):
+        if self.__db.delete_many('host_slots', {'jobId': self.__job_id}) is None:
+            self.log.error(f'[{self.__worker_id}] Failed to release host slots for job {self.__job_id[:8]}')
+
+
+class JobLease():
+    def __init__(self, db: Mongo, job_id: str, worker_id: str, logger: logging.Logger, slots: HostSlots = None,
+                 has_document: bool = True):
+        """Renews the lease of a running job every JOB_HEARTBEAT_SECONDS until the job finishes so the scheduler
+        reaper can tell a long running job apart from one whose worker has died
+
+        Args:
+            db (Mongo): database client of the worker thread
+            job_id (str): ID of the claimed job
+            worker_id (str): ID of the worker thread holding the lease
+            logger (logging.Logger): logger object
+            slots (HostSlots, optional): host slots renewed with the lease. Defaults to None.
+            has_document (bool, optional): False for summary record jobs, only their host slots are renewed.
+                Defaults to True.
+        """
+        self.log = logger
+        self.__db = db
+        self.__job_id = job_id
+        self.__worker_id = worker_id
+        self.__slots = slots
+        self.__has_document = has_document
+        self.__stop = Event()
+        self.__thread: Thread | None = None
+
+    def __enter__(self):
+        self.__thread = Thread(target=self.__heartbeat, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.__stop.set()
+        if self.__thread and self.__thread.is_alive():
+            self.__thread.join(5)
+
+    def __heartbeat(self):
+        while not self.__stop.wait(JOB_HEARTBEAT_SECONDS):
+            if self.__has_document:
+                rsp = self.__db.update_one(
+                    job_collection(self.__job_id),
+                    {'_id': self.__job_id, 'state': 'running', 'workerId': self.__worker_id},
+                    {'$set': {'leaseUntil': utc_now() + timedelta(seconds=JOB_LEASE_SECONDS)}}
+                )
+                if rsp is None:
+                    self.log.error(f'[{self.__worker_id}] Failed to renew lease for job {self.__job_id[:8]}')
+                elif rsp.matched_count == 0:
+                    self.log.error(f'[{self.__worker_id}] Lost lease for job {self.__job_id[:8]}')
+                    return
+            if self.__slots is not None:
+                self.__slots.renew()
+
+
+class ResultSpool():
+    def __init__(self, logger: logging.Logger, spool_dir: str = RESULT_SPOOL_DIR):
+        """Append-only SQLite (WAL) spool of job result writes that could not be made to MongoDB. Each worker process
+        claims the first spool file no other process holds a lock on, so a replacement worker picks up the results a
+        stopped worker left behind
+
+        Args:
+            logger (logging.Logger): logger object
+            spool_dir (str, optional): spool directory (node-local volume, not NFS). Defaults to RESULT_SPOOL_DIR.
+        """
+        self.log = logger
+        self.__spool_dir = spool_dir
+        self.__lock = Lock()
+        self.__lock_file = None
+        self.__db: sqlite3.Connection | None = None
+        self.path: str | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__db is not None
+
+    def __claim_file(self) -> str | None:
+        for index in range(64):
+            path = os.path.join(self.__spool_dir, f'results-{index}.db')
+            lock_file = open(f'{path}.lock', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self.__lock_file = lock_file
+            return path
+        self.log.error(f'No free result spool file in {self.__spool_dir}')
+        return None
+
+    def open(self) -> bool:
         try:
-            if self.__channel is not None:
-                if self.__channel.is_open:
-                    self.__channel.close()
-            if self.__client is not None:
-                if self.__client.is_open:
-                    self.__client.close()
-                self.__client.ioloop.stop()
-            self.__reset_connect_state()
+            os.makedirs(self.__spool_dir, exist_ok=True)
+            self.path = self.__claim_file()
+            if self.path is None:
+                return False
+            self.__db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS results (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                              'stage INTEGER NOT NULL DEFAULT 0, job TEXT, query TEXT, "update" TEXT)')
+            self.log.info(f'Result spool opened: {self.path} ({self.pending()} pending)')
             return True
         except Exception:
-            self.log.exception(f'[{self.__id}] Exception occurred while stopping IO-loop')
-            return False
+            self.log.exception(f'Failed to open result spool in {self.__spool_dir}, results are lost while MongoDB is '
+                               'unavailable')
+            self.close()
+        return False
 
-    def __stop_thread(self):
-        if self.__thread:
+    def close(self):
+        with self.__lock:
             try:
-                if self.__thread.is_alive():
-                    self.__thread.join(3)
-                    if self.__thread.is_alive():
-                        self.log.error(f'[{self.__id}] Failed to stop broker thread')
-                        return False
-                    self.__thread = None
-                    self.log.info(f'[{self.__id}] Successfully stopped broker thread')
-                return True
+                if self.__db is not None:
+                    self.__db.close()
+                if self.__lock_file is not None:
+                    self.__lock_file.close()
             except Exception:
-                self.log.exception(f'[{self.__id}] Exception occurred while stopping broker thread')
-        self.log.debug(f'[{self.__id}] Broker thread does not exist to stop')
-        return True
+                self.log.exception('Failed to close result spool')
+            self.__db = None
+            self.__lock_file = None
 
-    def _wait_for_reconnect(self, timeout: int = 1800):
-        cnt = 0
-        while self.__reconnecting:
-            self.log.info(f'[{self.__id}] Waiting for reconnection...')
-            sleep(1)
-            cnt += 1
-            if cnt > timeout:
-                self.log.error(f'[{self.__id}] Timeout waiting for reconnection')
-                return False
-        return True
+    def append(self, job: Dict, query: Dict, update: Dict) -> bool:
+        """Durably record a job result write
 
-    def _restart_io_loop_in_thread(self):
-        """The connection to the broker is done in a separate thread to avoid blocking the main thread. This method
-        will get called via the reconnect procedure to restart the connection to the broker within the thread.
-        __start_io_loop might not return as it will be running the IO loop until the connection is closed. This is OK.
+        Args:
+            job (Dict): fields of the job the completion follow-ups need
+            query (Dict): lease guarded filter of the job update
+            update (Dict): fields set on the job
 
         Returns:
-            bool: True if the connection was successfully restarted, otherwise False
+            bool: True if the write was spooled, otherwise False
         """
-        if self.__stop_io_loop():
-            return self.__start_io_loop()
-        self.log.error(f'[{self.__id}] Failed to restart broker connection')
+        if not self.enabled:
+            return False
+        try:
+            with self.__lock:
+                self.__db.execute('INSERT INTO results (job, query, "update") VALUES (?, ?, ?)',
+                                  (json_util.dumps(job), json_util.dumps(query), json_util.dumps(update)))
+            return True
+        except Exception:
+            self.log.exception(f'Failed to spool result of job {job.get("_id")}')
         return False
 
-    def __configure_queue(self):
-        if not self.__queue_declared:
-            try:
-                self.__channel.queue_declare(self.__route, durable=True)
-                self.__queue_declared = True
-                self.log.info(f'[{self.__id}] Successfully declared queue')
-            except Exception:
-                self.log.exception(f'[{self.__id}] Failed to declare queue')
-                return False
-        return True
+    def peek(self, limit: int = RESULT_SPOOL_BATCH) -> list:
+        """Oldest spooled writes
 
-    def __handle_blocked_connection(self):
-        self.log.info(f'[{self.__id}] Connection blocked, waiting for unblock from server...')
-        while self.__conn_blocked:
-            sleep(.5)
-        self.log.info(f'[{self.__id}] Connection unblocked, resuming operations...')
-
-    def __can_send(self) -> bool:
-        if self.__conn_blocked:
-            self.__handle_blocked_connection()
-        if self.client_exists:
-            return self.__configure_queue()
-        if self._wait_for_reconnect():
-            return self.__can_send()
-        return False
+        Args:
+            limit (int, optional): max writes to return. Defaults to RESULT_SPOOL_BATCH.
 
-    def start(self):
-        if self.__thread:
-            self.log.error(f'[{self.__id}] Broker already running')
-            return False
-        self.log.info(f'[{self.__id}] Starting broker')
+        Returns:
+            list: (seq, stage, job, query, update) tuples in spool order
+        """
+        if not self.enabled:
+            return []
         try:
-            self.__thread = Thread(target=self.__start_io_loop, daemon=True)
-            self.__thread.start()
-            if self.__wait_for_bind_set():
-                return True
-            self.log.error(f'[{self.__id}] Failed to start broker')
+            with self.__lock:
+                rows = self.__db.execute('SELECT seq, stage, job, query, "update" FROM results ORDER BY seq LIMIT ?',
+                                         (limit,)).fetchall()
+            return [(seq, stage, json_util.loads(job), json_util.loads(query), json_util.loads(update))
+                    for seq, stage, job, query, update in rows]
+        except Exception:
+            self.log.exception('Failed to read result spool')
+        return []
+
+    def set_stage(self, seqs: list, stage: int) -> bool:
+        return self.__execute_many('UPDATE results SET stage = ? WHERE seq = ?', [(stage, seq) for seq in seqs])
+
+    def remove(self, seqs: list) -> bool:
+        return self.__execute_many('DELETE FROM results WHERE seq = ?', [(seq,) for seq in seqs])
+
+    def __execute_many(self, statement: str, params: list) -> bool:
+        if not self.enabled:
             return False
+        try:
+            with self.__lock:
+                self.__db.execute('BEGIN')
+                try:
+                    self.__db.executemany(statement, params)
+                    self.__db.execute('COMMIT')
+                except Exception:
+                    self.__db.execute('ROLLBACK')
+                    raise
+            return True
         except Exception:
-            self.log.exception(f'[{self.__id}] Failed to start broker')
+            self.log.exception('Failed to update result spool')
         return False
 
-    def stop(self):
-        self.log.info(f'[{self.__id}] Stopping broker')
-        if self.__stop_io_loop():
-            return self.__stop_thread()
-        self.log.error(f'[{self.__id}] Failed to stop broker')
+    def pending(self) -> int:
+        if not self.enabled:
+            return 0
+        try:
+            with self.__lock:
+                return self.__db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        except Exception:
+            self.log.exception('Failed to count result spool')
+        return 0
+
+
+class JobFileCache():
+    def __init__(self, logger: logging.Logger, cache_dir: str = JOB_CACHE_DIR, keep: int = 2):
+        """Local copies of job run files keyed by the sha256 recorded on the job at create/update time. Jobs run from
+        the copy so a run only reads the NFS share the first time a new version of the file is seen
+
+        Args:
+            logger (logging.Logger): logger object
+            cache_dir (str, optional): cache directory (tmpfs). Defaults to JOB_CACHE_DIR.
+            keep (int, optional): versions of a run file to keep. Older versions are removed. Defaults to 2.
+        """
+        self.log = logger
+        self.__cache_dir = cache_dir
+        self.__keep = keep
+        self.__versions: Dict[str, list] = {}
+        self.__lock = Lock()
+
+    def get(self, source: str, run_hash: str | None) -> str:
+        """Get the path to run a job file from. Falls back to the source file if the job has no hash or the file
+        cannot be cached
+
+        Args:
+            source (str): path of the job run file on the shared mount
+            run_hash (str | None): sha256 of the run file recorded on the job
+
+        Returns:
+            str: path of the cached copy or the source path
+        """
+        if not run_hash:
+            return source
+        cached = os.path.join(self.__cache_dir, run_hash, os.path.basename(source))
+        if os.path.isfile(cached):
+            return cached
+        return self.__fill(source, run_hash, cached)
+
+    def __fill(self, source: str, run_hash: str, cached: str) -> str:
+        temp_file = None
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            digest = hashlib.sha256()
+            with open(source, 'rb') as src, NamedTemporaryFile(dir=os.path.dirname(cached), delete=False) as dst:
+                temp_file = dst.name
+                while chunk := src.read(65536):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            if digest.hexdigest() != run_hash:
+                self.log.warning(f'Job file changed since the job was saved, running from source: {source}')
+                os.unlink(temp_file)
+                return source
+            os.chmod(temp_file, 0o755)
+            os.replace(temp_file, cached)
+            self.__prune(source, run_hash)
+            return cached
+        except Exception:
+            self.log.exception(f'Failed to cache job file: {source}')
+            if temp_file and os.path.exists(temp_file):
+                os.unlink(temp_file)
+        return source
+
+    def __prune(self, source: str, run_hash: str):
+        with self.__lock:
+            versions = self.__versions.setdefault(source, [])
+            if run_hash in versions:
+                versions.remove(run_hash)
+            versions.append(run_hash)
+            # The previous version is kept as a job started just before the change may still be reading it
+            while len(versions) > self.__keep:
+                old_dir = os.path.join(self.__cache_dir, versions.pop(0))
+                try:
+                    os.unlink(os.path.join(old_dir, os.path.basename(source)))
+                    os.rmdir(old_dir)
+                except OSError:
+                    pass  # Already removed or the hash directory is shared with another run file
+
+
+class SSHConnectionPool():
+    def __init__(self, logger: logging.Logger, control_dir: str = SSH_CONTROL_DIR):
+        """Per-host SSH control master connections shared by every remote ansible job this worker runs. Masters are
+        kept open (ControlPersist=yes) until the host has been idle for SSH_POOL_IDLE_SECONDS, and hosts of enabled
+        crons that run at least every SSH_POOL_PREWARM_PERIOD seconds are connected ahead of their next run
+
+        Args:
+            logger (logging.Logger): logger object
+            control_dir (str, optional): directory of the control sockets. Defaults to SSH_CONTROL_DIR.
+        """
+        self.log = logger
+        self.__control_dir = control_dir
+        self.__hosts: Dict[str, Dict] = {}
+        self.__lock = Lock()
+        self.__last_report = time()
+        os.makedirs(self.__control_dir, mode=0o700, exist_ok=True)
+
+    @property
+    def ansible_env_vars(self) -> Dict:
+        """Ansible ssh settings that point ansible at the pool's control sockets. Overrides ansible.cfg
+
+        Returns:
+            Dict: Ansible environment variables
+        """
+        return {
+            'ANSIBLE_SSH_ARGS': '-o ControlMaster=auto -o ControlPersist=yes',
+            'ANSIBLE_SSH_CONTROL_PATH_DIR': self.__control_dir,
+            'ANSIBLE_SSH_CONTROL_PATH': '%(directory)s/%%h-%%p-%%r',
+        }
+
+    @property
+    def __frequency_seconds(self) -> Dict:
+        return {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+    def __control_path(self, host: str) -> str:
+        return f'{self.__control_dir}/{host}-22-ansible'
+
+    def __ssh(self, host: str, options: list, command: list = None) -> bool:
+        cmd = [
+            'ssh', '-o', f'ControlPath={self.__control_path(host)}', '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'ConnectTimeout=10',
+            '-i', '/app/ansible/.env/.ansible_rsa', *options, f'ansible@{host}', *(command or [])
+        ]
+        try:
+            return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30).returncode == 0
+        except Exception:
+            self.log.exception(f'Failed to run ssh control command for host: {host}')
         return False
 
+    def __is_open(self, host: str) -> bool:
+        return self.__ssh(host, ['-O', 'check'])
+
+    def __open(self, host: str) -> bool:
+        return self.__ssh(host, ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=yes'], ['true'])
+
+    def __close(self, host: str) -> bool:
+        return self.__ssh(host, ['-O', 'exit'])
+
+    def __host_stats(self, host: str) -> Dict:
+        return self.__hosts.setdefault(host, {'lastUsed': 0, 'hits': 0, 'misses': 0})
+
+    def checkout(self, inventory: Dict | None):
+        """Record connection reuse for the hosts of a job before ansible connects to them. Ansible opens the master
+        itself on a miss and it stays in the pool afterwards. A host counts as reused when its control socket exists,
+        a stale socket is replaced by ansible the same way. Per-host counts are kept in stats, the metric is only
+        labelled by reuse
+
+        Args:
+            inventory (Dict | None): job host inventory (hostname: ip)
+        """
+        for host in set((inventory or {}).values()):
+            is_open = os.path.exists(self.__control_path(host))
+            with self.__lock:
+                stats = self.__host_stats(host)
+                stats['hits' if is_open else 'misses'] += 1
+                stats['lastUsed'] = time()
+            worker_metrics.inc('worker_ssh_checkouts_total', reused=str(is_open).lower())
+
+    def stats(self) -> Dict[str, Dict]:
+        with self.__lock:
+            return {host: dict(stats) for host, stats in self.__hosts.items()}
+
+    def __prewarm_hosts(self, db: Mongo) -> set:
+        hosts = set()
+        crons = db.get_all('crons', {'disabled': {'$ne': True}, '$or': [
+            {'hostInventory': {'$nin': [None, {}]}}, {'inventory': {'$nin': [None, '']}}
+        ]}, {'hostInventory': 1, 'inventory': 1, 'frequency': 1, 'interval': 1})
+        names = set()
+        for cron in crons:
+            period = self.__frequency_seconds.get(cron.get('frequency'), 86400) * (cron.get('interval') or 1)
+            if period <= SSH_POOL_PREWARM_PERIOD:
+                if cron.get('inventory'):
+                    names.add(cron['inventory'])
+                elif isinstance(cron.get('hostInventory'), dict):
+                    hosts.update(cron['hostInventory'].values())
+        if names:
+            for inventory in db.get_all('inventories', {'_id': {'$in': list(names)}}, {'hosts': 1}):
+                hosts.update((inventory.get('hosts') or {}).values())
+        return set(sorted(hosts)[:SSH_POOL_MAX_HOSTS])
+
+    def maintain(self, db: Mongo):
+        """Open masters for hosts of upcoming crons, close masters that have been idle too long and periodically log
+        per-host reuse rates
+
+        Args:
+            db (Mongo): database object used to read the crons
+        """
+        prewarm = self.__prewarm_hosts(db)
+        for host in prewarm:
+            if not self.__is_open(host):
+                if self.__open(host):
+                    self.log.info(f'SSH pool prewarmed host: {host}')
+                else:
+                    self.log.error(f'SSH pool failed to prewarm host: {host}')
+            with self.__lock:
+                self.__host_stats(host)['lastUsed'] = time()
+        now = time()
+        for host, stats in self.stats().items():
+            if host not in prewarm and stats['lastUsed'] and now - stats['lastUsed'] > SSH_POOL_IDLE_SECONDS:
+                if self.__close(host):
+                    self.log.info(f'SSH pool evicted idle host: {host}')
+                with self.__lock:
+                    self.__hosts[host]['lastUsed'] = 0
+        if now - self.__last_report >= SSH_POOL_REPORT_SECONDS:
+            self.__last_report = now
+            for host, stats in self.stats().items():
+                total = stats['hits'] + stats['misses']
+                if total:
+                    self.log.info(f'SSH pool host {host}: reused {stats["hits"]}/{total} ({stats["hits"] / total:.0%})')
+
+
+class WarmPool():
+    def __init__(self, logger: logging.Logger):
+        """Pool of pre-forked python interpreters for python3 jobs running in warm mode. Interpreters are forked from a
+        fork server that has already imported WARM_POOL_PRELOAD so a job only pays for running its own script. Each
+        job is forked from the interpreter, which is recycled after WARM_POOL_MAX_TASKS jobs
+
+        Args:
+            logger (logging.Logger): logger object
+        """
+        self.log = logger
+        self.__pool = None
+        self.__lock = Lock()
+
+    def start(self) -> bool:
+        self.log.info(f'Starting warm pool: size {WARM_POOL_SIZE}, preload {WARM_POOL_PRELOAD}')
+        try:
+            self.__pool = get_forkserver_context().Pool(WARM_POOL_SIZE, maxtasksperchild=WARM_POOL_MAX_TASKS)
+            return True
+        except Exception:
+            self.log.exception('Failed to start warm pool')
+        return False
+
+    def stop(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.terminate()
+                self.__pool = None
+
+    def run(self, script: str, args: list, timeout: int = None) -> Dict | None:
+        """Run a job script in the next free warm interpreter
+
+        Args:
+            script (str): path to the python3 job script
+            args (list): job arguments
+            timeout (int, optional): seconds the script can run before it is stopped. Defaults to None.
+
+        Returns:
+            Dict | None: run_warm_script result or None if the script could not be run
+        """
+        with self.__lock:
+            if self.__pool is None:
+                return None
+            result = self.__pool.apply_async(run_warm_script, (script, args, timeout))
+        try:
+            return result.get(timeout + 10 if timeout else None)
+        except multiprocessing.TimeoutError:
+            # The interpreter itself stopped responding, the pool replaces it once it exits but drops the task result
+            return {'rc': 124, 'timedOut': True, 'stdout': '', 'stderr': ''}
+        except Exception:
+            self.log.exception(f'Failed to run warm job script: {script}')
+        return None
+
 
 class Worker():
     def __init__(self):
         self.log = get_logger()
         self.stop_trigger = Event()
         self.__threads = []
+        self.__file_cache = JobFileCache(self.log)
+        self.__specs = JobSpecs(Mongo('job-specs', self.log), self.log)
+        self.__ssh_pool = SSHConnectionPool(self.log)
+        self.__runner_pool = ProcessPoolExecutor(3, get_forkserver_context())
+        self.__warm_pool: WarmPool | None = None
+        if WARM_POOL_SIZE > 0:
+            self.__warm_pool = WarmPool(self.log)
+            if not self.__warm_pool.start():
+                self.__warm_pool = None
+        self.__consumers: list[JobConsumer] = []
+        self.__spool = ResultSpool(self.log)
+        self.__spool.open()
+        worker_metrics.set('worker_spool_pending', self.__spool.pending())
+        self.__metrics_server = MetricsServer(self.log)
+        self.__metrics_server.start()
+        worker_metrics.set('worker_slots', 3)
+        worker_metrics.set('worker_slots_busy', 0)
         self.__create_worker_threads()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
+        drained = self.__drain()
+        if self.__warm_pool is not None:
+            self.__warm_pool.stop()
+        self.__runner_pool.shutdown(wait=False, cancel_futures=True)
+        self.__metrics_server.stop()
+        self.__spool.close()
+        if not drained:
+            # Do not wait on the runner processes of the jobs still running, their leases requeue them
+            os._exit(1)
+        return
+
+    def __drain(self) -> bool:
+        """Stop taking jobs and give running jobs WORKER_STOP_GRACE_SECONDS to finish. Consumers are cancelled so
+        no new messages are delivered and messages buffered in the worker queues are requeued on the broker
+
+        Returns:
+            bool: True if every running job finished within the grace period, False otherwise
+        """
+        self.log.info(f'Draining worker, waiting up to {WORKER_STOP_GRACE_SECONDS}s for running jobs')
         self.stop_trigger.set()
+        for consumer in self.__consumers:
+            consumer.cancel()
+            consumer.requeue_buffered()
+        deadline = time() + WORKER_STOP_GRACE_SECONDS
         for thread in self.__threads:
-            if thread.is_alive():
-                thread.join(1)
-        return
+            thread.join(max(deadline - time(), 0))
+        running = len([thread for thread in self.__threads if thread.is_alive()])
+        if running:
+            self.log.error(f'Grace period expired with {running} jobs still running')
+            return False
+        self.log.info('Worker drained')
+        return True
 
     def __init_worker(self):
         thread_local.consumer_id = str(uuid4())[:8]
@@ -446,29 +1165,193 @@ class Worker():
         thread_local.consumer = JobConsumer(thread_local.consumer_id, queue, self.log)
         if not thread_local.consumer.start():
             raise Exception(f'[{thread_local.consumer_id}] Failed to start job consumer')
+        self.__consumers.append(thread_local.consumer)
         while not self.stop_trigger.is_set():
-            self.__job_request_handler(*queue.get())
+            try:
+                item = queue.get(timeout=1)
+            except Empty:
+                continue
+            self.__job_request_handler(*item)
+        thread_local.consumer.requeue_buffered()
         thread_local.consumer.stop()
 
+    def __init_ssh_pool(self):
+        db = Mongo('ssh-pool', self.log)
+        while True:
+            try:
+                self.__ssh_pool.maintain(db)
+            except Exception:
+                self.log.exception('Failed to maintain SSH connection pool')
+            if self.stop_trigger.wait(30):
+                break
+
+    def __init_spool_flusher(self):
+        thread_local.consumer_id = 'spool'
+        thread_local.db = Mongo(thread_local.consumer_id, self.log)
+        while True:
+            stopping = self.stop_trigger.wait(RESULT_SPOOL_FLUSH_SECONDS)
+            if self.__spool.enabled:
+                try:
+                    while self.__flush_spool():
+                        pass
+                except Exception:
+                    self.log.exception('Failed to flush result spool')
+                worker_metrics.set('worker_spool_pending', self.__spool.pending())
+            # Keep flushing while the worker threads finish their jobs, what is left stays on disk for the next worker
+            if stopping and not any(thread.is_alive() for thread in self.__threads[:3]):
+                break
+
     def __create_worker_threads(self):
         for _ in range(3):
             thread = Thread(target=self.__init_worker, daemon=True)
             thread.start()
             self.__threads.append(thread)
+        thread = Thread(target=self.__init_ssh_pool, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+        thread = Thread(target=self.__init_spool_flusher, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+
+    @property
+    def __job_projection(self) -> Dict:
+        return {
+            'name': 1, 'type': 1, 'run': 1, 'args': 1, 'hostInventory': 1, 'extraVars': 1, 'timeout': 1, 'mode': 1,
+            'runHash': 1, 'parentId': 1, 'shard': 1, 'start': 1, 'scheduled': 1, 'cronId': 1, 'cronVersion': 1,
+            'inventory': 1
+        }
+
+    def __claim_job(self, job_id: str) -> Dict | None:
+        """Atomically move a pending job to running so only one worker can ever run it. The claim also takes the
+        first lease on the job which is renewed by JobLease while the job runs
+
+        Args:
+            job_id (str): ID of the job to claim
+
+        Returns:
+            Dict | None: the claimed job fields the worker needs or None if the job is not pending
+        """
+        now = utc_now()
+        job = thread_local.db.find_one_and_update(
+            job_collection(job_id), {'_id': job_id, 'state': 'pending'},
+            {'$set': {'state': 'running', 'start': now, 'workerId': thread_local.consumer_id,
+                      'leaseUntil': now + timedelta(seconds=JOB_LEASE_SECONDS)}},
+            self.__job_projection
+        )
+        if job and isinstance(job.get('scheduled'), datetime):
+            worker_metrics.observe('worker_job_queue_wait_seconds', max((now - job['scheduled']).total_seconds(), 0))
+        return job
 
     def __job_request_handler(self, ch: Channel, method: Basic.Deliver, body: bytes):
-        job = thread_local.db.get_one('jobs', {'_id': body.decode()})
+        if body.startswith(b'{'):
+            return self.__summary_job_request_handler(ch, method, body)
+        job_id = body.decode()
+        job = self.__claim_job(job_id)
+        if job is None:
+            found = thread_local.db.find(job_collection(job_id), {'_id': job_id}, {'state': 1}, limit=1)
+            if found is None:
+                # The claim may have failed the same way, the job is left to a worker that can reach MongoDB
+                self.log.error(f'[{thread_local.consumer_id}] Failed to look up job, requeueing message: {job_id}')
+                thread_local.consumer.nack_msg(ch, method.delivery_tag)
+                return
+            if not found:
+                self.log.error(f'[{thread_local.consumer_id}] Job not found in database: {job_id}')
+                thread_local.consumer.ack_msg(ch, method.delivery_tag)
+                return
+            self.log.info(f'[{thread_local.consumer_id}] Job already running: {job_id[:8]}')
+        elif not self.__resolve_job(job):
+            thread_local.consumer.ack_msg(ch, method.delivery_tag)
+            self.__complete_job(job, {'state': 'completed', 'result': False, 'tasks': [],
+                                      'errors': ['Failed to resolve the cron version or inventory of the job']})
+            return
+        slots = HostSlots(thread_local.db, job_id, thread_local.consumer_id, self.log)
+        if job and not slots.acquire(list((job.get('hostInventory') or {}).values())):
+            return self.__defer_job(ch, method, job_id)
+        # The job is owned through its lease from here on so the message is acked before running. Long jobs no longer
+        # hold the delivery open against the broker consumer timeout
+        thread_local.consumer.ack_msg(ch, method.delivery_tag)
         if job:
-            if job.get('state', '') == 'pending':
-                self.run_job(job)
-            else:
-                self.log.info(f'[{thread_local.consumer_id}] Job already running: {job.get("_id")[:8]}')
+            worker_metrics.inc('worker_slots_busy')
             try:
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-            except Exception:
-                self.log.exception(f'[{thread_local.consumer_id}] Failed to ack message')
-        else:
-            self.log.error(f'[{thread_local.consumer_id}] Job not found in database: {body.decode()}')
+                with JobLease(thread_local.db, job_id, thread_local.consumer_id, self.log, slots):
+                    self.run_job(job)
+            finally:
+                slots.release()
+                worker_metrics.inc('worker_slots_busy', -1)
+
+    def __resolve_job(self, job: Dict) -> bool:
+        """Fill in the run spec of a job that references its cron version and the hosts of a named inventory. Fields
+        set on the job itself, like the host inventory of a shard, override the cron version
+
+        Args:
+            job (Dict): claimed job, updated in place
+
+        Returns:
+            bool: True if the job is ready to run, False if its cron version or inventory was not found
+        """
+        if job.get('cronId'):
+            spec = self.__specs.cron_spec(job['cronId'], job.get('cronVersion'))
+            if spec is None:
+                return False
+            for key, value in spec.items():
+                if value is not None:
+                    job.setdefault(key, value)
+        if job.get('inventory'):
+            hosts = self.__specs.inventory(job['inventory'])
+            if hosts is None:
+                return False
+            job['hostInventory'] = hosts
+        return True
+
+    def __summary_job_request_handler(self, ch: Channel, method: Basic.Deliver, body: bytes):
+        """Run a job of a cron in summary record mode. The message carries the job spec and there is no job document
+        to claim, lease or complete. Once acked the run is not resent, it is only recorded when it finishes
+        """
+        try:
+            job = loads(body)
+            job['scheduled'] = datetime.fromisoformat(job['scheduled'])
+        except Exception:
+            self.log.exception(f'[{thread_local.consumer_id}] Invalid summary job message, dropping it')
+            thread_local.consumer.ack_msg(ch, method.delivery_tag)
+            return
+        if not self.__resolve_job(job):
+            thread_local.consumer.ack_msg(ch, method.delivery_tag)
+            job['start'] = utc_now()
+            self.__complete_job(job, {'state': 'completed', 'result': False, 'tasks': [],
+                                      'errors': ['Failed to resolve the inventory of the job']})
+            return
+        slots = HostSlots(thread_local.db, job['_id'], thread_local.consumer_id, self.log)
+        if not slots.acquire(list((job.get('hostInventory') or {}).values())):
+            worker_metrics.inc('worker_jobs_deferred_total')
+            thread_local.consumer.defer_msg(ch, body)
+            thread_local.consumer.ack_msg(ch, method.delivery_tag)
+            return
+        thread_local.consumer.ack_msg(ch, method.delivery_tag)
+        job['start'] = utc_now()
+        wait = (job['start'] - job['scheduled']).total_seconds()
+        worker_metrics.observe('worker_job_queue_wait_seconds', max(wait, 0))
+        worker_metrics.inc('worker_slots_busy')
+        try:
+            with JobLease(thread_local.db, job['_id'], thread_local.consumer_id, self.log, slots, False):
+                self.run_job(job)
+        finally:
+            slots.release()
+            worker_metrics.inc('worker_slots_busy', -1)
+
+    def __defer_job(self, ch: Channel, method: Basic.Deliver, job_id: str):
+        """Give a claimed job back when its hosts are saturated. The job is returned to pending and its message goes
+        through the delay queue so the worker thread is free for other jobs in the meantime
+        """
+        rsp = thread_local.db.update_one(
+            job_collection(job_id), {'_id': job_id, 'state': 'running', 'workerId': thread_local.consumer_id},
+            {'$set': {'state': 'pending', 'start': None, 'workerId': None, 'leaseUntil': None,
+                      'resent': utc_now()}}
+        )
+        if rsp is None:
+            self.log.error(f'[{thread_local.consumer_id}] Failed to return deferred job to pending: {job_id}')
+        worker_metrics.inc('worker_jobs_deferred_total')
+        thread_local.consumer.defer_msg(ch, job_id.encode())
+        thread_local.consumer.ack_msg(ch, method.delivery_tag)
 
     @property
     def ansible_env_vars(self) -> Dict:
@@ -481,6 +1364,7 @@ class Worker():
             'ANSIBLE_CONFIG': '/app/ansible/ansible.cfg',
             'ANSIBLE_PYTHON_INTERPRETER': '/usr/bin/python3',
             'ANSIBLE_PRIVATE_KEY_FILE': '/app/ansible/.env/.ansible_rsa',
+            **self.__ssh_pool.ansible_env_vars,
         }
 
     def __parse_host_inventory(self, inventory: Dict | None) -> Dict:
@@ -522,16 +1406,233 @@ class Worker():
                 job['extraVars'] = {
                     'script_file': job.get('run'),
                     'script_type': script_type,
+                    'script_source': self.__file_cache.get(
+                        f'/app/jobs/{script_type}/{job.get("run")}', job.get('runHash')),
                     'script_args': job.get('args', []),
                 }
             return playbook
         return ''
 
-    def __handle_result(self, result: ansible_runner.runner.Runner, job: Dict):
-        job['state'] = 'completed'
-        job['end'] = datetime.now()
-        job['tasks'] = []
-        for event in result.events:
+    def __partial_output(self, events: list, max_lines: int = 100) -> list:
+        """Get the tail of the playbook output of a job that was killed before it finished. The task results only
+        include finished tasks so this is the only record of what the job was doing when it was killed
+
+        Args:
+            events (list): runner events of the job
+            max_lines (int, optional): max number of output lines to keep. Defaults to 100.
+
+        Returns:
+            list: output lines
+        """
+        lines = []
+        for event in events:
+            if event.get('stdout'):
+                lines.extend(event['stdout'].splitlines())
+        return lines[-max_lines:]
+
+    def __complete_job(self, job: Dict, update: Dict) -> bool:
+        update['end'] = utc_now()
+        job_type = self.__parse_script_type(job.get('type'), job.get('run')) or 'unknown'
+        worker_metrics.inc('worker_jobs_total', type=job_type, state=update['state'],
+                           result=str(update['result']).lower())
+        if job.get('start'):
+            worker_metrics.observe('worker_job_duration_seconds', (update['end'] - job['start']).total_seconds(),
+                                   type=job_type)
+        if update['state'] == 'timed_out':
+            self.log.error(f"[{thread_local.consumer_id}] Job timed out: {job.get('name')} {job.get('_id')[:8]}")
+            update['errors'].append(f"Job timed out after {job.get('timeout')} seconds, process group killed")
+        elif update['result']:
+            self.log.info(
+                f"[{thread_local.consumer_id}] Job completed successfully: {job.get("name")} {job.get("_id")[:8]}")
+        else:
+            self.log.error(f"[{thread_local.consumer_id}] Job failed: {job.get('name')} {job.get('_id')[:8]}")
+        if job.get('record') == 'summary':
+            self.__record_summary_job(job, update)
+            return update['result']
+        query = {'_id': job.get('_id'), 'state': 'running', 'workerId': thread_local.consumer_id}
+        rsp = None
+        # While results are spooled MongoDB is likely still down, spool straight away instead of waiting on a timeout
+        if not self.__spool.pending():
+            rsp = thread_local.db.update_one(job_collection(job.get('_id')), query, {'$set': update})
+        if rsp is None:
+            self.__spool_result(job, query, update)
+        elif rsp.matched_count == 0:
+            self.log.error(f"[{thread_local.consumer_id}] Lease lost, discarding job result: {job.get('_id')}")
+        else:
+            self.__complete_job_followups(job, update)
+        return update['result']
+
+    def __complete_job_followups(self, job: Dict, update: Dict):
+        # Shards are rolled up once, as their parent job, when the last one completes the parent
+        if job.get('parentId'):
+            self.__complete_shard(job, update)
+        else:
+            self.__update_job_stats(job, update)
+
+    def __record_summary_job(self, job: Dict, update: Dict):
+        """Record a summary record job, which has no job document, in the job_stats rollup and push a failed run
+        onto the job_failures ring buffer of the job name. Nothing is spooled, a run that cannot be recorded while
+        MongoDB is down is only counted in the worker metrics
+        """
+        self.__update_job_stats(job, update)
+        if update['result']:
+            return
+        failure = {
+            'jobId': job['_id'],
+            'state': update['state'],
+            'scheduled': job['scheduled'],
+            'start': job['start'],
+            'end': update['end'],
+            'workerId': thread_local.consumer_id,
+            'errors': update['errors'],
+            'output': update.get('output', []),
+        }
+        push = {
+            '$push': {'failures': {'$each': [failure], '$slice': -JOB_FAILURES_KEEP}},
+            '$set': {'expiresAt': update['end'] + timedelta(days=JOB_STATS_RETENTION_DAYS)},
+        }
+        for _ in range(2):  # A concurrent first upsert of the job name collides on _id, the retry updates it instead
+            rsp = thread_local.db.update_one('job_failures', {'_id': job.get('name')}, push, upsert=True)
+            if rsp is not False:
+                break
+        if not rsp:
+            self.log.error(f'[{thread_local.consumer_id}] Failed to record job failure for {job.get("name")}')
+
+    def __spool_result(self, job: Dict, query: Dict, update: Dict):
+        spooled_job = {key: job.get(key) for key in ['_id', 'name', 'start', 'parentId', 'shard']}
+        if self.__spool.append(spooled_job, query, update):
+            worker_metrics.inc('worker_results_spooled_total')
+            self.log.warning(f"[{thread_local.consumer_id}] Job result spooled until MongoDB is reachable: "
+                             f"{job.get('_id')}")
+        else:
+            self.log.error(f"[{thread_local.consumer_id}] Failed to update job status in database: {job.get('_id')}")
+
+    def __flush_spool(self) -> bool:
+        """Flush the oldest batch of spooled job results to MongoDB. A result moves to stage 1 once its job update is
+        confirmed on the job document, then the shard and job stats follow-ups run and the result is removed. A batch
+        that fails part way is picked up again on the next flush, replayed job updates no longer match their lease
+        guard so they cannot apply twice
+
+        Returns:
+            bool: True if a full batch was flushed and more results may be waiting, otherwise False
+        """
+        rows = self.__spool.peek()
+        if not rows:
+            return False
+        confirmed = [row for row in rows if row[1] == 1]
+        writes = [row for row in rows if row[1] == 0]
+        if writes:
+            applied = self.__write_spooled_results(writes)
+            if applied is None:
+                return False
+            confirmed.extend(applied)
+        for seq, _, job, _, update in confirmed:
+            self.__complete_job_followups(job, update)
+            self.__spool.remove([seq])
+        if confirmed:
+            self.log.info(f'Flushed {len(confirmed)} spooled job results to MongoDB')
+        return len(rows) == RESULT_SPOOL_BATCH
+
+    def __write_spooled_results(self, rows: list) -> list | None:
+        applied = []
+        for collection in dict.fromkeys(job_collection(row[2]['_id']) for row in rows):
+            written = self.__write_spooled_collection(
+                collection, [row for row in rows if job_collection(row[2]['_id']) == collection])
+            if written is None:
+                return None
+            applied.extend(written)
+        return applied
+
+    def __write_spooled_collection(self, collection: str, rows: list) -> list | None:
+        ops = [UpdateOne(query, {'$set': update}) for _, _, _, query, update in rows]
+        rsp = thread_local.db.bulk_write(collection, ops)
+        if rsp is None:
+            return None
+        if rsp['writeConcernErrors']:
+            self.log.error(f'Spooled results not acknowledged by MongoDB: {rsp["writeConcernErrors"]}')
+            return None
+        if rsp['writeErrors']:
+            # An ordered bulk write stops at the first error, results after it stay spooled for the next flush
+            error = rsp['writeErrors'][0]
+            failed = rows[error['index']]
+            self.log.error(f'Dropping spooled result of job {failed[2]["_id"]}: {error.get("errmsg")}')
+            self.__spool.remove([failed[0]])
+            rows = rows[:error['index']]
+            if not rows:
+                return []
+        docs = thread_local.db.find(collection, {'_id': {'$in': [row[2]['_id'] for row in rows]}}, {'end': 1})
+        if docs is None:
+            return None
+        ends = {doc['_id']: doc.get('end') for doc in docs}
+        applied, lost = [], []
+        for row in rows:
+            if ends.get(row[2]['_id']) == row[4]['end']:
+                applied.append(row)
+            else:
+                self.log.error(f'Lease lost, discarding spooled job result: {row[2]["_id"]}')
+                lost.append(row)
+        self.__spool.remove([row[0] for row in lost])
+        self.__spool.set_stage([row[0] for row in applied], 1)
+        return applied
+
+    def __update_job_stats(self, job: Dict, update: Dict):
+        run = {'name': job.get('name', ''), 'start': job.get('start'), **update}
+        if not record_job_stats(thread_local.db, run):
+            self.log.error(f'[{thread_local.consumer_id}] Failed to update job stats for {run["name"]}')
+
+    @staticmethod
+    def __summarize_hosts(shard: int, tasks: list) -> list:
+        hosts: Dict[str, Dict] = {}
+        for task in tasks:
+            summary = hosts.setdefault(task['host'], {'host': task['host'], 'shard': shard, 'tasks': 0, 'rc': 0,
+                                                      'failed': False})
+            summary['tasks'] += 1
+            if task.get('failed'):
+                summary.update({'rc': task['rc'], 'failed': True})
+        return list(hosts.values())
+
+    def __complete_shard(self, job: Dict, update: Dict):
+        """Fold the result of a child job into its parent and complete the parent once every shard reported. The
+        completedShards guard keeps a shard from being counted twice and the parent is only completed by the update
+        that sees the last shard. Shard resource usage is summed on the parent, which is added to job_stats as one run.
+        The task output stays on the child, the parent only gets a summary per host so it stays small at any inventory
+        size
+        """
+        parent_id = job.get('parentId')
+        rsp = thread_local.db.update_one(
+            job_collection(parent_id), {'_id': parent_id, 'completedShards': {'$ne': job.get('shard')}},
+            {
+                '$push': {
+                    'completedShards': job.get('shard'),
+                    'hosts': {'$each': self.__summarize_hosts(job.get('shard'), update['tasks'])},
+                    'errors': {'$each': update['errors']},
+                },
+                '$inc': {
+                    'failedShards': 0 if update['result'] else 1,
+                    **{f'usage.{key}': value for key, value in (update.get('usage') or {}).items() if key != 'maxRssKb'}
+                },
+                '$max': {'usage.maxRssKb': (update.get('usage') or {}).get('maxRssKb', 0)},
+            }
+        )
+        if rsp is None:
+            self.log.error(f'[{thread_local.consumer_id}] Failed to update parent job {parent_id} with shard result')
+            return
+        if rsp.modified_count:
+            rsp = thread_local.db.update_one(
+                job_collection(parent_id),
+                {'_id': parent_id, 'state': 'running', '$expr': {'$eq': [{'$size': '$completedShards'}, '$shards']}},
+                [{'$set': {'state': 'completed', 'end': update['end'], 'result': {'$eq': ['$failedShards', 0]}}}]
+            )
+            if rsp is not None and rsp.modified_count:
+                self.log.info(f'[{thread_local.consumer_id}] All shards reported for parent job {parent_id[:8]}')
+                parent = thread_local.db.get_one(job_collection(parent_id), {'_id': parent_id},
+                                                 {'name': 1, 'start': 1, 'end': 1, 'result': 1, 'state': 1, 'usage': 1})
+                if parent and not record_job_stats(thread_local.db, parent):
+                    self.log.error(f'[{thread_local.consumer_id}] Failed to update job stats for {parent.get("name")}')
+
+    def __handle_result(self, result: Dict, job: Dict):
+        update = {'state': 'completed', 'tasks': [], 'errors': [], 'usage': result['usage']}
+        for event in result['events']:
             if event.get('event') not in ['runner_on_ok', 'runner_on_failed']:
                 continue
             data = event.get('event_data', {})
@@ -544,46 +1645,121 @@ class Worker():
                 'stdout': res.get('stdout_lines', []),
                 'stderr': res.get('stderr_lines', []),
                 'msg': res.get('msg', ''),
+                'failed': event.get('event') == 'runner_on_failed',
             }
-            if event.get('event') == 'runner_on_failed':
+            if task_info['failed']:
                 msg = res.get('stderr', '') or task_info.get('msg')
                 error = f"Task: {task_info.get('task')}, Host: {task_info.get('host')}, Error: {msg}"
                 self.log.error(error)
-                job['errors'].append(error)
-            job['tasks'].append(task_info)
-        if result.rc == 0:
-            self.log.info(
-                f"[{thread_local.consumer_id}] Job completed successfully: {job.get("name")} {job.get("_id")[:8]}")
-            job['result'] = True
+                update['errors'].append(error)
+            update['tasks'].append(task_info)
+        if result['status'] == 'timeout':
+            update.update({'state': 'timed_out', 'result': False, 'output': self.__partial_output(result['events'])})
         else:
-            job['result'] = False
-            self.log.error(f"[{thread_local.consumer_id}] Job failed: {job.get('name')} {job.get('_id')[:8]}")
-        if not thread_local.db.update_one({'_id': job.get('_id')}, {'$set': job}):
-            self.log.error(f"[{thread_local.consumer_id}] Failed to update job status in database: {job.get('_id')}")
-        return job['result']
+            update['result'] = result['rc'] == 0
+        return self.__complete_job(job, update)
+
+    def __handle_warm_result(self, result: Dict, job: Dict, script: str):
+        task_info = {
+            'task': 'Run Job',
+            'host': 'localhost',
+            'rc': result.get('rc', -1),
+            'stdin': ['python3', script] + list(job.get('args') or []),
+            'stdout': result.get('stdout', '').splitlines(),
+            'stderr': result.get('stderr', '').splitlines(),
+            'msg': '',
+            'failed': result.get('rc', -1) != 0,
+        }
+        update = {
+            'state': 'completed', 'tasks': [task_info], 'errors': [], 'result': not task_info['failed'],
+            'usage': result.get('usage')
+        }
+        if result.get('timedOut'):
+            update.update({'state': 'timed_out', 'result': False, 'output': task_info['stdout'][-100:]})
+        elif task_info['rc'] != 0:
+            error = f"Task: Run Job, Host: localhost, Error: {result.get('stderr', '') or 'non-zero return code'}"
+            self.log.error(error)
+            update['errors'].append(error)
+        return self.__complete_job(job, update)
+
+    def __is_warm_job(self, job: Dict) -> bool:
+        if job.get('mode') != 'warm':
+            return False
+        if self.__warm_pool is None:
+            self.log.info(f'[{thread_local.consumer_id}] Warm pool disabled, running job in standard mode')
+            return False
+        if self.__parse_script_type(job.get('type'), job.get('run')) != 'python3' or job.get('hostInventory'):
+            self.log.error(f'[{thread_local.consumer_id}] Warm mode only runs local python3 jobs, using standard mode')
+            return False
+        return True
+
+    def __run_warm_job(self, job: Dict) -> bool:
+        script = self.__file_cache.get(f'/app/jobs/python3/{job.get("run")}', job.get('runHash'))
+        result = self.__warm_pool.run(script, job.get('args'), job.get('timeout'))
+        if result is None:
+            return self.__complete_job(job, {'state': 'completed', 'result': False, 'tasks': [],
+                                             'errors': ['Failed to run job in warm pool']})
+        return self.__handle_warm_result(result, job, script)
 
     def run_job(self, job: Dict) -> bool:
+        """Run a job that has already been claimed by this worker
+
+        Args:
+            job (Dict): claimed job data
+
+        Returns:
+            bool: True if the job ran successfully, False otherwise
+        """
         self.log.info(f'[{thread_local.consumer_id}] Running job: {job.get("name")} {job.get("_id")[:8]}')
-        job['start'] = datetime.now()
-        job['state'] = 'running'
-        thread_local.db.update_one({'_id': job.get('_id')}, {'$set': job})
+        if self.__is_warm_job(job):
+            return self.__run_warm_job(job)
         inventory = self.__parse_host_inventory(job.get('hostInventory'))
         playbook = self.__parse_playbook(job)
         if inventory and playbook:
-            with TemporaryDirectory(prefix=f'job-{job.get("_id")}-', dir='/tmp', delete=True) as temp_dir:
-                return self.__handle_result(ansible_runner.run(
-                    private_data_dir=temp_dir,
-                    playbook=playbook,
-                    inventory=inventory,
-                    envvars=self.ansible_env_vars,
-                    extravars=job.get('extraVars', {}),
-                    quiet=True
-                ), job)
-        return False
+            if job.get('hostInventory'):
+                self.__ssh_pool.checkout(job.get('hostInventory'))
+            runner_args = {
+                'playbook': playbook,
+                'inventory': inventory,
+                'envvars': self.ansible_env_vars,
+                'extravars': job.get('extraVars', {}),
+                'timeout': job.get('timeout') or None,
+                'quiet': True,
+            }
+            runner_dir = self.__runner_skeleton() if RUNNER_TMPFS else None
+            try:
+                result = self.__runner_pool.submit(run_ansible_job, runner_args, runner_dir, job.get('_id')).result()
+            except Exception:
+                self.log.exception(f'[{thread_local.consumer_id}] Failed to run job in runner process')
+                return self.__complete_job(job, {'state': 'completed', 'result': False, 'tasks': [],
+                                                 'errors': ['Failed to run job in runner process']})
+            return self.__handle_result(result, job)
+        # The message is already acked, a job left running would only be failed by the reaper once its lease expires
+        errors = []
+        if not inventory:
+            errors.append(f'Invalid host inventory type: {type(job.get("hostInventory")).__name__}')
+        if not playbook:
+            errors.append(f'Unknown script type: {job.get("type")} for job: {job.get("run")}')
+        return self.__complete_job(job, {'state': 'completed', 'result': False, 'tasks': [], 'errors': errors})
+
+    def __runner_skeleton(self) -> str:
+        """Get the private data dir of this worker thread, creating its skeleton on first use. The dir is on tmpfs
+        and is reused by every run of the thread as env files, stdout and events are never written to it
+
+        Returns:
+            str: private data dir path
+        """
+        if getattr(thread_local, 'runner_dir', None) is None:
+            runner_dir = os.path.join(RUNNER_DIR, thread_local.consumer_id)
+            for sub_dir in ('env', 'inventory', 'project', 'artifacts'):
+                os.makedirs(os.path.join(runner_dir, sub_dir), exist_ok=True)
+            thread_local.runner_dir = runner_dir
+        return thread_local.runner_dir
 
 
 def main():
     with Worker() as worker:
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop_trigger.set())
         while not worker.stop_trigger.is_set():
             sleep(1)
 
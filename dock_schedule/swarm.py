@@ -253,10 +253,23 @@ class Services(Swarm):
             self.log.warning('Only one node in the cluster. Add more nodes to swarm cluster to rebalance services')
         return True
 
+    def __set_worker_stop_grace_period(self, data: Dict):
+        """Derive the worker stop_grace_period from the WORKER_STOP_GRACE_SECONDS the worker drains with, plus time
+        for the worker to shut down, so swarm does not kill a worker that is still waiting on its running jobs
+        """
+        worker = data.get('services', {}).get('worker', {})
+        for env in worker.get('environment', []):
+            key, _, value = str(env).partition('=')
+            if key == 'WORKER_STOP_GRACE_SECONDS' and value.isdigit():
+                worker['stop_grace_period'] = f'{int(value) + 15}s'
+                return
+
     def __load_compose_file(self) -> Dict:
         try:
             with open('/opt/dock-schedule/docker-compose.yml', 'r') as file:
-                return safe_load(file)
+                data = safe_load(file)
+            self.__set_worker_stop_grace_period(data)
+            return data
         except Exception:
             self.log.exception('Failed to load docker-compose file')
             return {}
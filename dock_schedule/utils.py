@@ -1,182 +1,23 @@
-import json
 from subprocess import run
 from tempfile import TemporaryDirectory
 from logging import Logger
 from typing import Dict
-from urllib.parse import quote_plus
-from time import sleep
 
 import ansible_runner
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure, ServerSelectionTimeoutError
 
+from dock_schedule import dsdb
 from dock_schedule.logger import get_logger
 from dock_schedule.color import Color
 
 
-class Mongo():
+class Mongo(dsdb.Mongo):
     def __init__(self, logger: Logger):
-        self.log = logger
-        self.__client: MongoClient | None = None
-        self.__creds = {'user': '', 'passwd': '', 'db': ''}
+        """Shared data-access layer configured with the host credentials and certificates of the CLI
 
-    @property
-    def __host(self):
-        return "mongodb://%s:%s@mongodb:27017/" % (quote_plus(self.__creds.get('user')),
-                                                   quote_plus(self.__creds.get('passwd')))
-
-    @property
-    def client(self):
-        if self.__client is None:
-            if self.__load_creds():
-                for attempt in range(36):
-                    try:
-                        self.__client = MongoClient(
-                            host=self.__host,
-                            tls=True,
-                            tlsCAFile='/etc/docker/ca.crt',
-                            tlsCertificateKeyFile='/etc/docker/host.pem',
-                            serverSelectionTimeoutMS=2000
-                        )
-                        self.__client.admin.command('ping')
-                        self.log.info('MongoDB client created successfully')
-                        return self.__client
-                    except ServerSelectionTimeoutError:
-                        self.log.error(f'Failed to connect to MongoDB {attempt + 1}/36')
-                    except ConnectionFailure:
-                        self.log.exception('Failed to connect to MongoDB')
-                    except Exception:
-                        self.log.exception('Failed to create MongoDB client')
-                        return None
-                    sleep(2)
-        return self.__client
-
-    def __load_creds(self):
-        try:
-            with open('/opt/dock-schedule/.mongo', 'r') as file:
-                self.__creds = json.load(file)
-            return True
-        except Exception:
-            self.log.exception('Failed to load mongodb credentials')
-            return False
-
-    def __get_db(self):
-        if self.client:
-            try:
-                return self.client[self.__creds.get('db')]
-            except Exception:
-                self.log.exception('Failed to get database object')
-        return None
-
-    def __get_collection(self, collection_name: str = 'jobs'):
-        db = self.__get_db()
-        if db is not None:
-            try:
-                return db[collection_name]
-            except Exception:
-                self.log.exception(f'Failed to get collection: {collection_name}')
-        return None
-
-    def insert_one(self, collection_name: str, document: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.insert_one(document)
-            except OperationFailure as error:
-                self.log.error(f'Failed to insert document: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to insert document: {document}')
-        return None
-
-    def insert_many(self, collection_name: str, documents: list[dict]):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.insert_many(documents)
-            except OperationFailure as error:
-                self.log.error(f'Failed to insert documents: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to insert documents: {documents}')
-        return None
-
-    def get_one(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.find_one(*filters)
-            except OperationFailure as error:
-                self.log.error(f'Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception('Failed to find data')
-        return None
-
-    def get_all(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return list(collection.find(*filters))
-            except OperationFailure as error:
-                self.log.error(f'Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception('Failed to query collection')
-        return []
-
-    def get_all_with_cursor(self, collection_name: str, *filters: dict):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.find(*filters)
-            except OperationFailure as error:
-                self.log.error(f'Failed to find data: {error.details}')
-            except Exception:
-                self.log.exception('Failed to query collection')
-        return None
-
-    def update_one(self, collection_name: str, query: dict, update: dict, upsert: bool = False):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.update_one(query, update, upsert=upsert)
-            except OperationFailure as error:
-                self.log.error(f'Failed to update data: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to update document: {query}')
-        return None
-
-    def update_many(self, collection_name: str, query: dict, update: dict, upsert: bool = False):
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                return collection.update_many(query, update, upsert=upsert)
-            except OperationFailure as error:
-                self.log.error(f'Failed to update data: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to update documents: {query}')
-        return None
-
-    def delete_one(self, collection_name: str, query: dict) -> bool:
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                collection.delete_one(query)
-                return True
-            except OperationFailure as error:
-                self.log.error(f'Failed to delete data: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to delete document: {query}')
-        return False
-
-    def delete_many(self, collection_name: str, query: dict) -> bool:
-        collection = self.__get_collection(collection_name)
-        if collection is not None:
-            try:
-                collection.delete_many(query)
-                return True
-            except OperationFailure as error:
-                self.log.error(f'Failed to delete data: {error.details}')
-            except Exception:
-                self.log.exception(f'Failed to delete documents: {query}')
-        return False
+        Args:
+            logger (Logger): logger object
+        """
+        super().__init__('cli', logger, '/opt/dock-schedule/.mongo', '/etc/docker/ca.crt', '/etc/docker/host.pem')
 
 
 class Utils():
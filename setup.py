@@ -8,6 +8,7 @@ try:
         entry_points={'console_scripts': [
             'dschedule = dock_schedule.cli:parent',
         ]},
+        extras_require={'parquet': ['pyarrow==26.0.0']},
     )
     exit(0)
 except Exception as error:
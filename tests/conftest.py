@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT, os.path.join(ROOT, 'dock_schedule/services/scheduler'),
+             os.path.join(ROOT, 'dock_schedule/services/worker')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# The scheduler and worker import dsdb and dsbroker as top level modules, the way they are copied into their images
+from dock_schedule import dsbroker, dsdb  # noqa: E402
+
+sys.modules.setdefault('dsdb', dsdb)
+sys.modules.setdefault('dsbroker', dsbroker)
+
+
+@pytest.fixture
+def memory_db():
+    """dsdb.Mongo on the in-memory mongomock backend, emptied after the test"""
+    pytest.importorskip('mongomock')
+    db = dsdb.Mongo('test', backend='memory')
+    yield db
+    db.client.drop_database('dock-schedule')
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+# mongomock 4.3 cannot take UpdateOne from pymongo 4.12 (it passes sort=), so the bulk tests insert only
+from pymongo import InsertOne
+
+from dsdb import (JOB_RETENTION_DAYS, JobPartitions, JobSpecs, db_latency, job_collection, record_job_stats,
+                  sibling_job_id)
+
+
+def bulk_write_batches() -> int:
+    for line in db_latency.render('db_latency_seconds'):
+        if line.startswith('db_latency_seconds_count{collection="bulk",operation="bulk_write"}'):
+            return int(line.split()[-1])
+    return 0
+
+
+def test_bulk_write_batches_and_totals(memory_db):
+    before = bulk_write_batches()
+    rsp = memory_db.bulk_write('bulk', [InsertOne({'_id': index}) for index in range(5)], batch_size=2)
+    assert rsp['nInserted'] == 5
+    assert rsp['writeErrors'] == []
+    assert bulk_write_batches() - before == 3
+
+
+def test_ordered_bulk_write_stops_at_first_error(memory_db):
+    memory_db.insert_one('bulk', {'_id': 3})
+    rsp = memory_db.bulk_write('bulk', [InsertOne({'_id': index}) for index in range(6)], batch_size=2)
+    # The duplicate is the second operation of the second batch, its index is into the whole request list
+    assert [error['index'] for error in rsp['writeErrors']] == [3]
+    assert rsp['nInserted'] == 3
+    assert memory_db.count_documents('bulk', {}) == 4
+
+
+def test_update_one_upsert_collision_returns_false(memory_db):
+    memory_db.insert_one('stats', {'_id': 'job|2026101900', 'runs': 1})
+    assert memory_db.update_one('stats', {'_id': 'job|2026101900', 'runs': 5}, {'$inc': {'runs': 1}},
+                                upsert=True) is False
+    rsp = memory_db.update_one('stats', {'_id': 'job|2026101900'}, {'$inc': {'runs': 1}}, upsert=True)
+    assert rsp.modified_count == 1
+    assert memory_db.get_one('stats', {'_id': 'job|2026101900'})['runs'] == 2
+
+
+def test_projections(memory_db):
+    memory_db.insert_many('jobs', [{'_id': str(index), 'name': f'job-{index}', 'run': 'test.py', 'scheduled': index}
+                                   for index in range(3)])
+    assert memory_db.get_one('jobs', {'_id': '1'}, {'name': 1}) == {'_id': '1', 'name': 'job-1'}
+    jobs = memory_db.find('jobs', {}, {'_id': 0, 'scheduled': 1}, [('scheduled', -1)], 2)
+    assert jobs == [{'scheduled': 2}, {'scheduled': 1}]
+    assert memory_db.get_all('jobs', {'name': 'job-0'}, {'run': 1}) == [{'_id': '0', 'run': 'test.py'}]
+
+
+def test_record_job_stats_without_usage(memory_db):
+    end = datetime(2026, 10, 19, 10, 5)
+    run = {'name': 'sharded', 'start': end - timedelta(seconds=3), 'end': end}
+    assert record_job_stats(memory_db, {**run, 'result': False, 'state': 'timed_out'})
+    assert record_job_stats(memory_db, {**run, 'result': True, 'state': 'completed', 'usage': {'userCpu': 1.5}})
+    stats = memory_db.get_one('job_stats', {'_id': 'sharded|2026101910'})
+    assert (stats['runs'], stats['failures'], stats['timedOut']) == (2, 1, 1)
+    assert stats['userCpu'] == 1.5
+    assert stats['maxDurationSeconds'] == 3
+
+
+def test_cron_versions_expire_and_join_onto_jobs(memory_db):
+    cron = {'_id': 'cron-1', 'name': 'join', 'type': 'python3', 'run': 'test.py', 'args': ['-v'], 'timeout': 30,
+            'hostInventory': {'web01': '10.0.0.1'}}
+    specs = JobSpecs(memory_db)
+    version = specs.save_cron_version(cron)
+    saved = memory_db.get_one('cron_versions', {'_id': f'cron-1:{version}'})
+    assert saved['expiresAt'] - saved['lastUsed'] == timedelta(days=JOB_RETENTION_DAYS + 2)
+    # Within the refresh period the expiry is not written again
+    memory_db.update_one('cron_versions', {'_id': f'cron-1:{version}'}, {'$unset': {'lastUsed': 1}})
+    assert specs.save_cron_version(cron) == version
+    assert 'lastUsed' not in memory_db.get_one('cron_versions', {'_id': f'cron-1:{version}'})
+    jobs = [{'_id': 'job-1', 'cronId': 'cron-1', 'cronVersion': version},
+            {'_id': 'job-2', 'cronId': 'cron-1', 'cronVersion': version, 'hostInventory': {'web02': '10.0.0.2'}},
+            {'_id': 'job-3', 'args': ['manual']}]
+    # A fresh JobSpecs reads the version from the database like the CLI does
+    JobSpecs(memory_db).join_cron_versions(jobs)
+    assert (jobs[0]['run'], jobs[0]['args'], jobs[0]['timeout']) == ('test.py', ['-v'], 30)
+    assert jobs[0]['hostInventory'] == {'web01': '10.0.0.1'}
+    assert jobs[1]['hostInventory'] == {'web02': '10.0.0.2'}
+    assert jobs[2] == {'_id': 'job-3', 'args': ['manual']}
+
+
+def test_job_partition_derived_from_job_id(memory_db):
+    partitions = JobPartitions(memory_db, partitioning='daily')
+    job_id = partitions.new_job_id(datetime(2026, 10, 19, 23, 59, 59))
+    assert job_id.startswith('20261019_')
+    assert job_collection(job_id) == 'jobs_20261019'
+    # Shards go to the collection of their parent whatever day they are created
+    assert job_collection(sibling_job_id(job_id)) == 'jobs_20261019'
+    unpartitioned = JobPartitions(memory_db, partitioning='none').new_job_id(datetime(2026, 10, 19))
+    assert job_collection(unpartitioned) == 'jobs'
+    assert job_collection(sibling_job_id(unpartitioned)) == 'jobs'
+    # A uuid4 can start with 8 digits, only the underscore marks a partition day
+    assert job_collection('20261019-4b1e-4d8a-9d2e-0c6f3c1a2b3c') == 'jobs'
+    assert job_collection(None) == 'jobs'
+
+
+def test_job_partitions_detected_and_listed_newest_first(memory_db):
+    detected = JobPartitions(memory_db)
+    assert not detected.partitioned
+    for day in ['20261016', '20261017', '20261018', '20261019']:
+        memory_db.insert_one(f'jobs_{day}', {'_id': f'{day}_job'})
+    assert detected.partitioned
+    assert detected.collections() == ['jobs_20261019', 'jobs_20261018', 'jobs_20261017', 'jobs_20261016', 'jobs']
+    # A day early for manual jobs scheduled just after midnight, until is exclusive of later days
+    assert detected.collections(datetime(2026, 10, 18, 0, 5), datetime(2026, 10, 18, 12)) == [
+        'jobs_20261018', 'jobs_20261017', 'jobs']
+
+
+def test_expired_job_partitions_dropped(memory_db):
+    for day in ['20261010', '20261011', '20261012', '20261019']:
+        memory_db.insert_one(f'jobs_{day}', {'_id': f'{day}_job'})
+    memory_db.insert_one('jobs', {'_id': 'legacy'})
+    partitions = JobPartitions(memory_db, partitioning='daily', retention_days=7)
+    assert partitions.prepare(datetime(2026, 10, 19, 0, 30))
+    assert sorted(memory_db.list_collection_names(r'^jobs')) == [
+        'jobs', 'jobs_20261012', 'jobs_20261019', 'jobs_20261020']
+    assert memory_db.count_documents('jobs_20261012', {}) == 1
+    # Switching partitioning off still drops what expires later
+    assert JobPartitions(memory_db, partitioning='none', retention_days=7).prepare(datetime(2026, 10, 20, 0, 30))
+    assert sorted(memory_db.list_collection_names(r'^jobs')) == ['jobs', 'jobs_20261019', 'jobs_20261020']
@@ -0,0 +1,74 @@
+import csv
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from dock_schedule.export import EXPORT_FIELDS, EXPORT_FORMATS
+
+
+def job_batches() -> list:
+    batches = []
+    for batch in range(2):
+        jobs = []
+        for index in range(3):
+            scheduled = datetime(2026, 10, 19, 10, batch, index, 250000)
+            jobs.append({
+                '_id': f'job-{batch}-{index}', 'name': 'export', 'type': 'python3', 'run': 'test.py',
+                'args': ['-v'], 'cronId': 'cron-1', 'cronVersion': 'abc', 'state': 'completed', 'result': index != 1,
+                'scheduled': scheduled, 'start': scheduled, 'end': scheduled.replace(microsecond=750000),
+                'errors': [] if index != 1 else ['failed'], 'usage': {'userCpu': 0.5}
+            })
+        batches.append(jobs)
+    return batches
+
+
+def export(tmp_path, _format: str) -> tuple:
+    path = str(tmp_path / f'jobs.{_format}')
+    writer = EXPORT_FORMATS[_format](path)
+    batches = job_batches()
+    for batch in batches:
+        writer.write(batch)
+    writer.close()
+    return path, [job for batch in batches for job in batch]
+
+
+def test_ndjson_round_trip(tmp_path):
+    path, jobs = export(tmp_path, 'ndjson')
+    with open(path) as file:
+        rows = [json.loads(line) for line in file]
+    assert [row['_id'] for row in rows] == [job['_id'] for job in jobs]
+    assert rows[0]['scheduled'] == jobs[0]['scheduled'].isoformat()
+    assert rows[1]['errors'] == ['failed']
+
+
+def test_csv_round_trip(tmp_path):
+    path, jobs = export(tmp_path, 'csv')
+    with open(path, newline='') as file:
+        reader = csv.DictReader(file)
+        assert reader.fieldnames == EXPORT_FIELDS
+        rows = list(reader)
+    assert [row['_id'] for row in rows] == [job['_id'] for job in jobs]
+    assert rows[0]['durationSeconds'] == '0.5'
+    assert json.loads(rows[0]['args']) == ['-v']
+    assert rows[0]['scheduled'] == jobs[0]['scheduled'].isoformat()
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path, jobs = export(tmp_path, 'parquet')
+    parquet = pq.ParquetFile(path)
+    # One row group per write
+    assert parquet.num_row_groups == 2
+    assert parquet.metadata.row_group(0).num_rows == 3
+    table = parquet.read()
+    assert table.schema.field('scheduled').type == pa.timestamp('ms', tz='UTC')
+    rows = table.to_pylist()
+    # Naive datetimes from pymongo are UTC
+    assert rows[0]['scheduled'] == jobs[0]['scheduled'].replace(tzinfo=timezone.utc)
+    assert rows[1]['result'] is False
+    assert rows[0]['durationSeconds'] == 0.5
+    assert json.loads(rows[0]['usage']) == {'userCpu': 0.5}
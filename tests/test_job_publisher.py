@@ -0,0 +1,127 @@
+from threading import Event
+from time import sleep
+from types import SimpleNamespace
+
+import pytest
+from pika import BasicProperties
+
+scheduler = pytest.importorskip('scheduler')
+dsbroker = pytest.importorskip('dsbroker')
+
+
+class FakeChannel():
+    def __init__(self, loop):
+        self.loop = loop
+        self.is_open = True
+        self.published = []
+        self.on_return = None
+        self.on_confirm = None
+
+    def add_on_close_callback(self, _):
+        pass
+
+    def add_on_return_callback(self, callback):
+        self.on_return = callback
+
+    def exchange_declare(self, *_):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback):
+        self.on_confirm = ack_nack_callback
+
+    def queue_declare(self, _, durable, callback):
+        self.loop.call_soon(callback, None)
+
+    def basic_publish(self, exchange, route, body, properties, mandatory=False):
+        self.published.append((body, properties))
+        frame = SimpleNamespace(method=SimpleNamespace(NAME='Basic.Ack', delivery_tag=len(self.published),
+                                                       multiple=False))
+        self.loop.call_soon(self.on_confirm, frame)
+
+
+class FakeConnection():
+    """Stands in for AsyncioConnection, opens straight away on the broker loop it is given"""
+    instances = []
+
+    def __init__(self, params, on_open, on_open_error, on_close, custom_ioloop):
+        self.loop = custom_ioloop
+        self.channel_obj = FakeChannel(custom_ioloop)
+        self.is_closing = self.is_closed = False
+        self.on_close = on_close
+        self.on_blocked = self.on_unblocked = None
+        FakeConnection.instances.append(self)
+        custom_ioloop.call_soon(on_open, self)
+
+    def add_on_connection_blocked_callback(self, callback):
+        self.on_blocked = callback
+
+    def add_on_connection_unblocked_callback(self, callback):
+        self.on_unblocked = callback
+
+    def channel(self, on_open_callback):
+        self.loop.call_soon(on_open_callback, self.channel_obj)
+
+    def close(self):
+        self.is_closed = True
+        self.loop.call_soon(self.on_close, self, 'closed')
+
+
+@pytest.fixture
+def publisher(monkeypatch):
+    monkeypatch.setattr(dsbroker, 'AsyncioConnection', FakeConnection)
+    monkeypatch.setattr(dsbroker.BrokerConnection, '_BrokerConnection__create_connection_parameters',
+                        lambda _: object())
+    FakeConnection.instances.clear()
+    pub = scheduler.JobPublisher('test-pub')
+    pub._max_connect_attempts = 1  # Fail within 30 seconds instead of waiting out the reconnect budget
+    assert pub.start()
+    yield pub, FakeConnection.instances[-1]
+    pub.stop()
+
+
+def wait_for(condition: callable, timeout: float = 5) -> bool:
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        sleep(0.05)
+    return condition()
+
+
+def return_message(loop: dsbroker.BrokerLoop, connection: FakeConnection, properties: BasicProperties):
+    channel = connection.channel_obj
+    assert loop.call(channel.on_return, channel, None, properties, b'job-1')
+
+
+def test_send_msg_waits_for_confirm(publisher):
+    pub, connection = publisher
+    assert pub.send_msg(b'job-1', 'job-1')
+    assert connection.channel_obj.published[0][0] == b'job-1'
+
+
+def test_returned_message_resent_with_attempt_header(publisher):
+    pub, connection = publisher
+    loop = dsbroker.get_broker_loop()
+    channel = connection.channel_obj
+    return_message(loop, connection, BasicProperties(message_id='job-1'))
+    assert wait_for(lambda: len(channel.published) == 1)
+    assert channel.published[0][1].headers == {'x-return-attempt': 1}
+    return_message(loop, connection, channel.published[0][1])
+    assert wait_for(lambda: len(channel.published) == 2)
+    assert channel.published[1][1].headers == {'x-return-attempt': 2}
+
+
+def test_heartbeat_runs_while_resend_backs_off_and_connection_blocked(publisher):
+    pub, connection = publisher
+    loop = dsbroker.get_broker_loop()
+    channel = connection.channel_obj
+    assert loop.call(connection.on_blocked, connection, None)
+    return_message(loop, connection, BasicProperties(message_id='job-1'))
+    heartbeat = Event()
+    # pika schedules its heartbeat checks on the same loop with call_later
+    assert loop.call(loop.loop.call_later, 0.5, heartbeat.set)
+    assert heartbeat.wait(2)
+    sleep(1.5)  # Past the 1 second backoff of the first return, the resend is held while blocked
+    assert channel.published == []
+    assert loop.call(connection.on_unblocked, connection, None)
+    assert wait_for(lambda: len(channel.published) == 1)
+    assert channel.published[0][1].headers == {'x-return-attempt': 1}
@@ -0,0 +1,111 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from dock_schedule.dsdb import JobPartitions, JobSpecs
+from dock_schedule.schedule import Schedule
+
+
+@pytest.fixture
+def schedule(memory_db):
+    """CLI Schedule reading the in-memory database"""
+    cli = Schedule()
+    cli._Schedule__db = memory_db
+    cli._Schedule__partitions = JobPartitions(memory_db, cli.log)
+    cli._Schedule__specs = JobSpecs(memory_db, cli.log)
+    return cli
+
+
+def test_jobs_read_across_partitions_newest_first(schedule, memory_db):
+    # Partition names sort the way their jobs do, so listing them newest first returns jobs newest first
+    start = datetime(2026, 10, 17, 22)
+    jobs = []
+    for hour in range(0, 48, 6):
+        scheduled = start + timedelta(hours=hour)
+        jobs.append({'_id': f'{scheduled:%Y%m%d}_{hour:02d}', 'name': 'daily', 'scheduled': scheduled})
+    for job in jobs:
+        memory_db.insert_one(f'jobs_{job["scheduled"]:%Y%m%d}', job)
+    memory_db.insert_one('jobs', {'_id': 'legacy', 'name': 'daily', 'scheduled': datetime(2026, 10, 1)})
+    newest_first = [job['_id'] for job in reversed(jobs)] + ['legacy']
+    assert [job['_id'] for job in schedule.get_jobs_by_filter({'name': 'daily'}, 0)] == newest_first
+    # A limit that ends part way into the second partition
+    assert [job['_id'] for job in schedule.get_jobs_by_filter({}, 4)] == newest_first[:4]
+    window = {'scheduled': {'$gte': datetime(2026, 10, 18, 10), '$lt': datetime(2026, 10, 19, 10)}}
+    expected = ['20261019_30', '20261018_24', '20261018_18', '20261018_12']
+    assert [job['_id'] for job in schedule.get_jobs_by_filter(window, 0)] == expected
+    # A job is read from the partition its ID names
+    assert schedule.get_jobs_by_filter({'_id': '20261018_18'}, 1)[0]['scheduled'] == datetime(2026, 10, 18, 16)
+
+
+def paged_jobs(db, partitioned: bool) -> list:
+    """Jobs of two names across two days with runs of ties on scheduled that page boundaries fall inside of
+
+    Returns:
+        list: IDs of the paged jobs newest first
+    """
+    jobs = []
+    for index, (day, minute) in enumerate([(18, 0)] * 3 + [(18, 5)] * 3 + [(19, 0)] * 4 + [(19, 30)]):
+        scheduled = datetime(2026, 10, day, 10, minute)
+        prefix = f'{scheduled:%Y%m%d}_' if partitioned else ''
+        jobs.append({'_id': f'{prefix}{index:02d}', 'name': 'paged' if index != 4 else 'other', 'state': 'completed',
+                     'result': True, 'scheduled': scheduled, 'start': scheduled, 'end': scheduled})
+    for job in jobs:
+        db.insert_one(f'jobs_{job["scheduled"]:%Y%m%d}' if partitioned else 'jobs', job)
+    paged = [job for job in jobs if job['name'] == 'paged']
+    return [job['_id'] for job in sorted(paged, key=lambda job: (job['scheduled'], job['_id']), reverse=True)]
+
+
+@pytest.mark.parametrize('partitioned', [False, True])
+@pytest.mark.parametrize('limit', [2, 3])
+def test_keyset_pages_with_ties_in_both_directions(schedule, memory_db, partitioned, limit):
+    expected = paged_jobs(memory_db, partitioned)
+    # A key that does not move past a page repeats it, bounded so that fails instead of looping forever
+    older, key = [], None
+    for _ in range(len(expected) + 1):
+        page = schedule.get_jobs_by_filter({'name': 'paged'}, limit, after=key)
+        if not page:
+            break
+        assert len(page) <= limit
+        older.extend(job['_id'] for job in page)
+        key = (page[-1]['scheduled'], page[-1]['_id'])
+    assert older == expected
+    # Back up from the oldest job, every page is still newest first
+    oldest = schedule.get_jobs_by_filter({'_id': expected[-1]}, 1)[0]
+    newer, key = [], (oldest['scheduled'], oldest['_id'])
+    for _ in range(len(expected) + 1):
+        page = schedule.get_jobs_by_filter({'name': 'paged'}, limit, before=key)
+        if not page:
+            break
+        assert len(page) <= limit
+        newer = [job['_id'] for job in page] + newer
+        key = (page[0]['scheduled'], page[0]['_id'])
+    assert newer == expected[:-1]
+
+
+def test_display_results_page_keys_walk_every_job(schedule, memory_db, capsys):
+    expected = paged_jobs(memory_db, True)
+
+    def page(**key) -> tuple:
+        assert schedule.display_results(job_name='paged', limit=3, **key)
+        output = capsys.readouterr().out
+        keys = dict(re.findall(r'(--after|--before) "([^"]+)"', output))
+        return re.findall(r'ID: (\S+),', output), keys.get('--after'), keys.get('--before')
+
+    shown, (ids, after, before) = [], page()
+    for _ in range(len(expected) + 1):
+        if not ids:
+            break
+        shown.extend(ids)
+        last_ids, last_before = ids, before
+        ids, after, before = page(after=after)
+    assert shown == expected
+    # Follow the newer keys back from the last page
+    shown, before = [], last_before
+    for _ in range(len(expected) + 1):
+        ids, _, newer = page(before=before)
+        if not ids:
+            break
+        shown = ids + shown
+        before = newer
+    assert shown == expected[:-len(last_ids)]
@@ -0,0 +1,93 @@
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from dsdb import JobPartitions, SchemaMigrations
+
+scheduler = pytest.importorskip('scheduler')
+
+MIGRATIONS = os.path.join(os.path.dirname(scheduler.__file__), 'migrations.json')
+
+
+def test_keep_last_boundary_skips_unfinished_runs(memory_db):
+    scheduler.thread_local.db = memory_db
+    runs = []
+    for minute in range(12):
+        unfinished = minute in (5, 10, 11)
+        runs.append({'_id': f'{minute:02d}', 'name': 'trim', 'scheduled': datetime(2026, 10, 19, 0, minute),
+                     'state': 'running' if unfinished else 'completed', 'result': None if unfinished else True})
+    # Newest partition first, like JobScheduler.__job_collections
+    memory_db.insert_many('jobs_new', [run for run in runs if run['scheduled'].minute >= 6])
+    memory_db.insert_many('jobs_old', [run for run in runs if run['scheduled'].minute < 6])
+    completed = [run['_id'] for run in reversed(runs) if run['result'] is not None]
+    boundary = scheduler.JobScheduler._JobScheduler__keep_last_boundary
+    for keep_last in range(1, len(completed) + 1):
+        index, job = boundary(None, 'trim', keep_last, ['jobs_new', 'jobs_old'])
+        assert job['_id'] == completed[keep_last - 1]
+        assert index == (0 if keep_last <= 4 else 1)
+    assert boundary(None, 'trim', len(completed) + 1, ['jobs_new', 'jobs_old']) is None
+    scheduler.thread_local.db = None
+
+
+@pytest.fixture
+def date_strings(monkeypatch):
+    """$substrCP and $dateFromString, which mongomock 4.3 does not implement, as MongoDB evaluates them for the ISO
+    string backfill: code point substrings, and dates without an offset taken in the given timezone"""
+    from mongomock.aggregate import _Parser
+    string_operator, date_operator = _Parser._handle_string_operator, _Parser._handle_date_operator
+
+    def handle_string_operator(self, operator, values):
+        if operator == '$substrCP':
+            string, start, length = self.parse_many(values)
+            return string[start:start + length]
+        return string_operator(self, operator, values)
+
+    def handle_date_operator(self, operator, values):
+        if operator == '$dateFromString':
+            try:
+                parsed = datetime.fromisoformat(self.parse(values['dateString']))
+            except (TypeError, ValueError):
+                return self.parse(values['onError'])
+            if parsed.tzinfo is None and values.get('timezone') == 'UTC':
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return date_operator(self, operator, values)
+
+    monkeypatch.setattr(_Parser, '_handle_string_operator', handle_string_operator)
+    monkeypatch.setattr(_Parser, '_handle_date_operator', handle_date_operator)
+
+
+def test_iso_string_backfill_keeps_legacy_jobs_rescheduled(memory_db, date_strings):
+    memory_db.insert_many('jobs', [
+        {'_id': 'pending', 'state': 'pending', 'scheduled': '2026-01-05T09:00:00.123456', 'resendAttempt': 0,
+         'resent': '2026-01-05T09:00:00.123456'},
+        {'_id': 'whole-second', 'state': 'pending', 'scheduled': '2026-01-05T09:10:00', 'resendAttempt': 1,
+         'resent': '2026-01-05T09:12:00'},
+        {'_id': 'unparsable', 'state': 'pending', 'scheduled': 'not a date', 'resendAttempt': 0,
+         'resent': 'not a date'},
+        {'_id': 'completed', 'state': 'completed', 'scheduled': '2026-01-05T09:30:00.5', 'resendAttempt': 0,
+         'resent': '2026-01-05T09:30:00.5'},
+    ])
+    job_scheduler = object.__new__(scheduler.JobScheduler)
+    job_scheduler._JobScheduler__db = memory_db
+    job_scheduler._JobScheduler__partitions = JobPartitions(memory_db, partitioning='none')
+    resent = []
+
+    def submit(_, job, attempt):
+        resent.append((job['_id'], attempt))
+
+    job_scheduler._JobScheduler__pool = SimpleNamespace(submit=submit)
+    # String times never compare with the dates of the reschedule query
+    job_scheduler.reschedule_jobs_check()
+    assert resent == []
+    assert SchemaMigrations(memory_db, MIGRATIONS).migrate()
+    jobs = {job['_id']: job for job in memory_db.get_all('jobs')}
+    assert (jobs['pending']['scheduled'], jobs['pending']['resent']) == (datetime(2026, 1, 5, 9, 0, 0, 123000),) * 2
+    assert jobs['whole-second']['resent'] == datetime(2026, 1, 5, 9, 12)
+    assert jobs['completed']['scheduled'] == datetime(2026, 1, 5, 9, 30, 0, 500000)
+    # A string that is not a date is left as it was instead of failing the migration
+    assert (jobs['unparsable']['scheduled'], jobs['unparsable']['resent']) == ('not a date', 'not a date')
+    job_scheduler.reschedule_jobs_check()
+    assert sorted(resent) == [('pending', 1), ('whole-second', 2)]
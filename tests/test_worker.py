@@ -0,0 +1,340 @@
+import json
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Event, Thread
+from time import process_time, sleep, time
+from types import SimpleNamespace
+
+import pytest
+from pymongo import UpdateOne
+
+from dsdb import JobSpecs, Mongo
+
+worker = pytest.importorskip('worker')
+
+
+class MemoryUpdateOne(UpdateOne):
+    """UpdateOne that mongomock 4.3 can take, pymongo 4.12 passes it a sort argument it does not know"""
+    def _add_to_bulk(self, bulkobj):
+        bulkobj.add_update(self._filter, self._doc, False, bool(self._upsert), hint=self._hint)
+
+
+class FakeConsumer():
+    """Records what a worker thread hands back to its JobConsumer"""
+    def __init__(self):
+        self.acked, self.nacked, self.deferred = [], [], []
+
+    def ack_msg(self, _, delivery_tag: int) -> bool:
+        self.acked.append(delivery_tag)
+        return True
+
+    def nack_msg(self, _, delivery_tag: int) -> bool:
+        self.nacked.append(delivery_tag)
+        return True
+
+    def defer_msg(self, _, body: bytes, delay: int = 0) -> bool:
+        self.deferred.append(body)
+        return True
+
+
+def delivery(tag: int = 1) -> SimpleNamespace:
+    return SimpleNamespace(delivery_tag=tag)
+
+
+@pytest.fixture
+def bare_worker(memory_db, tmp_path):
+    """Worker with its spool and job specs but without broker consumers, pools or threads"""
+    job_worker = object.__new__(worker.Worker)
+    job_worker.log = worker.get_logger()
+    job_worker.stop_trigger = Event()
+    job_worker._Worker__threads = []
+    job_worker._Worker__consumers = []
+    job_worker._Worker__specs = JobSpecs(memory_db, job_worker.log)
+    job_worker._Worker__spool = worker.ResultSpool(job_worker.log, str(tmp_path / 'spool'))
+    worker.thread_local.db = memory_db
+    worker.thread_local.consumer_id = 'test'
+    worker.thread_local.consumer = FakeConsumer()
+    yield job_worker
+    job_worker._Worker__spool.close()
+    worker.thread_local.db = None
+    worker.thread_local.consumer = None
+
+
+def spooled_result(job_id: str, end: datetime) -> tuple:
+    job = {'_id': job_id, 'name': 'spooled', 'start': end - timedelta(seconds=2), 'parentId': None, 'shard': None}
+    query = {'_id': job_id, 'state': 'running', 'workerId': 'test'}
+    update = {'state': 'completed', 'result': True, 'tasks': [], 'errors': [], 'end': end}
+    return job, query, update
+
+
+def test_result_spool_append_peek_and_ack(tmp_path):
+    spool = worker.ResultSpool(worker.get_logger(), str(tmp_path))
+    assert spool.open()
+    end = datetime(2026, 10, 19, 10, 0, 0, 123000)
+    for job_id in ['job-1', 'job-2', 'job-3']:
+        assert spool.append(*spooled_result(job_id, end))
+    rows = spool.peek(2)
+    assert [(row[1], row[2]['_id']) for row in rows] == [(0, 'job-1'), (0, 'job-2')]
+    # Dates round trip as datetimes so the flusher can compare the end it wrote
+    assert rows[0][4]['end'] == end
+    assert spool.set_stage([rows[0][0]], 1)
+    assert spool.remove([rows[1][0]])
+    assert [(row[1], row[2]['_id']) for row in spool.peek()] == [(1, 'job-1'), (0, 'job-3')]
+    # A second worker process claims another file while this one holds its lock
+    other = worker.ResultSpool(worker.get_logger(), str(tmp_path))
+    assert other.open()
+    assert (other.path != spool.path, other.pending()) == (True, 0)
+    other.close()
+    spool.close()
+    assert not spool.append(*spooled_result('job-4', end))
+    # A replacement worker picks up what was left behind
+    replacement = worker.ResultSpool(worker.get_logger(), str(tmp_path))
+    assert replacement.open()
+    assert (replacement.path, replacement.pending()) == (spool.path, 2)
+    replacement.close()
+
+
+def test_spool_flush_discards_results_of_lost_leases(bare_worker, memory_db, monkeypatch):
+    monkeypatch.setattr(worker, 'UpdateOne', MemoryUpdateOne)
+    spool = bare_worker._Worker__spool
+    assert spool.open()
+    end = datetime(2026, 10, 19, 10, 0, 0, 123000)
+    memory_db.insert_many('jobs', [
+        {'_id': 'kept', 'name': 'spooled', 'state': 'running', 'workerId': 'test'},
+        # The lease expired while MongoDB was unreachable and the reaper requeued the job to another worker
+        {'_id': 'lost', 'name': 'spooled', 'state': 'running', 'workerId': 'other'},
+    ])
+    for job_id in ['kept', 'lost']:
+        assert spool.append(*spooled_result(job_id, end))
+    assert bare_worker._Worker__flush_spool() is False
+    assert spool.pending() == 0
+    kept = memory_db.get_one('jobs', {'_id': 'kept'})
+    assert (kept['state'], kept['result'], kept['end']) == ('completed', True, end)
+    lost = memory_db.get_one('jobs', {'_id': 'lost'})
+    assert (lost['state'], lost['workerId'], 'end' in lost) == ('running', 'other', False)
+    # Only the applied result is rolled up
+    assert memory_db.get_one('job_stats', {'_id': 'spooled|2026101910'})['runs'] == 1
+
+
+# The test process has the broker loop thread of the other tests, a runner pool process is single threaded
+fork_with_threads = pytest.mark.filterwarnings('ignore:This process .* is multi-threaded')
+
+
+@fork_with_threads
+def test_ansible_run_usage_is_measured_on_its_fork(monkeypatch, tmp_path):
+    def run(private_data_dir, ident, event_handler, **_):
+        event_handler({'event': 'runner_on_ok', 'event_data': {'host': 'localhost'}})
+        start = process_time()
+        while process_time() - start < 0.2:
+            pass
+        return SimpleNamespace(status='successful', rc=0)
+
+    monkeypatch.setattr(worker.ansible_runner, 'run', run)
+    result = worker.run_ansible_job({'playbook': 'test.yml'}, str(tmp_path), 'job-1')
+    assert (result['status'], result['rc']) == ('successful', 0)
+    assert result['events'] == [{'event': 'runner_on_ok', 'event_data': {'host': 'localhost'}}]
+    # Only the forked run is counted, not the CPU time the calling process spent importing and running tests
+    assert 0.2 <= result['usage']['userCpu'] + result['usage']['sysCpu'] < 1
+
+
+@fork_with_threads
+def test_ansible_run_without_result_raises(monkeypatch, tmp_path):
+    def run(**_):
+        raise ValueError('runner failed')
+
+    monkeypatch.setattr(worker.ansible_runner, 'run', run)
+    with pytest.raises(RuntimeError):
+        worker.run_ansible_job({'playbook': 'test.yml'}, str(tmp_path), 'job-1')
+
+
+def test_job_that_cannot_run_is_failed_straight_away(bare_worker, memory_db):
+    start = datetime(2026, 10, 19, 10, 0)
+    jobs = [
+        {'_id': 'bad-type', 'name': 'bad', 'type': 'cobol', 'run': 'test.cbl'},
+        {'_id': 'bad-inventory', 'name': 'bad', 'type': 'ansible', 'run': 'test.yml', 'hostInventory': ['web01']},
+    ]
+    for job in jobs:
+        memory_db.insert_one('jobs', {**job, 'state': 'running', 'workerId': 'test', 'start': start})
+        assert bare_worker.run_job({**job, 'start': start}) is False
+    failed = {job['_id']: job for job in memory_db.get_all('jobs', {'state': 'completed', 'result': False})}
+    assert failed['bad-type']['errors'] == ['Unknown script type: cobol for job: test.cbl']
+    assert failed['bad-inventory']['errors'] == ['Invalid host inventory type: list']
+
+
+def test_unclaimable_message_is_acked_or_requeued(bare_worker, memory_db, tmp_path):
+    consumer = worker.thread_local.consumer
+    memory_db.insert_one('jobs', {'_id': 'running', 'name': 'taken', 'state': 'running', 'workerId': 'other'})
+    bare_worker._Worker__job_request_handler(None, delivery(1), b'missing')
+    bare_worker._Worker__job_request_handler(None, delivery(2), b'running')
+    assert (consumer.acked, consumer.nacked) == ([1, 2], [])
+    # Without MongoDB a job cannot be told apart from a deleted one, so its message goes back to the broker
+    worker.thread_local.db = Mongo('down', creds_file=str(tmp_path / 'missing.json'))
+    bare_worker._Worker__job_request_handler(None, delivery(3), b'unknown')
+    assert (consumer.acked, consumer.nacked) == ([1, 2], [3])
+
+
+def host_slot_owners(db: Mongo, host: str) -> list:
+    return sorted(slot['jobId'] for slot in db.get_all('host_slots', {'host': host}))
+
+
+def test_host_slots_limit_and_recover_stale_slots(memory_db, monkeypatch):
+    monkeypatch.setitem(worker.HOST_CONCURRENCY_LIMITS, '10.0.0.1', 2)
+    slots = {job_id: worker.HostSlots(memory_db, job_id, 'test', worker.get_logger()) for job_id in 'abcd'}
+    assert slots['a'].acquire(['10.0.0.1'])
+    assert slots['b'].acquire(['10.0.0.1', '10.0.0.1'])
+    # A job taking its slot again keeps the one it holds
+    assert slots['a'].acquire(['10.0.0.1'])
+    assert host_slot_owners(memory_db, '10.0.0.1') == ['a', 'b']
+    # Beyond the limit nothing is taken, not even the slot of a host that was free
+    assert not slots['c'].acquire(['10.0.0.2', '10.0.0.1'])
+    assert host_slot_owners(memory_db, '10.0.0.2') == []
+    slots['a'].release()
+    assert slots['c'].acquire(['10.0.0.2', '10.0.0.1'])
+    assert host_slot_owners(memory_db, '10.0.0.1') == ['b', 'c']
+    # The slot of a job whose worker died is taken over once its lease expired
+    memory_db.update_many('host_slots', {'jobId': 'b'}, {'$set': {'expiresAt': datetime(2026, 1, 1)}})
+    assert slots['d'].acquire(['10.0.0.1'])
+    assert host_slot_owners(memory_db, '10.0.0.1') == ['c', 'd']
+
+
+def pending_host_job(db: Mongo, job_id: str) -> bytes:
+    db.insert_one('jobs', {'_id': job_id, 'name': 'hosts', 'type': 'ansible', 'run': 'test.yml', 'state': 'pending',
+                           'scheduled': datetime(2026, 10, 19, 10, 0), 'hostInventory': {'web01': '10.0.0.1'}})
+    return job_id.encode()
+
+
+def test_host_slots_released_when_the_job_exits(bare_worker, memory_db, monkeypatch):
+    monkeypatch.setitem(worker.HOST_CONCURRENCY_LIMITS, '10.0.0.1', 1)
+    held = []
+
+    def run_job(job):
+        held.append(host_slot_owners(memory_db, '10.0.0.1'))
+        if job['_id'] == 'fails':
+            raise RuntimeError('job crashed')
+        return True
+
+    bare_worker.run_job = run_job
+    bare_worker._Worker__job_request_handler(None, delivery(1), pending_host_job(memory_db, 'runs'))
+    with pytest.raises(RuntimeError):
+        bare_worker._Worker__job_request_handler(None, delivery(2), pending_host_job(memory_db, 'fails'))
+    assert held == [['runs'], ['fails']]
+    assert host_slot_owners(memory_db, '10.0.0.1') == []
+    assert worker.thread_local.consumer.acked == [1, 2]
+
+
+def test_saturated_host_defers_job_to_delay_queue(bare_worker, memory_db, monkeypatch):
+    monkeypatch.setitem(worker.HOST_CONCURRENCY_LIMITS, '10.0.0.1', 1)
+    assert worker.HostSlots(memory_db, 'other', 'test', worker.get_logger()).acquire(['10.0.0.1'])
+    bare_worker.run_job = lambda job: pytest.fail('a deferred job must not run')
+    bare_worker._Worker__job_request_handler(None, delivery(1), pending_host_job(memory_db, 'deferred'))
+    consumer = worker.thread_local.consumer
+    assert (consumer.deferred, consumer.acked) == ([b'deferred'], [1])
+    job = memory_db.get_one('jobs', {'_id': 'deferred'})
+    assert (job['state'], job['workerId'], job['leaseUntil']) == ('pending', None, None)
+    assert host_slot_owners(memory_db, '10.0.0.1') == ['other']
+
+
+def summary_message(index: int) -> bytes:
+    return json.dumps({'_id': f'summary-{index}', 'name': 'frequent', 'type': 'python3', 'run': 'test.py',
+                       'record': 'summary', 'scheduled': datetime(2026, 10, 19, 10, 0, index).isoformat()}).encode()
+
+
+def test_summary_runs_keep_stats_and_last_failures(bare_worker, memory_db, monkeypatch):
+    monkeypatch.setattr(worker, 'JOB_FAILURES_KEEP', 3)
+    consumer = worker.thread_local.consumer
+    acked_before_run = []
+
+    def run_job(job):
+        acked_before_run.append(len(consumer.acked))
+        errors = [] if job['_id'] == 'summary-0' else [f'{job["_id"]} failed']
+        return bare_worker._Worker__complete_job(job, {'state': 'completed', 'result': not errors, 'tasks': [],
+                                                       'errors': errors})
+
+    bare_worker.run_job = run_job
+    for index in range(6):
+        bare_worker._Worker__job_request_handler(None, delivery(index + 1), summary_message(index))
+    # At most once: every message is acked before its run starts
+    assert acked_before_run == [1, 2, 3, 4, 5, 6]
+    assert memory_db.count_documents('jobs', {}) == 0
+    stats = memory_db.get_all('job_stats', {'name': 'frequent'})
+    assert (sum(stat['runs'] for stat in stats), sum(stat['failures'] for stat in stats)) == (6, 5)
+    failures = memory_db.get_one('job_failures', {'_id': 'frequent'})['failures']
+    assert [failure['jobId'] for failure in failures] == ['summary-3', 'summary-4', 'summary-5']
+    assert failures[-1]['errors'] == ['summary-5 failed']
+
+
+class DrainConsumer():
+    def __init__(self, stop_trigger: Event, events: list):
+        self.stop_trigger = stop_trigger
+        self.events = events
+
+    def cancel(self) -> bool:
+        self.events.append(('cancel', self.stop_trigger.is_set()))
+        return True
+
+    def requeue_buffered(self) -> int:
+        self.events.append(('requeue', self.stop_trigger.is_set()))
+        return 0
+
+
+def test_drain_stops_deliveries_then_waits_for_running_jobs(bare_worker, monkeypatch):
+    monkeypatch.setattr(worker, 'WORKER_STOP_GRACE_SECONDS', 5)
+    events = []
+    bare_worker._Worker__consumers = [DrainConsumer(bare_worker.stop_trigger, events)]
+
+    def running_job():
+        bare_worker.stop_trigger.wait()
+        sleep(0.3)
+        events.append(('job finished', True))
+
+    bare_worker._Worker__threads = [Thread(target=running_job, daemon=True)]
+    bare_worker._Worker__threads[0].start()
+    start = time()
+    assert bare_worker._Worker__drain()
+    assert 0.3 <= time() - start < 5
+    # Deliveries stop once the stop trigger is set and before the running job is waited on
+    assert events == [('cancel', True), ('requeue', True), ('job finished', True)]
+
+
+def test_drain_gives_up_after_the_grace_period(bare_worker, monkeypatch):
+    monkeypatch.setattr(worker, 'WORKER_STOP_GRACE_SECONDS', 0.3)
+    release = Event()
+    bare_worker._Worker__threads = [Thread(target=release.wait, daemon=True)]
+    bare_worker._Worker__threads[0].start()
+    start = time()
+    assert not bare_worker._Worker__drain()
+    assert time() - start < 2
+    release.set()
+
+
+class ConsumerChannel():
+    def __init__(self):
+        self.calls = []
+
+    def basic_cancel(self, consumer_tag: str):
+        self.calls.append(('cancel', consumer_tag))
+
+    def basic_consume(self, *_):
+        self.calls.append(('consume',))
+        return 'ctag-2'
+
+    def basic_nack(self, delivery_tag: int, requeue: bool):
+        self.calls.append(('nack', delivery_tag, requeue))
+
+
+def test_cancelled_consumer_takes_no_deliveries():
+    queue = Queue()
+    consumer = worker.JobConsumer('drain', queue)
+    channel = ConsumerChannel()
+    consumer._channel = channel
+    consumer._JobConsumer__consumer_tag = 'ctag-1'
+    for tag in [7, 8]:
+        queue.put((channel, delivery(tag), b'job'))
+    assert consumer.cancel()
+    assert consumer.requeue_buffered() == 2
+    # A reconnect after the cancel sets up the channel without consuming again
+    assert consumer._JobConsumer__start_consuming_queue()
+    # Callbacks run in order on the broker loop, once this one ran the cancel and nacks have too
+    done = Event()
+    assert consumer._loop.call(done.set) and done.wait(2)
+    assert channel.calls == [('cancel', 'ctag-1'), ('nack', 7, True), ('nack', 8, True)]